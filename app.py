@@ -1,23 +1,53 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_from_directory, abort
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, send_from_directory, abort, Response
 from flask_socketio import SocketIO, emit
 from flask_login import LoginManager, login_required, current_user, login_user
 from datetime import timedelta
 from dotenv import load_dotenv
-import google.generativeai as genai
 import os
 import time
 import logging
 import json
-from models import db, User, Conversation, Message
-from auth import auth as auth_blueprint, oauth
-import PIL.Image
+from functools import wraps
+from models import db, User, Conversation, Message, ensure_columns, ensure_indexes
+import sqlalchemy as sa
+from auth import auth as auth_blueprint
 import io
 import base64
 import pathlib
 import textwrap
 import mimetypes
-from groq import Groq
-genai_types = genai.types # Usar el alias genai importado previamente
+from upstream_clients import UpstreamClients, UpstreamBusyError, build_groq_client
+from backends import BackendRegistry, FakeBackend, GeminiBackend, GroqBackend
+from model_registry import ModelRegistry
+from history_loader import HistoryLoader
+from job_scheduler import JobScheduler, QueueFullError
+from video_jobs import VideoJobTracker
+from stream_coalescer import StreamCoalescer
+from attachment_store import AttachmentStore
+from media_store import MediaStore
+from media_server import MediaServer
+from image_pipeline import ImagePreprocessor, ImageVariants
+from instrumentation import Instrumentation
+from message_persister import MessagePersister
+from message_search import MessageSearch, SearchUnavailableError
+from response_cache import ResponseCache, replay_chunks
+from providers import LazyModule, ProviderRegistry
+from blocking import BlockingExecutor, LoopLagMonitor
+from database_config import (
+    SQLITE_WRITER_BIND,
+    PoolMonitor,
+    configure_postgres,
+    configure_sqlite,
+    get_write_engine,
+    install_sqlite_pragmas,
+    pool_status,
+    recreate_pools_after_fork,
+    release_connection,
+    sqlite_pragmas,
+)
+# Los SDK pesados se importan en su primer uso (ver providers.py y gunicorn_config.py)
+genai = LazyModule('google.generativeai')
+PIL = LazyModule('PIL')
 
 # Configuración de logging
 logging.basicConfig(
@@ -36,125 +66,249 @@ if not os.path.exists(UPLOAD_FOLDER):
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
-# Configurar Google AI
+# Media generada (imágenes, videos) con nombres por hash; MEDIA_MAX_BYTES limita todo
+# uploads/ (adjuntos y variantes incluidos) borrando primero lo usado hace más tiempo.
+# MEDIA_RESCAN_SECONDS: cada cuánto se mide de nuevo el directorio (escrituras de otros workers)
+media_store = MediaStore(
+    UPLOAD_FOLDER,
+    max_bytes=int(os.getenv('MEDIA_MAX_BYTES', 500 * 1024 * 1024)),
+    min_age_seconds=int(os.getenv('MEDIA_MIN_AGE_SECONDS', 600)),
+    reuse_ttl_seconds=int(os.getenv('MEDIA_REUSE_TTL', 86400)),
+    rescan_seconds=int(os.getenv('MEDIA_RESCAN_SECONDS', 300))
+)
+
+# Almacén de adjuntos subidos, direccionado por SHA-256 (deduplica imágenes repetidas)
+ATTACHMENTS_FOLDER = os.path.join(UPLOAD_FOLDER, 'attachments')
+attachment_store = AttachmentStore(ATTACHMENTS_FOLDER, max_size=MAX_FILE_SIZE, on_write=media_store.record_write)
+
+# Envío de /uploads: MEDIA_OFFLOAD='x-accel' (nginx) o 'x-sendfile' delega el envío
+# del fichero al proxy; MEDIA_OFFLOAD_PREFIX es la location interna de nginx
+media_server = MediaServer(
+    UPLOAD_FOLDER,
+    offload=os.getenv('MEDIA_OFFLOAD') or None,
+    offload_prefix=os.getenv('MEDIA_OFFLOAD_PREFIX', '/_uploads')
+)
+
+# Paginación de mensajes en GET /api/conversations/<id>
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+
+# Paginación de la barra lateral en GET /api/conversations
+CONVERSATIONS_PAGE_SIZE = 50
+CONVERSATIONS_PAGE_MAX = 200
+
+# Búsqueda en el historial (GET /api/conversations/search); SEARCH_LANGUAGE es la
+# configuración de texto de PostgreSQL ('simple' no aplica stemming de ningún idioma)
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 50
+SEARCH_LANGUAGE = os.getenv('SEARCH_LANGUAGE', 'simple')
+
+# Agrupación de 'message_progress': se emite al acumular N bytes o tras M milisegundos
+STREAM_FLUSH_BYTES = int(os.getenv('STREAM_FLUSH_BYTES', 64))
+STREAM_FLUSH_INTERVAL_MS = int(os.getenv('STREAM_FLUSH_INTERVAL_MS', 80))
+
+# Tiempo máximo (segundos) para generar el título de una conversación antes de usar el fallback
+TITLE_GENERATION_TIMEOUT = float(os.getenv('TITLE_GENERATION_TIMEOUT', 5))
+
+# Caché de respuestas (desactivada por defecto) para búsquedas web y primeras preguntas
+# sin adjuntos. Con RESPONSE_CACHE_EMBEDDING_MODEL también acepta prompts parecidos
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 500))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv('RESPONSE_CACHE_EMBEDDING_MODEL')  # p. ej. models/text-embedding-004
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', 0.95))
+
+# Tablas e índices que falten: gunicorn los crea en el maestro antes de arrancar los
+# workers (ver gunicorn_config.py). Con DB_PREPARE_ON_START=false solo se crean con
+# 'flask --app app init-db' (p. ej. como paso de despliegue)
+DB_PREPARE_ON_START = os.getenv('DB_PREPARE_ON_START', 'true').lower() == 'true'
+
+# Perfil de SQLite cuando no hay DATABASE_URL de PostgreSQL ('tuned' o 'default')
+SQLITE_PROFILE = os.getenv('SQLITE_PROFILE', 'tuned')
+SQLITE_READERS = int(os.getenv('SQLITE_READERS', 4))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+# Pool de conexiones de PostgreSQL. DB_POOL_TIMEOUT es bajo a propósito: con el pool
+# agotado es mejor fallar pronto (y verlo en /metrics) que esperar los 30s por defecto
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# Esperas por una conexión a partir de las que se registra un aviso
+DB_POOL_SLOW_WAIT_MS = int(os.getenv('DB_POOL_SLOW_WAIT_MS', 100))
+
+# Tiempos por etapa (histogramas en /metrics); SLOW_REQUEST_MS activa el log de peticiones lentas
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 0)) or None
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+instrumentation = Instrumentation(slow_threshold_ms=SLOW_REQUEST_MS)
+
+# Espera por una conexión de cada pool (etapa db_pool_wait_<motor> en /metrics)
+db_pool_monitors = {
+    name: PoolMonitor(
+        name,
+        observe=lambda seconds, name=name: instrumentation.observe(f'db_pool_wait_{name}', seconds),
+        slow_wait_ms=DB_POOL_SLOW_WAIT_MS
+    )
+    for name in ('default', SQLITE_WRITER_BIND)
+}
+
+# Claves de Google AI y Groq
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 GROQ_API_KEY = os.getenv('GROQ_API_KEY')
-logger.info("Intentando configurar Google AI y Groq...")
 
-# Configurar Groq AI
-if GROQ_API_KEY:
-    try:
-        # Inicializar el cliente Groq directamente sin manipular proxies
-        groq_client = Groq(api_key=GROQ_API_KEY)
-        logger.info("Groq API configurada exitosamente")
-    except Exception as e:
-        logger.error(f"Error al configurar Groq API: {str(e)}")
-        groq_client = None
-else:
+# Clientes de proveedores con inicialización diferida. PROVIDER_WARMUP (con gunicorn):
+# 'preload' importa los SDK en el maestro y construye los clientes en cada worker tras
+# el fork; 'worker' hace ambas cosas en el worker; 'lazy' espera al primer uso
+PROVIDER_WARMUP = os.getenv('PROVIDER_WARMUP', 'preload')
+providers = ProviderRegistry()
+
+# Clientes de proveedores: pool de conexiones, timeouts y llamadas simultáneas por proveedor
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', 20))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv('UPSTREAM_MAX_KEEPALIVE', 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', 5))
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', 60))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 1))
+UPSTREAM_ACQUIRE_TIMEOUT = float(os.getenv('UPSTREAM_ACQUIRE_TIMEOUT', 10))
+UPSTREAM_LIMITS = {
+    'groq': int(os.getenv('UPSTREAM_LIMIT_GROQ', 8)),
+    'gemini': int(os.getenv('UPSTREAM_LIMIT_GEMINI', 8)),
+}
+
+# Configurar Groq AI: un único cliente por worker, compartido por todas las tareas en segundo plano
+def build_groq():
+    return build_groq_client(
+        GROQ_API_KEY,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+        connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+        read_timeout=UPSTREAM_READ_TIMEOUT,
+        max_retries=UPSTREAM_MAX_RETRIES
+    )
+
+providers.register('groq', build_groq, modules=('httpx', 'httpcore', 'groq'), enabled=bool(GROQ_API_KEY))
+if not GROQ_API_KEY:
     logger.warning("GROQ_API_KEY no está configurada")
-    groq_client = None
 
-# Variables globales para los modelos
-model = None
-vision_model = None
-image_gen_model = None  # Modelo para generación/edición de imágenes
+upstream = UpstreamClients(
+    get_groq_client=lambda: providers.get('groq'),
+    limits=UPSTREAM_LIMITS,
+    gemini_timeout=UPSTREAM_READ_TIMEOUT,
+    acquire_timeout=UPSTREAM_ACQUIRE_TIMEOUT
+)
+
+# Las llamadas al SDK de Gemini (gRPC) no ceden el control a gevent: se ejecutan en un
+# pool de hilos nativos. Debe ser al menos UPSTREAM_LIMIT_GEMINI para que una llamada con
+# plaza en el limitador no espere además por un hilo (Groq usa httpx y ya es cooperativo)
+BLOCKING_POOL_SIZE = int(os.getenv('BLOCKING_POOL_SIZE', UPSTREAM_LIMITS['gemini'] + 2))
+upstream_executor = BlockingExecutor('upstream', BLOCKING_POOL_SIZE)
 
+# Retrasos del bucle de gevent por encima de LOOP_LAG_THRESHOLD_MS se registran como
+# aviso (0 desactiva el monitor); todas las medidas van a la etapa loop_lag de /metrics
+LOOP_LAG_THRESHOLD_MS = int(os.getenv('LOOP_LAG_THRESHOLD_MS', 100))
+LOOP_LAG_INTERVAL_MS = int(os.getenv('LOOP_LAG_INTERVAL_MS', 100))
+
+@instrumentation.timed('save_message')
 def save_message_to_db(conversation_id, content, role):
     """
-    Guarda un mensaje en la base de datos.
+    Guarda un mensaje en la base de datos (escritura diferida en lotes, ver MessagePersister).
+    
+    El mensaje se encola y se escribe en la siguiente transacción por lotes; para leer
+    lo recién guardado hay que llamar antes a message_persister.flush().
     
     Args:
         conversation_id: ID de la conversación
         content: Contenido del mensaje
         role: Rol del mensaje ('user' o 'assistant')
     """
-    try:
-        # Obtener o crear la conversación
-        conversation = Conversation.query.get(conversation_id)
-        if not conversation:
-            conversation = Conversation(id=conversation_id)
-            db.session.add(conversation)
-        
-        # Crear y guardar el mensaje
-        message = Message(
-            conversation_id=conversation_id,
-            content=content,
-            role=role
-        )
-        db.session.add(message)
-        db.session.commit()
-        logger.debug(f"Mensaje guardado en DB - Conversación: {conversation_id}, Rol: {role}")
-        
-    except Exception as e:
-        logger.error(f"Error guardando mensaje en DB: {str(e)}")
-        db.session.rollback()
+    message_persister.save(conversation_id, content, role)
+    logger.debug(f"Mensaje encolado - Conversación: {conversation_id}, Rol: {role}")
 
-try:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    
-    # Configuración del modelo
-    generation_config = {
-        "temperature": 0.9,
-        "top_p": 1,
-        "top_k": 32,
-        "max_output_tokens": 2048,
-    }
-
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-    ]
+def stored_user_content(user_message, images):
+    """
+    Texto con el que se guarda un mensaje del usuario (el prompt más una nota de los adjuntos).
 
-    # Usar el mismo modelo para todo
-    model = genai.GenerativeModel(
-        model_name="gemini-2.0-flash",    # Última versión Gemini 2.0 Flash
-        generation_config=generation_config,
-        safety_settings=safety_settings
-    )
+    Args:
+        user_message: Texto escrito por el usuario
+        images: Imágenes adjuntas al mensaje
 
-    # Modelo para generación/edición de imágenes (Gemini Flash)
-    try:
-        image_gen_model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash-exp-image-generation",  # Gemini Flash 2.0 Experimento (imagen)
-            generation_config=generation_config, # Ajustar si es necesario
-            safety_settings=safety_settings
-        )
-        logger.info("Modelo de generación de imágenes configurado exitosamente")
-    except Exception as e:
-        logger.error(f"Error configurando modelo de generación de imágenes: {e}")
-        image_gen_model = None
-
-    # Cliente Google AI (genai.Client) no se usa directamente aquí.
-    # La inicialización del modelo principal (texto/imagen) se hace arriba.
-    # genai_client = None # Mantener como None si Veo 2 no está activo/configurado
-    genai_client = None
-    if GOOGLE_API_KEY:
-        try:
-            genai_client = genai.Client()
-            logger.info("Google AI Client (for Veo 2) initialized successfully.")
-        except Exception as e:
-            logger.error(f"Failed to initialize Google AI Client for Veo 2: {e}")
-            genai_client = None # Ensure it's None if initialization fails
-    else:
-        logger.warning("GOOGLE_API_KEY not found. Google AI Client for Veo 2 cannot be initialized.")
+    Returns:
+        str: Contenido que se guarda en la base de datos
+    """
+    content = user_message
+    if images:
+        content += f"\n[{len(images)} image(s) attached]"
+    return content.strip()
+
+# Configuración del modelo Gemini principal
+GEMINI_MODEL_NAME = "gemini-2.0-flash"    # Última versión Gemini 2.0 Flash
+GEMINI_IMAGE_MODEL_NAME = "gemini-2.0-flash-exp-image-generation"  # Gemini Flash 2.0 Experimento (imagen)
+
+generation_config = {
+    "temperature": 0.9,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 2048,
+}
+
+safety_settings = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+]
+
+# Registro de modelos: cada configuración se construye una vez por worker
+model_registry = ModelRegistry(api_key=GOOGLE_API_KEY)
+
+# Modelo de texto principal y modelo de generación/edición de imágenes (Gemini Flash)
+providers.register(
+    'gemini',
+    lambda: model_registry.get(GEMINI_MODEL_NAME, generation_config, safety_settings),
+    modules=('google.generativeai',)
+)
+providers.register(
+    'gemini_image',
+    lambda: model_registry.get(GEMINI_IMAGE_MODEL_NAME, generation_config, safety_settings),
+    modules=('google.generativeai',)
+)
 
-    # Initialize chat instance (para el modelo de texto principal)
-    chat = model.start_chat(history=[])
-    logger.info("Google AI model y chat configurados exitosamente")
-    logger.info("Google AI configurado exitosamente")
-except Exception as e:
-    logger.error(f"Error configurando Google AI: {e}")
-    model = None
+# Cliente Google AI para la generación de videos (Veo 2)
+providers.register('veo', lambda: genai.Client(), modules=('google.generativeai',), enabled=bool(GOOGLE_API_KEY))
+if not GOOGLE_API_KEY:
+    logger.warning("GOOGLE_API_KEY not found. Google AI Client for Veo 2 cannot be initialized.")
 
 # Almacenamiento de contexto por conversación
 conversation_history = {}
 
+# Presupuesto de historial por modelo (mensajes y tokens aproximados enviados en cada turno)
+HISTORY_BUDGETS = {
+    'gemini': {
+        'max_messages': int(os.getenv('HISTORY_MAX_MESSAGES_GEMINI', 40)),
+        'max_tokens': int(os.getenv('HISTORY_MAX_TOKENS_GEMINI', 24000)),
+    },
+    'groq': {
+        'max_messages': int(os.getenv('HISTORY_MAX_MESSAGES_GROQ', 30)),
+        'max_tokens': int(os.getenv('HISTORY_MAX_TOKENS_GROQ', 6000)),
+    },
+}
+history_loader = HistoryLoader(budgets=HISTORY_BUDGETS)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_image(file):
+def process_image(file, max_edge=None, quality=None):
+    """
+    Normaliza una imagen a JPEG RGB.
+
+    Args:
+        file: Archivo de Flask (FileStorage) o io.BytesIO con la imagen
+        max_edge: Tamaño máximo (px) del lado mayor; si es None no se redimensiona
+        quality: Calidad JPEG (1-95); si es None se usa la de PIL por defecto
+
+    Returns:
+        io.BytesIO con la imagen JPEG o None si no se pudo procesar
+    """
     try:
         if isinstance(file, io.BytesIO):
             # Si es un BytesIO, leemos directamente los bytes
@@ -188,13 +342,26 @@ def process_image(file):
             # Abrir la imagen con PIL
             img = PIL.Image.open(io.BytesIO(image_bytes))
             
+            if max_edge:
+                # Para JPEG, decodificar directamente a una escala reducida (mucho más rápido)
+                img.draft('RGB', (max_edge, max_edge))
+            
+            # Aplicar la orientación EXIF antes de descartar los metadatos
+            img = PIL.ImageOps.exif_transpose(img)
+            
             # Convertir a RGB si es necesario
             if img.mode != 'RGB':
                 img = img.convert('RGB')
             
+            if max_edge and max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), PIL.Image.LANCZOS)
+            
             # Guardar la imagen procesada en un BytesIO
             output = io.BytesIO()
-            img.save(output, format='JPEG')
+            save_options = {'format': 'JPEG'}
+            if quality:
+                save_options.update(quality=quality, optimize=True)
+            img.save(output, **save_options)
             output.seek(0)
             
             logger.debug("Imagen procesada exitosamente")
@@ -208,6 +375,98 @@ def process_image(file):
         logger.error(f"Error en process_image: {e}")
         return None
 
+# Preprocesado de imágenes antes de enviarlas al modelo (tamaño máximo y calidad JPEG)
+image_preprocessor = ImagePreprocessor(
+    attachment_store,
+    process_image,
+    max_edge=int(os.getenv('IMAGE_MAX_EDGE', 1536)),
+    quality=int(os.getenv('IMAGE_JPEG_QUALITY', 85)),
+    pool_size=int(os.getenv('IMAGE_POOL_SIZE', 2))
+)
+
+# Variantes WebP/AVIF (miniatura y anchos) de las imágenes generadas, en segundo plano
+image_variants = ImageVariants(
+    UPLOAD_FOLDER,
+    widths=tuple(int(w) for w in os.getenv('IMAGE_VARIANT_WIDTHS', '320,640,1280').split(',')),
+    quality=int(os.getenv('IMAGE_VARIANT_QUALITY', 80)),
+    pool_size=int(os.getenv('IMAGE_VARIANT_POOL_SIZE', 1)),
+    on_write=media_store.record_write
+)
+
+# Backends de chat con interfaz de streaming común. LLM_BACKEND=fake sustituye todos
+# por el backend local determinista (pruebas de carga sin API keys)
+LLM_BACKEND = os.getenv('LLM_BACKEND') or None
+llm_backends = BackendRegistry(
+    override=LLM_BACKEND,
+    factories={
+        'fake': lambda history_key: FakeBackend(
+            history_key=history_key,
+            chunks=int(os.getenv('FAKE_BACKEND_CHUNKS', 60)),
+            first_chunk_ms=int(os.getenv('FAKE_BACKEND_FIRST_CHUNK_MS', 150)),
+            chunk_interval_ms=int(os.getenv('FAKE_BACKEND_CHUNK_INTERVAL_MS', 10))
+        )
+    }
+)
+llm_backends.register('gemini', GeminiBackend(
+    get_model=lambda: providers.get('gemini'),
+    upstream=upstream,
+    read_attachment=attachment_store.read_bytes,
+    # Reducir/recomprimir los adjuntos (caché por hash, en un pool de hilos nativos)
+    prepare_image=image_preprocessor.prepare,
+    executor=upstream_executor
+))
+llm_backends.register('groq', GroqBackend(upstream))
+
+def embed_prompt(text):
+    """Embedding de un prompt con Gemini para las coincidencias aproximadas de la caché"""
+    with upstream.limiter('gemini'):
+        result = upstream_executor.call(
+            genai.embed_content,
+            model=RESPONSE_CACHE_EMBEDDING_MODEL,
+            content=text,
+            request_options=upstream.gemini_request_options()
+        )
+    return result['embedding']
+
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl_seconds=RESPONSE_CACHE_TTL,
+    embed=embed_prompt if RESPONSE_CACHE_EMBEDDING_MODEL else None,
+    similarity=RESPONSE_CACHE_SIMILARITY
+) if RESPONSE_CACHE_ENABLED else None
+
+def lookup_cached_response(namespace, prompt, use_cache=True):
+    """
+    Busca una respuesta en la caché.
+
+    Args:
+        namespace: Espacio de la caché ('chat:<modelo>', 'web_search')
+        prompt: Texto del usuario, sin la plantilla del prompt
+        use_cache: False cuando el cliente pide omitir la caché
+
+    Returns:
+        CacheLookup (con response a None si hay que generar la respuesta) o None si la
+        caché está desactivada
+    """
+    if response_cache is None:
+        return None
+    with instrumentation.span('response_cache_lookup'):
+        return response_cache.lookup(namespace, prompt, read=use_cache)
+
+def is_first_user_turn(conversation_id):
+    """
+    Si la conversación solo tiene guardado el mensaje actual del usuario.
+
+    Se cuenta en la base de datos y no en el historial cargado, que está recortado al
+    presupuesto del modelo: una conversación larga podría parecer recién empezada.
+    """
+    rows = db.session.query(Message.id).filter(Message.conversation_id == conversation_id).limit(2).all()
+    return len(rows) <= 1
+
+def wants_cache_bypass(flag):
+    # Omitir la caché con el campo no_cache=true o con 'Cache-Control: no-cache'
+    return str(flag).lower() == 'true' or 'no-cache' in request.headers.get('Cache-Control', '')
+
 # --- Mover la inicialización de Flask aquí ---
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -227,11 +486,34 @@ database_url = os.getenv('DATABASE_URL')
 if database_url and database_url.startswith('postgres://'):
     # Asegurarse de que la URL de Heroku/Render sea compatible con SQLAlchemy 1.4+
     database_url = database_url.replace('postgres://', 'postgresql://', 1)
-    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
-    logger.info("Usando base de datos PostgreSQL de Render")
+    configure_postgres(
+        app,
+        database_url,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pre_ping=DB_POOL_PRE_PING,
+        monitor=db_pool_monitors['default']
+    )
+    logger.info(f"Usando base de datos PostgreSQL de Render (pool {DB_POOL_SIZE}+{DB_MAX_OVERFLOW}, timeout {DB_POOL_TIMEOUT}s)")
 else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(instance_path, "db.sqlite")}'
-    logger.info("DATABASE_URL no encontrada o no es PostgreSQL, usando SQLite local")
+    # SQLite: la de DATABASE_URL (p. ej. la base de datos temporal de benchmarks/load_chat.py) o instance/db.sqlite
+    if database_url and database_url.startswith('sqlite:'):
+        sqlite_uri = database_url
+    else:
+        sqlite_uri = f'sqlite:///{os.path.join(instance_path, "db.sqlite")}'
+        logger.info("DATABASE_URL no encontrada o no es PostgreSQL, usando SQLite local")
+    # 'tuned': WAL + pragmas, una conexión de escritura y un pool de lectura; 'default': motor sin ajustes
+    configure_sqlite(
+        app,
+        sqlite_uri,
+        profile=SQLITE_PROFILE,
+        readers=SQLITE_READERS,
+        busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+        monitors=db_pool_monitors
+    )
+    logger.info(f"Usando base de datos SQLite {sqlite_uri} (perfil {SQLITE_PROFILE})")
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
@@ -244,6 +526,12 @@ app.config['REMEMBER_COOKIE_HTTPONLY'] = True
 
 # Inicializar extensiones
 db.init_app(app)
+if app.config.get('SQLITE_PROFILE') == 'tuned':
+    install_sqlite_pragmas(app, db, sqlite_pragmas(
+        busy_timeout_ms=SQLITE_BUSY_TIMEOUT_MS,
+        mmap_size=int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        cache_size_kb=int(os.getenv('SQLITE_CACHE_SIZE_KB', 20000))
+    ))
 
 # Importar configuración optimizada de SocketIO
 from socketio_config import socketio_config
@@ -251,14 +539,73 @@ from socketio_config import socketio_config
 # Configuración optimizada de SocketIO para reducir uso de memoria
 socketio = SocketIO(app, **socketio_config)
 
+# Planificador de tareas de generación: límite de tareas simultáneas por modelo y cola acotada
+job_scheduler = JobScheduler(
+    spawn=socketio.start_background_task,
+    limits={
+        'gemini': int(os.getenv('JOB_LIMIT_GEMINI', 4)),
+        'groq': int(os.getenv('JOB_LIMIT_GROQ', 4)),
+        'kkty2-video': int(os.getenv('JOB_LIMIT_VIDEO', 1)),
+    },
+    default_limit=int(os.getenv('JOB_LIMIT_DEFAULT', 2)),
+    max_queue=int(os.getenv('JOB_QUEUE_SIZE', 20))
+)
+
+# Escritura diferida de mensajes: inserciones agrupadas en una transacción por lote
+message_persister = MessagePersister(
+    app,
+    lambda: get_write_engine(db),
+    Message.__table__,
+    spawn=socketio.start_background_task,
+    sleep=socketio.sleep,
+    flush_interval_ms=int(os.getenv('MESSAGE_FLUSH_INTERVAL_MS', 100)),
+    max_batch=int(os.getenv('MESSAGE_FLUSH_BATCH', 200))
+)
+
+# Búsqueda de texto completo: FTS5 en SQLite, índices GIN en PostgreSQL
+message_search = MessageSearch(lambda: db.engine, lambda: get_write_engine(db), language=SEARCH_LANGUAGE)
+
+def prepare_database():
+    """
+    Crea las tablas y los índices que falten (idempotente).
+
+    create_all() no modifica tablas que ya existen: ensure_columns() añade las columnas
+    nuevas (reservas de VideoJob), ensure_indexes() crea los índices declarados en los
+    modelos (historial, barra lateral) en bases de datos antiguas, y
+    message_search.ensure_schema() el índice de búsqueda. Se ejecuta al arrancar, no en
+    las peticiones: construir un índice sobre una tabla grande puede tardar más que el
+    timeout de un worker.
+    """
+    started = time.perf_counter()
+    with app.app_context():
+        db.create_all()
+        ensure_columns(db.engine)
+        ensure_indexes(db.engine)
+        message_search.ensure_schema()
+        # Sin conexiones abiertas en el maestro de gunicorn: cada worker abre las suyas
+        for engine in db.engines.values():
+            engine.dispose()
+    logger.info(f"Esquema de la base de datos preparado en {(time.perf_counter() - started) * 1000:.0f}ms")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crea las tablas, los índices y el índice de búsqueda que falten"""
+    prepare_database()
+
+# Tiempo que el bucle de gevent pasa bloqueado (llamadas que no ceden el control)
+loop_lag_monitor = LoopLagMonitor(
+    spawn=socketio.start_background_task,
+    sleep=socketio.sleep,
+    threshold_ms=LOOP_LAG_THRESHOLD_MS,
+    interval_ms=LOOP_LAG_INTERVAL_MS,
+    observe=lambda seconds: instrumentation.observe('loop_lag', seconds)
+) if LOOP_LAG_THRESHOLD_MS > 0 else None
+
 # Configurar monitoreo de memoria para SocketIO
 if os.environ.get('RENDER', False):
     from socketio_config import monitor_socketio_memory
     monitor_socketio_memory(socketio, interval=300)
 
-# Inicializar OAuth con la app Flask
-oauth.init_app(app)
-
 # Configurar Login Manager
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
@@ -282,6 +629,13 @@ chat_sessions = {}
 def before_request():
     session.permanent = True
     app.permanent_session_lifetime = timedelta(days=31)
+    # Pools de conexiones propios de este worker (no-op si ya se crearon)
+    recreate_pools_after_fork(app, db)
+    # Seguimiento de videos pendientes (con gunicorn ya lo inicia post_worker_init; no-op si está activo)
+    video_job_tracker.start()
+    message_persister.start()
+    if loop_lag_monitor:
+        loop_lag_monitor.start()
 
 @app.route('/')
 @login_required
@@ -305,6 +659,7 @@ def handle_disconnect():
     if current_user.is_authenticated:
         logger.info(f"Usuario {current_user.username} desconectado")
 
+@instrumentation.timed('image_edit')
 def generate_image_edit_from_upload(input_image, prompt):
     """
     Edita una imagen usando Gemini 2.0 Flash
@@ -337,8 +692,8 @@ def generate_image_edit_from_upload(input_image, prompt):
         if not processed_image:
             return "Error: No se pudo procesar la imagen para edición."
         
-        # Usar instancia global de edición (image_gen_model)
-        global image_gen_model # Necesario para acceder al modelo global
+        # Usar la instancia compartida de edición (se construye en su primer uso)
+        image_gen_model = providers.get('gemini_image')
         if image_gen_model is None:
             logger.error("El modelo global de generación/edición de imágenes (image_gen_model) no está inicializado.")
             return "Error: El servicio de edición de imágenes no está disponible actualmente."
@@ -368,10 +723,13 @@ def generate_image_edit_from_upload(input_image, prompt):
             }}
         ]
 
-        response = image_gen_model.generate_content( # Usa el modelo global directamente
-            content
-            # generation_config y safety_settings ya están en el image_gen_model global
-        )
+        with upstream.limiter('gemini'):
+            response = upstream_executor.call(
+                image_gen_model.generate_content, # Usa el modelo global directamente
+                content,
+                # generation_config y safety_settings ya están en el image_gen_model global
+                request_options=upstream.gemini_request_options()
+            )
         
         # Procesar la respuesta
         if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
@@ -383,29 +741,7 @@ def generate_image_edit_from_upload(input_image, prompt):
                         image_data = inline_data.data
                         image_mime = inline_data.mime_type
                         
-                        # Crear un nombre de archivo único
-                        timestamp = int(time.time())
-                        file_extension = mimetypes.guess_extension(image_mime) or '.png'
-                        filename = f"edited_image_{timestamp}{file_extension}"
-                        filepath = os.path.join(UPLOAD_FOLDER, filename)
-                        
-                        # Guardar la imagen - decodificar base64 si es necesario
-                        if isinstance(image_data, str):
-                            if image_data.startswith('data:'):
-                                # Es una cadena base64 con prefijo
-                                header, encoded = image_data.split(",", 1)
-                                image_data = base64.b64decode(encoded)
-                            else:
-                                # Es una cadena base64 sin prefijo
-                                image_data = base64.b64decode(image_data)
-                        
-                        # Guardar la imagen
-                        with open(filepath, "wb") as f:
-                            f.write(image_data)
-                        
-                        # Crear URL para la imagen
-                        image_url = f"/uploads/{filename}"
-                        logger.info(f"Imagen editada guardada en: {filepath}")
+                        image_url = store_generated_image(image_data, image_mime, 'edited_image')
                         return f"\n[GENERATED_IMAGE:{image_url}]"
                     except Exception as img_save_error:
                         logger.error(f"Error al guardar la imagen editada: {str(img_save_error)}")
@@ -416,21 +752,34 @@ def generate_image_edit_from_upload(input_image, prompt):
         logger.error(f"Error en generate_image_edit_from_upload: {str(e)}")
         return f"Error al editar la imagen: {str(e)}"
 
-def save_binary_file(file_path, data):
+def store_generated_image(image_data, image_mime, prefix, prompt=None, model_name=None):
     """
-    Guarda datos binarios en un archivo
+    Guarda una imagen devuelta por el modelo en el almacén de media
     
     Args:
-        file_path: Ruta del archivo donde guardar los datos
-        data: Datos binarios a guardar
+        image_data: Bytes de la imagen o cadena base64 (con o sin prefijo data:)
+        image_mime: Tipo MIME de la imagen
+        prefix: Prefijo del nombre ('generated_image', 'edited_image')
+        prompt: Prompt de la generación, para poder reutilizarla (opcional)
+        model_name: Modelo que la generó (junto con prompt)
+    
+    Returns:
+        URL pública de la imagen
     """
-    try:
-        with open(file_path, "wb") as f:
-            f.write(data)
-        logger.info(f"Archivo guardado en: {file_path}")
-    except Exception as e:
-        logger.error(f"Error al guardar el archivo {file_path}: {e}")
-        raise
+    if isinstance(image_data, str):
+        if image_data.startswith('data:'):
+            # Es una cadena base64 con prefijo
+            header, encoded = image_data.split(",", 1)
+            image_data = base64.b64decode(encoded)
+        else:
+            # Es una cadena base64 sin prefijo
+            image_data = base64.b64decode(image_data)
+    extension = mimetypes.guess_extension(image_mime or '') or '.png'
+    filename = media_store.save(image_data, extension, prefix=prefix)
+    image_variants.schedule(filename)
+    if prompt:
+        media_store.remember(prompt, model_name, [filename])
+    return media_store.url_for(filename)
 
 def with_retries(max_retries=3, delay=1):
     """
@@ -441,6 +790,7 @@ def with_retries(max_retries=3, delay=1):
         delay: Tiempo de espera entre reintentos en segundos
     """
     def decorator(func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
             retries = 0
             while retries < max_retries:
@@ -452,198 +802,188 @@ def with_retries(max_retries=3, delay=1):
                         logger.error(f"Error después de {max_retries} intentos: {str(e)}")
                         raise
                     logger.warning(f"Intento {retries} fallido: {str(e)}. Reintentando en {delay} segundos...")
-                    time.sleep(delay)
+                    # Espera cooperativa: no bloquea el resto de greenlets del worker
+                    socketio.sleep(delay)
         return wrapper
     return decorator
 
+@instrumentation.timed('video_start')
 @with_retries()
-def generate_video_from_text(prompt_text,
-                             duration_seconds: int = 5,
-                             number_of_videos: int = 1,
-                             aspect_ratio: str = "16:9"):
+def start_video_generation(prompt_text,
+                           duration_seconds: int = 5,
+                           number_of_videos: int = 1,
+                           aspect_ratio: str = "16:9"):
     """
-    Genera videos a partir de un prompt de texto usando Google Veo 2.
+    Inicia una operación de generación de video con Google Veo 2 sin esperar a que termine.
+
+    El seguimiento de la operación lo hace VideoJobTracker (ver video_jobs.py), que guarda
+    el nombre de la operación en la base de datos y la consulta periódicamente.
 
     Args:
         prompt_text (str): El texto que describe el video a generar.
         duration_seconds (int): Duración del video en segundos (5-8).
         number_of_videos (int): Número de videos a generar (1-4).
+        aspect_ratio (str): Relación de aspecto ("16:9" o "9:16").
 
     Returns:
-        list: Lista de URLs de los videos generados o lista vacía en caso de error.
+        La operación de larga duración devuelta por la API.
     """
+    genai_client = providers.get('veo')
     if not genai_client:
-        logger.error("Video generation client not available (genai.Client is not initialized).")
-        return []
+        raise Exception("Video generation client is not configured (genai.Client is not initialized).")
 
-    try:
-        logger.info(f"Generando video desde texto: '{prompt_text}', Duración: {duration_seconds}s, Cantidad: {number_of_videos}, Aspect Ratio: {aspect_ratio}")
-
-        # Validar parámetros
-        duration_seconds = max(5, min(int(duration_seconds), 8))
-        number_of_videos = max(1, min(int(number_of_videos), 4))
-
-        # Configuración específica para Veo 2
-        video_config = genai_types.GenerateVideosConfig(
-            person_generation="dont_allow", # O "allow_adult"
-            aspect_ratio=aspect_ratio, # Leído de los parámetros
-            duration_seconds=duration_seconds,
-            number_of_videos=number_of_videos
-        )
+    logger.info(f"Generando video desde texto: '{prompt_text}', Duración: {duration_seconds}s, Cantidad: {number_of_videos}, Aspect Ratio: {aspect_ratio}")
 
-        # Iniciar la operación de generación de video
-        operation = genai_client.models.generate_videos(
-            model="veo-2.0-generate-001", # Asegúrate de que este sea el nombre correcto del modelo Veo 2
-            prompt=prompt_text,
-            config=video_config,
-        )
+    # Validar parámetros
+    duration_seconds = max(5, min(int(duration_seconds), 8))
+    number_of_videos = max(1, min(int(number_of_videos), 4))
+
+    # Configuración específica para Veo 2
+    video_config = genai.types.GenerateVideosConfig(
+        person_generation="dont_allow", # O "allow_adult"
+        aspect_ratio=aspect_ratio, # Leído de los parámetros
+        duration_seconds=duration_seconds,
+        number_of_videos=number_of_videos
+    )
 
-        logger.info(f"Operación de generación de video iniciada: {operation.name}")
+    # Iniciar la operación de generación de video
+    operation = genai_client.models.generate_videos(
+        model="veo-2.0-generate-001", # Asegúrate de que este sea el nombre correcto del modelo Veo 2
+        prompt=prompt_text,
+        config=video_config,
+    )
 
-        # Esperar a que la operación se complete (con timeouts y logging)
-        timeout_seconds = 300  # 5 minutos de timeout total
-        poll_interval_seconds = 20
-        start_time = time.time()
+    logger.info(f"Operación de generación de video iniciada: {operation.name}")
+    return operation
 
-        while not operation.done:
-            current_time = time.time()
-            if current_time - start_time > timeout_seconds:
-                logger.error(f"Timeout esperando la generación del video (Operación: {operation.name})")
-                return []
+def get_video_operation(operation_name):
+    """Obtiene el estado actual de una operación de video a partir de su nombre"""
+    genai_client = providers.get('veo')
+    if not genai_client:
+        raise Exception("Video generation client is not configured (genai.Client is not initialized).")
+    return genai_client.operations.get(name=operation_name)
 
-            logger.debug(f"Esperando {poll_interval_seconds}s para la operación {operation.name}. Estado actual: {operation.metadata.state if operation.metadata else 'Unknown'}")
-            time.sleep(poll_interval_seconds)
-            try:
-                # Re-fetch the operation object to get the latest status.
-                operation = genai_client.operations.get(name=operation.name) # Use operation.name
-                logger.debug(f"Estado de la operación {operation.name}: {'Done' if operation.done else 'Running'}. Progreso: {operation.metadata.progress_percent if operation.metadata and hasattr(operation.metadata, 'progress_percent') else 'N/A'}")
-            except Exception as poll_error:
-                logger.error(f"Error al obtener el estado de la operación {operation.name}: {poll_error}")
-                # Consider if this should be a critical failure or allow retries
-                time.sleep(poll_interval_seconds) # Wait before retrying poll
+@instrumentation.timed('video_save')
+def save_generated_videos(operation):
+    """
+    Guarda en UPLOAD_FOLDER los videos de una operación de Veo 2 ya finalizada.
 
-        # Procesar la respuesta
-        video_urls = []
-        if operation.done and operation.response:
-            if hasattr(operation.response, 'generated_videos') and operation.response.generated_videos:
-                for n, generated_video_container in enumerate(operation.response.generated_videos):
-                    try:
-                        # The actual video data might be nested, e.g. generated_video_container.video
-                        # Check the exact structure from SDK documentation or by inspecting the object.
-                        # Assuming 'generated_video_container' itself has 'video' attribute which then has 'uri' or 'data'
-                        
-                        # Let's assume 'generated_video_container' is the direct video object based on previous logic
-                        # and it might have a 'uri' or 'data' attribute, or a 'file_resource' which has 'uri'.
-                        # The existing code uses generated_video.video.save() or generated_video.video.name
-                        
-                        video_resource = None
-                        if hasattr(generated_video_container, 'video'): # Common pattern: container has a 'video' attribute
-                            video_resource = generated_video_container.video
-                        elif hasattr(generated_video_container, 'file_resource'): # Another possible pattern
-                             video_resource = generated_video_container.file_resource
-                        else:
-                            logger.warning(f"Video container {n} does not have a directly accessible 'video' or 'file_resource' attribute. Inspect object: {generated_video_container}")
-                            # Try to access attributes that might hold the video data or reference
-                            # This part might need adjustment based on actual SDK response object structure
-                            if hasattr(generated_video_container, 'data'): # Example if data is directly on container
-                                video_resource = generated_video_container 
-                            # Add more checks if necessary based on SDK
-
-                        if not video_resource:
-                            logger.error(f"No video resource found in generated_video_container {n}")
-                            continue
+    Args:
+        operation: Operación finalizada (operation.done == True)
 
-                        timestamp = int(time.time())
-                        filename = f"generated_video_{timestamp}_{n}.mp4"
-                        filepath = os.path.join(UPLOAD_FOLDER, filename)
-
-                        logger.info(f"Procesando video {n+1}/{len(operation.response.generated_videos)}...")
-
-                        # Attempt to save or download the video
-                        if hasattr(video_resource, 'save') and callable(video_resource.save):
-                            logger.info(f"Intentando guardar video usando .save() para {filename}")
-                            video_resource.save(filepath)
-                            logger.info(f"Video guardado en: {filepath} usando .save()")
-                        elif hasattr(video_resource, 'uri'): # If there's a URI, try to download
-                            logger.info(f"Intentando descargar video desde URI: {video_resource.uri} para {filename}")
-                            # The SDK might provide a direct download method or require using genai_client.files.download
-                            # Assuming genai_client.files.get(name=uri).download() if uri is a resource name
-                            # This part is speculative and needs to match the SDK's way of handling URIs.
-                            # The previous code used genai_client.files.get(name=video_resource.name)
-                            # then genai_client.files.download(name=file_info.name)
-                            # This implies video_resource should have a 'name' attribute if 'save' is not present.
-                            if hasattr(video_resource, 'name'):
-                                file_info = genai_client.files.get(name=video_resource.name)
-                                if file_info and hasattr(file_info, 'uri') and not filepath.startswith("gs://"): # Check if it's a GCS URI
-                                     # If file_info.uri is a GCS URI, direct download might not be the way
-                                     logger.info(f"Video resource name: {video_resource.name}, URI: {file_info.uri}")
-                                     # The download method should handle fetching the bytes
-                                     downloaded_content = genai_client.files.download(name=video_resource.name)
-                                     with open(filepath, 'wb') as f:
-                                         f.write(downloaded_content)
-                                     logger.info(f"Video descargado y guardado en: {filepath}")
-                                elif filepath.startswith("gs://"):
-                                    logger.warning(f"Video URI es una ruta GCS: {file_info.uri}. Se requiere un manejo especial o acceso directo.")
-                                    # For GCS URIs, the client might not be able to directly download.
-                                    # The application would need GCS access configured or the URI itself might be the deliverable.
-                                    # For this example, we'll assume direct download is possible or URI is the link.
-                                    # If the URI is the public URL, we can just use it.
-                                    # This part needs clarification on how GCS URIs are handled by the SDK for end-user access.
-                                    # Adding the GCS URI directly if it's a valid URL.
-                                    if file_info.uri.startswith("https://"): # Simplistic check
-                                        video_urls.append(file_info.uri)
-                                        logger.info(f"Usando GCS URI directamente: {file_info.uri}")
-                                        continue # Skip local saving if GCS URI is used directly
-                                else:
-                                     logger.error(f"No se pudo determinar cómo descargar el video para {filename} desde el recurso: {video_resource}")
-                                     continue
+    Returns:
+        list: Lista de URLs de los videos guardados (vacía si no se pudo guardar ninguno)
+    """
+    genai_client = providers.get('veo')
+    video_urls = []
+    if operation.done and operation.response:
+        if hasattr(operation.response, 'generated_videos') and operation.response.generated_videos:
+            for n, generated_video_container in enumerate(operation.response.generated_videos):
+                try:
+                    # The actual video data might be nested, e.g. generated_video_container.video
+                    # Check the exact structure from SDK documentation or by inspecting the object.
+                    # Assuming 'generated_video_container' itself has 'video' attribute which then has 'uri' or 'data'
+
+                    # Let's assume 'generated_video_container' is the direct video object based on previous logic
+                    # and it might have a 'uri' or 'data' attribute, or a 'file_resource' which has 'uri'.
+                    # The existing code uses generated_video.video.save() or generated_video.video.name
+
+                    video_resource = None
+                    if hasattr(generated_video_container, 'video'): # Common pattern: container has a 'video' attribute
+                        video_resource = generated_video_container.video
+                    elif hasattr(generated_video_container, 'file_resource'): # Another possible pattern
+                         video_resource = generated_video_container.file_resource
+                    else:
+                        logger.warning(f"Video container {n} does not have a directly accessible 'video' or 'file_resource' attribute. Inspect object: {generated_video_container}")
+                        # Try to access attributes that might hold the video data or reference
+                        # This part might need adjustment based on actual SDK response object structure
+                        if hasattr(generated_video_container, 'data'): # Example if data is directly on container
+                            video_resource = generated_video_container 
+                        # Add more checks if necessary based on SDK
+
+                    if not video_resource:
+                        logger.error(f"No video resource found in generated_video_container {n}")
+                        continue
+
+                    logger.info(f"Procesando video {n+1}/{len(operation.response.generated_videos)}...")
+
+                    # Attempt to save or download the video
+                    if hasattr(video_resource, 'save') and callable(video_resource.save):
+                        logger.info(f"Intentando guardar video {n} usando .save()")
+                        # Nombre por hash del contenido (calculado tras escribir el fichero)
+                        filename = media_store.save_with(video_resource.save, '.mp4', prefix='generated_video')
+                        logger.info(f"Video guardado como {filename} usando .save()")
+                    elif hasattr(video_resource, 'uri'): # If there's a URI, try to download
+                        logger.info(f"Intentando descargar video {n} desde URI: {video_resource.uri}")
+                        # The SDK might provide a direct download method or require using genai_client.files.download
+                        # Assuming genai_client.files.get(name=uri).download() if uri is a resource name
+                        # This part is speculative and needs to match the SDK's way of handling URIs.
+                        # The previous code used genai_client.files.get(name=video_resource.name)
+                        # then genai_client.files.download(name=file_info.name)
+                        # This implies video_resource should have a 'name' attribute if 'save' is not present.
+                        if hasattr(video_resource, 'name'):
+                            file_info = genai_client.files.get(name=video_resource.name)
+                            if file_info and hasattr(file_info, 'uri') and not file_info.uri.startswith("gs://"): # Check if it's a GCS URI
+                                 # If file_info.uri is a GCS URI, direct download might not be the way
+                                 logger.info(f"Video resource name: {video_resource.name}, URI: {file_info.uri}")
+                                 # The download method should handle fetching the bytes
+                                 downloaded_content = genai_client.files.download(name=video_resource.name)
+                                 filename = media_store.save(downloaded_content, '.mp4', prefix='generated_video')
+                                 logger.info(f"Video descargado y guardado como {filename}")
+                            elif file_info and file_info.uri.startswith("gs://"):
+                                logger.warning(f"Video URI es una ruta GCS: {file_info.uri}. Se requiere un manejo especial o acceso directo.")
+                                # For GCS URIs, the client might not be able to directly download.
+                                # The application would need GCS access configured or the URI itself might be the deliverable.
+                                # For this example, we'll assume direct download is possible or URI is the link.
+                                # If the URI is the public URL, we can just use it.
+                                # This part needs clarification on how GCS URIs are handled by the SDK for end-user access.
+                                # Adding the GCS URI directly if it's a valid URL.
+                                if file_info.uri.startswith("https://"): # Simplistic check
+                                    video_urls.append(file_info.uri)
+                                    logger.info(f"Usando GCS URI directamente: {file_info.uri}")
+                                    continue # Skip local saving if GCS URI is used directly
                             else:
-                                logger.error(f"Video resource para {filename} no tiene método 'save' ni atributo 'name' para descarga.")
-                                continue
+                                 logger.error(f"No se pudo determinar cómo descargar el video {n} desde el recurso: {video_resource}")
+                                 continue
                         else:
-                            logger.error(f"No se pudo guardar o descargar el video {n}. El objeto video_resource no tiene 'save' ni 'uri'/'name'. Atributos: {dir(video_resource)}")
+                            logger.error(f"Video resource {n} no tiene método 'save' ni atributo 'name' para descarga.")
                             continue
-                        
-                        video_url = f"/uploads/{filename}"
-                        video_urls.append(video_url)
+                    else:
+                        logger.error(f"No se pudo guardar o descargar el video {n}. El objeto video_resource no tiene 'save' ni 'uri'/'name'. Atributos: {dir(video_resource)}")
+                        continue
 
-                    except Exception as video_save_error:
-                        logger.error(f"Error al procesar o guardar el video {n}: {str(video_save_error)}", exc_info=True)
-                
-                if video_urls:
-                    logger.info(f"Se procesaron y guardaron {len(video_urls)} videos.")
-                else:
-                    logger.warning(f"La operación {operation.name} finalizó, se encontraron videos generados, pero ninguno pudo ser procesado/guardado.")
+                    video_urls.append(media_store.url_for(filename))
+
+                except Exception as video_save_error:
+                    logger.error(f"Error al procesar o guardar el video {n}: {str(video_save_error)}", exc_info=True)
+
+            if video_urls:
+                logger.info(f"Se procesaron y guardaron {len(video_urls)} videos.")
             else:
-                # Log details if response structure is unexpected
-                logger.warning(f"La operación {operation.name} finalizó pero no se encontraron 'generated_videos' en la respuesta o la respuesta está vacía.")
-                if operation.error:
-                    logger.error(f"La operación de generación de video falló con error: {operation.error.message} (Código: {operation.error.code})")
+                logger.warning(f"La operación {operation.name} finalizó, se encontraron videos generados, pero ninguno pudo ser procesado/guardado.")
         else:
-            # Handle cases where operation didn't complete successfully or response is missing
+            # Log details if response structure is unexpected
+            logger.warning(f"La operación {operation.name} finalizó pero no se encontraron 'generated_videos' en la respuesta o la respuesta está vacía.")
             if operation.error:
                 logger.error(f"La operación de generación de video falló con error: {operation.error.message} (Código: {operation.error.code})")
-            else:
-                logger.warning(f"La operación {operation.name} no finalizó correctamente o no tuvo respuesta. Estado: {'Done' if operation.done else 'Running'}")
-
+    else:
+        # Handle cases where operation didn't complete successfully or response is missing
+        if operation.error:
+            logger.error(f"La operación de generación de video falló con error: {operation.error.message} (Código: {operation.error.code})")
+        else:
+            logger.warning(f"La operación {operation.name} no finalizó correctamente o no tuvo respuesta. Estado: {'Done' if operation.done else 'Running'}")
 
-        return video_urls
-
-    except genai_types.generation_types.BlockedPromptException as bpe:
-        logger.error(f"Generación de video bloqueada debido al prompt: {bpe}")
-        raise  # Re-raise to be caught by the caller task
-    except Exception as e:
-        logger.error(f"Error en generate_video_from_text: {str(e)}", exc_info=True)
-        # Consider re-raising or returning a specific error object/message
-        return [] # Return empty list on other errors
+    return video_urls
 
+@instrumentation.timed('image_generation')
 @with_retries()
-def generate_image_from_text(prompt_text):
+def generate_image_from_text(prompt_text, reuse=False):
     """
     Genera una imagen a partir de un prompt de texto usando Gemini Flash.
 
     Args:
         prompt_text (str): El texto que describe la imagen a generar.
+        reuse (bool): Devolver la imagen de una generación reciente con el mismo prompt y modelo si existe.
 
     Returns:
         str: URL de la imagen generada o un mensaje de error.
@@ -653,7 +993,7 @@ def generate_image_from_text(prompt_text):
         
         # Usar el modelo global image_gen_model si está disponible y configurado correctamente.
         # Esto asegura consistencia en el nombre del modelo y sus configuraciones.
-        global image_gen_model # Necesario para acceder al modelo global
+        image_gen_model = providers.get('gemini_image')
         if image_gen_model is None:
             logger.error("El modelo global de generación de imágenes (image_gen_model) no está inicializado.")
             return "Error: El servicio de generación de imágenes no está disponible actualmente."
@@ -664,18 +1004,21 @@ def generate_image_from_text(prompt_text):
         
         logger.info(f"Usando el modelo global de generación de imágenes: {image_gen_model.model_name}")
 
-        # Asegurarse de que el directorio de imágenes generadas exista
-        generated_images_dir = os.path.join(UPLOAD_FOLDER)
-        if not os.path.exists(generated_images_dir):
-            os.makedirs(generated_images_dir)
-            logger.info(f"Directorio creado: {generated_images_dir}")
+        if reuse:
+            reused = media_store.lookup(prompt_text, image_gen_model.model_name)
+            if reused:
+                logger.info(f"Reutilizando imagen generada para el mismo prompt: {reused[0]}")
+                return f"\n[GENERATED_IMAGE:{media_store.url_for(reused[0])}]"
         
         # Realizar la llamada al modelo para generación de imágenes usando el modelo global
-        response = image_gen_model.generate_content(
-            prompt_text,
-            # generation_config y safety_settings ya están en el image_gen_model global
-            stream=False
-        )
+        with upstream.limiter('gemini'):
+            response = upstream_executor.call(
+                image_gen_model.generate_content,
+                prompt_text,
+                # generation_config y safety_settings ya están en el image_gen_model global
+                stream=False,
+                request_options=upstream.gemini_request_options()
+            )
         
         # Procesar la respuesta con logging mejorado
         if hasattr(response, 'candidates') and response.candidates:
@@ -689,28 +1032,9 @@ def generate_image_from_text(prompt_text):
                                 image_data = inline_data.data
                                 image_mime = inline_data.mime_type
                                 
-                                # Crear un nombre de archivo único
-                                timestamp = int(time.time())
-                                file_extension = mimetypes.guess_extension(image_mime) or '.png'
-                                filename = f"generated_image_{timestamp}{file_extension}"
-                                filepath = os.path.join(generated_images_dir, filename)
-                                
-                                # Guardar la imagen - decodificar base64 si es necesario
-                                if isinstance(image_data, str):
-                                    if image_data.startswith('data:'):
-                                        # Es una cadena base64 con prefijo
-                                        header, encoded = image_data.split(",", 1)
-                                        image_data = base64.b64decode(encoded)
-                                    else:
-                                        # Es una cadena base64 sin prefijo
-                                        image_data = base64.b64decode(image_data)
-                                
-                                # Guardar la imagen usando la función auxiliar
-                                save_binary_file(filepath, image_data)
-                                
-                                # Crear URL para la imagen
-                                image_url = f"/uploads/{filename}"
-                                logger.info(f"Imagen generada guardada en: {filepath}")
+                                # Nombre por hash del contenido: dos generaciones nunca se pisan
+                                image_url = store_generated_image(image_data, image_mime, 'generated_image',
+                                                                  prompt=prompt_text, model_name=image_gen_model.model_name)
                                 return f"\n[GENERATED_IMAGE:{image_url}]"
                             except Exception as img_save_error:
                                 logger.error(f"Error al guardar la imagen generada: {str(img_save_error)}")
@@ -749,28 +1073,9 @@ def generate_image_from_text(prompt_text):
                         image_data = inline_data.data
                         image_mime = inline_data.mime_type
                         
-                        # Crear un nombre de archivo único
-                        timestamp = int(time.time())
-                        file_extension = mimetypes.guess_extension(image_mime) or '.png'
-                        filename = f"generated_image_{timestamp}{file_extension}"
-                        filepath = os.path.join(generated_images_dir, filename)
-                        
-                        # Guardar la imagen - decodificar base64 si es necesario
-                        if isinstance(image_data, str):
-                            if image_data.startswith('data:'):
-                                # Es una cadena base64 con prefijo
-                                header, encoded = image_data.split(",", 1)
-                                image_data = base64.b64decode(encoded)
-                            else:
-                                # Es una cadena base64 sin prefijo
-                                image_data = base64.b64decode(image_data)
-                        
-                        # Guardar la imagen usando la función auxiliar
-                        save_binary_file(filepath, image_data)
-                        
-                        # Crear URL para la imagen
-                        image_url = f"/uploads/{filename}"
-                        logger.info(f"Imagen generada guardada en: {filepath}")
+                        # Nombre por hash del contenido: dos generaciones nunca se pisan
+                        image_url = store_generated_image(image_data, image_mime, 'generated_image',
+                                                          prompt=prompt_text, model_name=image_gen_model.model_name)
                         return f"\n[GENERATED_IMAGE:{image_url}]"
                     except Exception as img_save_error:
                         logger.error(f"Error al guardar la imagen generada: {str(img_save_error)}")
@@ -791,17 +1096,8 @@ def generate_image_from_text(prompt_text):
                 image_data = response.image
                 image_mime = "image/png"  # Asumimos PNG por defecto
                 
-                # Crear un nombre de archivo único
-                timestamp = int(time.time())
-                filename = f"generated_image_{timestamp}.png"
-                filepath = os.path.join(generated_images_dir, filename)
-                
-                # Guardar la imagen usando la función auxiliar
-                save_binary_file(filepath, image_data)
-                
-                # Crear URL para la imagen
-                image_url = f"/uploads/{filename}"
-                logger.info(f"Imagen generada guardada en: {filepath}")
+                image_url = store_generated_image(image_data, image_mime, 'generated_image',
+                                                  prompt=prompt_text, model_name=image_gen_model.model_name)
                 return f"\n[GENERATED_IMAGE:{image_url}]"
         except Exception as e:
             logger.error(f"Error al procesar la imagen de la respuesta: {str(e)}")
@@ -838,135 +1134,20 @@ def generate_image_from_text(prompt_text):
         logger.error(f"Error en generate_image_from_text: {str(e)}", exc_info=True)
         return f"Error al generar la imagen: {str(e)}"
 
-def get_gemini_response(conversation_history, user_message, images=None):
-    """
-    Genera una respuesta utilizando el modelo Gemini basada en el historial de conversación,
-    el mensaje del usuario y opcionalmente imágenes.
-    
-    Args:
-        conversation_history: Lista de objetos Message con el historial de la conversación
-        user_message: Mensaje de texto del usuario
-        images: Lista de imágenes procesadas para visión (opcional)
-    
-    Returns:
-        str: Respuesta generada por el modelo
-    """
-    try:
-        logger.info(f"Generando respuesta con Gemini. Mensaje: {user_message[:50]}{'...' if len(user_message) > 50 else ''}")
-        logger.info(f"Imágenes adjuntas: {len(images) if images else 0}")
-        
-        # Configurar el modelo Gemini
-        genai.configure(api_key=GOOGLE_API_KEY)
-        
-        # Configuración de generación
-        generation_config = {
-            "temperature": 0.9,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 2048,
-        }
-        
-        # Configuración de seguridad
-        safety_settings = [
-            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        ]
-        
-        # Crear el modelo
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",    # Última versión Gemini 2.0 Flash
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        
-        # Preparar el historial de la conversación para el modelo
-        chat_history = []
-        for msg in conversation_history:
-            chat_history.append({"role": msg.role, "parts": [{"text": msg.content}]})
-        
-        # Iniciar chat con historial
-        chat = model.start_chat(history=chat_history)
-        
-        # Preparar el mensaje del usuario
-        parts = []
-        if user_message:
-            parts.append({"text": user_message})
-        
-        # Agregar imágenes si existen
-        if images:
-            for img in images:
-                parts.append({
-                    "inline_data": {
-                        "mime_type": img['mime_type'],
-                        "data": img['data']
-                    }
-                })
-            # Si no hay mensaje de texto pero hay imágenes, agregar un prompt por defecto
-            if not user_message:
-                parts.append({"text": "Describe lo que ves en esta imagen"})
-        
-        # Enviar mensaje y obtener respuesta
-        response = chat.send_message(parts)
-        if hasattr(response, 'resolve'):
-            response.resolve()
-        
-        # Extraer el texto de la respuesta
-        assistant_response = response.text
-        logger.info(f"Respuesta generada: {assistant_response[:50]}{'...' if len(assistant_response) > 50 else ''}")
-        
-        return assistant_response
-        
-    except Exception as e:
-        logger.error(f"Error en get_gemini_response: {str(e)}", exc_info=True)
-        return f"Error al generar respuesta: {str(e)}"
-
-import base64
-import mimetypes
-from functools import wraps
-
-# Decorador para reintentos (si no existe, definir uno simple)
-def with_retries(retries=3, delay=5):
-    def decorator(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            last_exception = None
-            for attempt in range(retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    logger.warning(f"Attempt {attempt + 1}/{retries} failed for {func.__name__}: {e}")
-                    last_exception = e
-                    time.sleep(delay)
-            logger.error(f"{func.__name__} failed after {retries} retries.")
-            raise last_exception
-        return wrapper
-    return decorator
-
-# Función auxiliar para guardar mensajes (si no existe)
-def save_message_to_db(conversation_id, content, role):
-    try:
-        message = Message(conversation_id=conversation_id, content=content, role=role)
-        db.session.add(message)
-        db.session.commit()
-        logger.debug(f"Saved message to DB: ConvID={conversation_id}, Role={role}, Content='{content[:50]}...'")
-    except Exception as e:
-        db.session.rollback()
-        logger.error(f"Error saving message to DB: {e}")
-
-# Función auxiliar para guardar archivos binarios (si no existe)
-def save_binary_file(filepath, data):
-    try:
-        with open(filepath, 'wb') as f:
-            f.write(data)
-        logger.info(f"File saved successfully: {filepath}")
-    except Exception as e:
-        logger.error(f"Error saving binary file {filepath}: {e}")
-        raise
+# Seguimiento de operaciones de video: un único bucle por worker que consulta todas las pendientes
+video_job_tracker = VideoJobTracker(
+    app,
+    socketio,
+    get_operation=get_video_operation,
+    save_videos=save_generated_videos,
+    save_message=save_message_to_db,
+    poll_interval=int(os.getenv('VIDEO_POLL_INTERVAL', 20)),
+    timeout=int(os.getenv('VIDEO_JOB_TIMEOUT', 600))
+)
 
 @app.route('/chat', methods=['POST'])
 @login_required
+@instrumentation.traced('chat_post')
 def handle_chat_post():
     # This route handles the initial POST request from the frontend
     # It starts the generation process and returns an initial JSON response.
@@ -977,6 +1158,7 @@ def handle_chat_post():
         model_type = request.form.get('model', 'gemini')
         files = request.files.getlist('attachments') # Use request.files for FormData
         is_web_search = request.form.get('web_search', 'false').lower() == 'true'
+        use_cache = not wants_cache_bypass(request.form.get('no_cache', 'false'))
         # Get video params if model is video
         duration_seconds = request.form.get('durationSeconds')
         number_of_videos = request.form.get('numberOfVideos')
@@ -985,111 +1167,78 @@ def handle_chat_post():
         sid = session.get('sid') 
         logger.debug(f"Received POST /chat - ConvID: {conversation_id_str}, Model: {model_type}, Files: {len(files)}, WebSearch: {is_web_search}, SID: {sid}")
 
+        # --- Backpressure: reject before touching the DB if this model's queue is full ---
+        job_key = 'gemini' if is_web_search else model_type
+        if not job_scheduler.can_accept(job_key):
+            logger.warning(f"Job queue full for model {job_key}, rejecting /chat request")
+            return jsonify({'status': 'error', 'message': 'El servidor está ocupado. Por favor, intenta de nuevo en unos segundos.'}), 429, {'Retry-After': '5'}
+
         # --- Get or Create Conversation --- 
-        conversation_id = None
-        if not conversation_id_str or conversation_id_str.lower() == 'null' or conversation_id_str == 'undefined':
-            conversation = Conversation(user_id=current_user.id, model_name=model_type, title="Nueva Conversación")
-            db.session.add(conversation)
-            db.session.commit()
-            conversation_id = conversation.id
-            logger.info(f"Created new conversation via POST: {conversation_id}")
-            # Emit new conversation info immediately if created here
-            socketio.emit('conversation_update', {
-                'id': conversation.id,
-                'title': conversation.title,
-                'starred': conversation.starred,
-                'created_at': conversation.created_at.isoformat()
-            }, room=sid) # Emit to specific user if SID is known
-        else:
-            try:
-                conversation_id = int(conversation_id_str)
-                conversation = db.session.get(Conversation, conversation_id)
-                if not conversation or conversation.user_id != current_user.id:
-                    logger.error(f"Invalid or unauthorized conversation ID: {conversation_id}")
-                    return jsonify({'status': 'error', 'message': 'Conversación inválida o no autorizada'}), 403
-            except ValueError:
-                 logger.error(f"Invalid conversation ID format: {conversation_id_str}")
-                 return jsonify({'status': 'error', 'message': 'ID de conversación inválido'}), 400
+        with instrumentation.span('conversation_lookup'):
+            conversation_id = None
+            if not conversation_id_str or conversation_id_str.lower() == 'null' or conversation_id_str == 'undefined':
+                conversation = Conversation(user_id=current_user.id, model_name=model_type, title="Nueva Conversación")
+                db.session.add(conversation)
+                db.session.commit()
+                conversation_id = conversation.id
+                logger.info(f"Created new conversation via POST: {conversation_id}")
+                # Emit new conversation info immediately if created here
+                socketio.emit('conversation_update', {
+                    'id': conversation.id,
+                    'title': conversation.title,
+                    'starred': conversation.starred,
+                    'created_at': conversation.created_at.isoformat()
+                }, room=sid) # Emit to specific user if SID is known
+            else:
+                try:
+                    conversation_id = int(conversation_id_str)
+                    conversation = db.session.get(Conversation, conversation_id)
+                    if not conversation or conversation.user_id != current_user.id:
+                        logger.error(f"Invalid or unauthorized conversation ID: {conversation_id}")
+                        return jsonify({'status': 'error', 'message': 'Conversación inválida o no autorizada'}), 403
+                except ValueError:
+                     logger.error(f"Invalid conversation ID format: {conversation_id_str}")
+                     return jsonify({'status': 'error', 'message': 'ID de conversación inválido'}), 400
 
         # --- Process Attachments (Images) --- 
-        processed_images = []
-        if files:
-            logger.debug(f"Processing {len(files)} files from POST")
-            for file in files:
-                if file and file.filename: # Basic check for file and filename
-                    if not allowed_file(file.filename):
-                        logger.warning(f"Skipping file with invalid extension: {file.filename}. Allowed: {ALLOWED_EXTENSIONS}")
-                        continue # Skip to the next file
-
-                    # Now check content type for allowed files
-                    if file.content_type.startswith('image/'):
-                        try:
-                            # Read file content into memory
-                            file_content = file.read()
-                            # Encode to base64 for consistency
-                            encoded_content = base64.b64encode(file_content).decode('utf-8')
-                            processed_images.append({
-                                'mime_type': file.content_type,
-                                'data': encoded_content # Send base64 encoded data
-                            })
-                            logger.debug(f"Processed image: {file.filename}")
-                        except Exception as img_proc_error:
-                            logger.error(f"Error processing image {file.filename}: {img_proc_error}")
-                    else:
-                        # This case means allowed_file() was true, but content_type is not image.
-                        logger.warning(f"Skipping file with allowed extension but non-image content type: {file.filename} (Content-Type: {file.content_type})")
-                else: # Handle cases where file object or filename might be missing
-                    logger.warning("Received a file object without a filename or the file object itself is invalid.")
+        with instrumentation.span('attachments_save'):
+            processed_images = []
+            if files:
+                logger.debug(f"Processing {len(files)} files from POST")
+                for file in files:
+                    if file and file.filename: # Basic check for file and filename
+                        if not allowed_file(file.filename):
+                            logger.warning(f"Skipping file with invalid extension: {file.filename}. Allowed: {ALLOWED_EXTENSIONS}")
+                            continue # Skip to the next file
+
+                        # Now check content type for allowed files
+                        if file.content_type.startswith('image/'):
+                            try:
+                                # Stream the upload to the content-addressed store; the task only gets the reference
+                                image_ref = attachment_store.save(file.stream, file.content_type)
+                                processed_images.append(image_ref)
+                                logger.debug(f"Processed image: {file.filename} -> {image_ref['sha256'][:12]}")
+                            except Exception as img_proc_error:
+                                logger.error(f"Error processing image {file.filename}: {img_proc_error}")
+                        else:
+                            # This case means allowed_file() was true, but content_type is not image.
+                            logger.warning(f"Skipping file with allowed extension but non-image content type: {file.filename} (Content-Type: {file.content_type})")
+                    else: # Handle cases where file object or filename might be missing
+                        logger.warning("Received a file object without a filename or the file object itself is invalid.")
             
-            if not processed_images and files: # This log is after attempting to process all files
-                 logger.warning("Files were attached but none could be processed as valid images (either due to extension, content type, or processing error).")
-                 # Decide if this is an error or just a note
+                if not processed_images and files: # This log is after attempting to process all files
+                     logger.warning("Files were attached but none could be processed as valid images (either due to extension, content type, or processing error).")
+                     # Decide if this is an error or just a note
 
         # --- Save User Message --- 
         if user_message or processed_images: # Save even if only images are sent
-            db_message_content = user_message
-            if processed_images:
-                db_message_content += f"\n[{len(processed_images)} image(s) attached]"
-            save_message_to_db(conversation_id, db_message_content.strip(), 'user')
+            save_message_to_db(conversation_id, stored_user_content(user_message, processed_images), 'user')
             # Frontend should optimistically display the user message
 
         # --- Handle Title Generation --- 
+        # Runs in its own background task so /chat does not wait for an LLM round trip
         if conversation.title == "Nueva Conversación" and user_message:
-            try:
-                title_prompt = f"Generate a short, descriptive title (max 5 words) for a conversation that starts with: {user_message}"
-                generated_title = None
-                if groq_client: # Prioritize Groq for speed if available
-                    title_model_name = "meta-llama/llama-4-maverick-17b-128e-instruct"
-                    title_messages = [{"role": "user", "content": title_prompt}]
-                    title_max_tokens = 15
-                    title_temp = 0.5
-                    logger.debug(f"Groq Title Gen Request: Model='{title_model_name}', Messages={json.dumps(title_messages)}, MaxTokens={title_max_tokens}, Temp={title_temp}")
-                    title_completion = groq_client.chat.completions.create(
-                        model=title_model_name,
-                        messages=title_messages,
-                        max_tokens=title_max_tokens,
-                        temperature=title_temp
-                    )
-                    logger.debug(f"Groq Title Gen Raw Response: {title_completion.model_dump_json(indent=2)}")
-                    generated_title = title_completion.choices[0].message.content.strip().replace('"', '')
-                    logger.debug(f"Groq Extracted Title: {generated_title}")
-                elif GOOGLE_API_KEY: # Fallback to Gemini if Groq unavailable
-                     # Use a faster Gemini model if possible, or the main one
-                     # title_response = model.generate_content(title_prompt) # This might be slow
-                     # generated_title = title_response.text.strip().replace('"', '')
-                     pass # Skipping Gemini title gen for now to keep it fast
-                
-                conversation.title = generated_title[:50] if generated_title else user_message[:50].strip()
-                db.session.commit()
-                logger.info(f"Generated title for Conv {conversation_id}: {conversation.title}")
-                # Emit title update
-                socketio.emit('conversation_update', {
-                    'id': conversation_id,
-                    'title': conversation.title
-                }, room=sid) # Emit to specific user if SID is known
-            except Exception as title_err:
-                 logger.error(f"Error generating title: {title_err}", exc_info=True)
-                 # Continue without title generation if it fails
+            socketio.start_background_task(target=generate_title_task, conversation_id=conversation_id, user_message=user_message, sid=sid)
 
         # --- Trigger Background Task for Response Generation --- 
         task_data = {
@@ -1098,6 +1247,7 @@ def handle_chat_post():
             'processed_images': processed_images,
             'model_type': model_type,
             'is_web_search': is_web_search,
+            'use_cache': use_cache,
             'video_params': {
                 'duration': duration_seconds,
                 'count': number_of_videos,
@@ -1105,17 +1255,80 @@ def handle_chat_post():
             } if model_type == 'kkty2-video' else None,
             'sid': sid # Pass SID to the background task
         }
-        socketio.start_background_task(target=generate_response_task, **task_data)
+        def notify_queue_position(position):
+            socketio.emit('queue_position', {'conversation_id': conversation_id, 'position': position}, room=sid)
+
+        try:
+            with instrumentation.span('schedule'):
+                queue_position = job_scheduler.submit(job_key, generate_response_task, notify=notify_queue_position, **task_data)
+        except QueueFullError:
+            logger.warning(f"Job queue filled up for model {job_key} while handling /chat")
+            return jsonify({'status': 'error', 'message': 'El servidor está ocupado. Por favor, intenta de nuevo en unos segundos.', 'conversation_id': conversation_id}), 429, {'Retry-After': '5'}
 
         # Return immediate JSON response to the fetch call
-        return jsonify({'status': 'processing', 'message': 'Solicitud recibida, procesando...', 'conversation_id': conversation_id})
+        return jsonify({'status': 'processing', 'message': 'Solicitud recibida, procesando...', 'conversation_id': conversation_id, 'queue_position': queue_position})
 
     except Exception as e:
         logger.error(f"Error in /chat POST handler: {str(e)}", exc_info=True)
         return jsonify({'status': 'error', 'message': f'Error interno del servidor: {str(e)}'}), 500
 
+@instrumentation.traced('title_generation', attrs=('conversation_id',))
+def generate_title_task(conversation_id, user_message, sid):
+    """
+    Genera el título de una conversación nueva en segundo plano y lo emite por Socket.IO.
+
+    Si Groq no está disponible, falla o supera TITLE_GENERATION_TIMEOUT, se usa como
+    título el inicio del primer mensaje.
+    """
+    with app.app_context():
+        generated_title = None
+        try:
+            title_prompt = f"Generate a short, descriptive title (max 5 words) for a conversation that starts with: {user_message}"
+            groq_client = upstream.groq
+            if groq_client: # Prioritize Groq for speed if available
+                title_model_name = "meta-llama/llama-4-maverick-17b-128e-instruct"
+                title_messages = [{"role": "user", "content": title_prompt}]
+                logger.debug(f"Groq Title Gen Request: Model='{title_model_name}', Messages={json.dumps(title_messages)}")
+                with instrumentation.span('groq_title'), upstream.limiter('groq'):
+                    title_completion = groq_client.with_options(timeout=TITLE_GENERATION_TIMEOUT, max_retries=0).chat.completions.create(
+                        model=title_model_name,
+                        messages=title_messages,
+                        max_tokens=15,
+                        temperature=0.5
+                    )
+                generated_title = title_completion.choices[0].message.content.strip().replace('"', '')
+                logger.debug(f"Groq Extracted Title: {generated_title}")
+        except Exception as title_err:
+            logger.warning(f"Title generation failed for Conv {conversation_id}, using fallback: {title_err}")
+
+        try:
+            conversation = db.session.get(Conversation, conversation_id)
+            # Do not overwrite a title that was set in the meantime
+            if not conversation or conversation.title != "Nueva Conversación":
+                return
+            conversation.title = generated_title[:50] if generated_title else user_message[:50].strip()
+            db.session.commit()
+            logger.info(f"Generated title for Conv {conversation_id}: {conversation.title}")
+            socketio.emit('conversation_update', {
+                'id': conversation_id,
+                'title': conversation.title
+            }, room=sid) # Emit to specific user if SID is known
+        except Exception as title_err:
+            db.session.rollback()
+            logger.error(f"Error saving title for Conv {conversation_id}: {title_err}", exc_info=True)
+
+def make_progress_coalescer(conversation_id, sid):
+    """Crea un StreamCoalescer que emite 'message_progress' agrupando fragmentos por tamaño/tiempo"""
+    def emit_progress(text):
+        with instrumentation.span('socketio_emit'):
+            socketio.emit('message_progress', {'content': text, 'conversation_id': conversation_id}, room=sid)
+    # El envío programado vacía el búfer a tiempo aunque el proveedor haga una pausa
+    return StreamCoalescer(emit_progress, max_bytes=STREAM_FLUSH_BYTES, max_interval_ms=STREAM_FLUSH_INTERVAL_MS,
+                           spawn=socketio.start_background_task, sleep=socketio.sleep)
+
 # Separate function for background task
-def generate_response_task(conversation_id, user_message, processed_images, model_type, is_web_search, video_params, sid):
+@instrumentation.traced('chat_response', attrs=('conversation_id', 'model_type'))
+def generate_response_task(conversation_id, user_message, processed_images, model_type, is_web_search, video_params, sid, use_cache=True):
     with app.app_context(): # Need app context for DB operations and config
         try:
             logger.info(f"Background task started for Conv {conversation_id}, Model: {model_type}, SID: {sid}")
@@ -1152,27 +1365,17 @@ def generate_response_task(conversation_id, user_message, processed_images, mode
                     start_msg = f'Generando {count} video(s) de {duration}s con Veo 2... (esto puede tardar unos minutos)'
                     socketio.emit('message', {'role': 'assistant', 'content': start_msg, 'done': False, 'conversation_id': conversation_id}, room=sid)
                     
-                    # Call the video generation function
-                    video_urls = generate_video_from_text(
+                    # Start the operation and hand it over to the tracker; it polls every
+                    # outstanding operation from one loop and emits the result when done
+                    operation = start_video_generation(
                         prompt_text=user_message,
                         duration_seconds=duration,
                         number_of_videos=count,
                         aspect_ratio=aspect
                     )
-
-                    if video_urls:
-                        response_content = f"Aquí tienes los videos generados a partir de '{user_message}':\n"
-                        for url in video_urls:
-                            response_content += f"[GENERATED_VIDEO:{url}]\n"
-                        socketio.emit('message', {'role': 'assistant', 'content': response_content, 'done': True, 'conversation_id': conversation_id, 'model_type': model_type}, room=sid)
-                        save_message_to_db(conversation_id, response_content, 'assistant')
-                    else:
-                        # This case might happen if generate_video_from_text returns [] on failure
-                        error_message = "Lo siento, no pude generar los videos con Veo 2. Hubo un problema durante la generación. Por favor, revisa el prompt, asegúrate de que el servicio Veo 2 esté activo y tu API key tenga permisos, o intenta de nuevo más tarde."
-                        socketio.emit('message', {'role': 'assistant', 'content': error_message, 'done': True, 'conversation_id': conversation_id, 'model_type': model_type}, room=sid)
-                        save_message_to_db(conversation_id, error_message, 'assistant')
+                    video_job_tracker.track(conversation_id, operation.name, user_message, sid)
                 
-                except genai_types.generation_types.BlockedPromptException as bpe:
+                except genai.types.generation_types.BlockedPromptException as bpe:
                     logger.error(f"Generación de video bloqueada debido al prompt para Conv {conversation_id}: {bpe}")
                     error_msg = "Tu solicitud de generación de video fue bloqueada porque el prompt infringe las políticas de seguridad. Por favor, modifica el prompt e intenta de nuevo."
                     socketio.emit('message', {'role': 'assistant', 'content': error_msg, 'done': True, 'conversation_id': conversation_id, 'model_type': model_type}, room=sid)
@@ -1192,9 +1395,6 @@ def generate_response_task(conversation_id, user_message, processed_images, mode
                 return # End task after video logic
 
             # --- Other Model Logic (Gemini, Groq, Image Gen, Web Search etc.) ---
-            # Get conversation history (only needed for models that use it)
-            previous_messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.created_at).all()
-            
             assistant_response = ""
             is_streaming = False
             try:
@@ -1203,78 +1403,70 @@ def generate_response_task(conversation_id, user_message, processed_images, mode
                      try:
                          search_prompt = f"Actúa como un asistente de búsqueda web experto. Busca información sobre: {user_message}. Proporciona una respuesta detallada y actualizada."
                          # Ensure 'model' is the correct Gemini model instance configured for text
+                         model = providers.get('gemini')
                          if not model:
                              raise Exception("Gemini text model not initialized.")
-                         response = model.generate_content(search_prompt)
-                         assistant_response = response.text
+                         # Keyed by the user's query, not by the prompt template around it
+                         cache_lookup = lookup_cached_response('web_search', user_message, use_cache)
+                         if cache_lookup and cache_lookup.response is not None:
+                             assistant_response = cache_lookup.response
+                             logger.info(f"Web search answered from the response cache for Conv {conversation_id}")
+                         else:
+                             with instrumentation.span('web_search'), upstream.limiter('gemini'):
+                                 response = upstream_executor.call(model.generate_content, search_prompt, request_options=upstream.gemini_request_options())
+                             assistant_response = response.text
+                             if cache_lookup:
+                                 response_cache.store(cache_lookup, assistant_response)
                      except Exception as search_err:
                          logger.error(f"Error during web search generation: {search_err}")
                          assistant_response = f"Error al realizar la búsqueda web: {search_err}"
 
-                elif model_type == 'gemini':
-                    if not model:
-                         raise Exception("Gemini model not initialized.")
-                    # Adapt get_gemini_response if needed, ensure it handles base64 images
-                    assistant_response = get_gemini_response(previous_messages, user_message, images=processed_images)
-                
-                elif model_type == 'groq':
-                    if not groq_client:
-                        raise Exception("Groq API key not configured.")
-                    is_streaming = True # Groq uses streaming
-                    
-                    # Prepare messages for Groq
-                    conversation_history_for_groq = []
-                    for msg in previous_messages:
-                         # Ensure history format is correct for Groq
-                         role = msg.role if msg.role in ['user', 'assistant'] else 'user' # Default unknown roles to user
-                         conversation_history_for_groq.append({"role": role, "content": msg.content})
-
-                    user_content_for_groq = user_message
-                    if processed_images:
-                         # Check if a vision model is available and selected for Groq
-                         # For now, assume text model and add note
-                         user_content_for_groq += "\n[Nota: El usuario adjuntó imágenes. No puedo verlas directamente.]" 
-                    
-                    messages_for_groq = conversation_history_for_groq + [{"role": "user", "content": user_content_for_groq}]
-                    
-                    # Select appropriate Groq model
-                    groq_model_name = "meta-llama/llama-4-maverick-17b-128e-instruct"  # Llama 4 Maverick (Meta)
-                    # if processed_images and groq_vision_model_available:
-                    #     groq_model_name = "groq-vision-model-name" # Keep vision model separate if needed
-                    
-                    groq_request_params = {
-                        "model": groq_model_name,
-                        "messages": messages_for_groq,
-                        "temperature": 0.7,
-                        "max_tokens": 2048,
-                        "stream": True
-                    }
-                    logger.debug(f"Groq Chat Request: {json.dumps(groq_request_params)}")
-
-                    completion = groq_client.chat.completions.create(**groq_request_params)
-                    
-                    logger.info("Groq stream initiated.")
-                    full_groq_response = ""
-                    chunk_counter = 0
-                    for chunk in completion:
-                        if chunk_counter < 3: # Log first 3 chunks in detail
-                            logger.debug(f"Groq Stream Chunk [{chunk_counter}]: {chunk.model_dump_json(indent=2)}")
-                        
-                        if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
-                            chunk_content = chunk.choices[0].delta.content
-                            full_groq_response += chunk_content
-                            logger.debug(f"Groq Stream: Received content chunk (length: {len(chunk_content)})")
-                            # Emit progress chunks
-                            socketio.emit('message_progress', {'content': chunk_content, 'conversation_id': conversation_id}, room=sid)
-                        elif chunk.choices and chunk.choices[0].delta and not chunk.choices[0].delta.content:
-                             logger.debug(f"Groq Stream: Received empty delta chunk (possibly finish reason): {chunk.model_dump_json(indent=2)}")
-                        else:
-                             logger.debug(f"Groq Stream: Received non-content or unexpected chunk: {chunk.model_dump_json(indent=2)}")
-                        chunk_counter += 1
+                elif model_type in llm_backends:
+                    backend = llm_backends.get(model_type)
+                    is_streaming = True # Chat backends stream through message_progress
+                    # Only the newest turns within the backend's history budget are loaded
+                    with instrumentation.span('message_flush'):
+                        # The history must include the messages still waiting in the write-behind queue
+                        message_persister.flush()
+                    with instrumentation.span('history_load'):
+                        # The current message is already stored, but the backend sends it on its own
+                        previous_messages = history_loader.load(
+                            conversation_id, backend.history_key,
+                            current_message=stored_user_content(user_message, processed_images))
+                    # Only a first question without attachments is cacheable. It is decided from
+                    # the persisted messages: the loaded history is trimmed to the budget
+                    cacheable = (response_cache is not None and not processed_images and bool(user_message)
+                                 and is_first_user_turn(conversation_id))
+                    # The stream can take many seconds: do not hold a pooled connection meanwhile
+                    release_connection(db)
+
+                    cache_lookup = None
+                    if cacheable:
+                        cache_lookup = lookup_cached_response(f'chat:{model_type}', user_message, use_cache)
+                    if cache_lookup and cache_lookup.response is not None:
+                        # Cache hits are replayed through the same message_progress protocol
+                        logger.info(f"Response for Conv {conversation_id} served from the response cache (semantic: {cache_lookup.semantic})")
+                        response_stream = replay_chunks(cache_lookup.response)
+                    else:
+                        # Upstream time is measured separately from the time spent emitting each chunk
+                        # (stages <backend>_stream and <backend>_first_chunk, e.g. gemini_stream)
+                        response_stream = instrumentation.timed_iter(
+                            f'{backend.name}_stream',
+                            backend.stream(previous_messages, user_message, images=processed_images),
+                            first_item_stage=f'{backend.name}_first_chunk'
+                        )
+                    response_chunks = []
+                    with make_progress_coalescer(conversation_id, sid) as coalescer:
+                        for chunk_content in response_stream:
+                            response_chunks.append(chunk_content)
+                            # Progress is emitted in batches, not once per token
+                            coalescer.push(chunk_content)
+                    assistant_response = "".join(response_chunks) # Store full response for DB
+                    if cache_lookup and cache_lookup.response is None:
+                        response_cache.store(cache_lookup, assistant_response)
                     
-                    logger.info(f"Groq stream finished. Total chunks processed: {chunk_counter}")
-                    assistant_response = full_groq_response # Store full response for DB
-                    logger.debug(f"Groq Full Assembled Response (first 200 chars): {assistant_response[:200]}")
+                    logger.info(f"{backend.name} stream finished ({len(assistant_response)} chars, progress emits: {coalescer.emits})")
+                    logger.debug(f"Full Assembled Response (first 200 chars): {assistant_response[:200]}")
                     # Emit final message marker for streaming
                     socketio.emit('message', {'role': 'assistant', 'content': '', 'done': True, 'conversation_id': conversation_id}, room=sid)
 
@@ -1796,14 +1988,68 @@ def handle_socket_message(data):
 @app.route('/api/conversations')
 @login_required
 def get_conversations():
-    conversations = Conversation.query.filter_by(user_id=current_user.id).order_by(Conversation.created_at.desc()).all()
+    # Paginación keyset: ?starred=true|false&before=<conversation_id>&limit=50
+    limit = max(1, min(request.args.get('limit', CONVERSATIONS_PAGE_SIZE, type=int), CONVERSATIONS_PAGE_MAX))
+    before_id = request.args.get('before', type=int)
+    starred_arg = request.args.get('starred')
+
+    query = Conversation.query.filter(Conversation.user_id == current_user.id)
+    if starred_arg is not None:
+        if starred_arg.lower() == 'true':
+            query = query.filter(Conversation.starred.is_(True))
+        else:
+            # Las conversaciones antiguas pueden tener starred a NULL
+            query = query.filter(sa.or_(Conversation.starred.is_(False), Conversation.starred.is_(None)))
+    if before_id:
+        before = db.session.get(Conversation, before_id)
+        if not before or before.user_id != current_user.id:
+            return jsonify({'status': 'error', 'message': 'Cursor inválido'}), 400
+        query = query.filter(sa.or_(
+            Conversation.created_at < before.created_at,
+            sa.and_(Conversation.created_at == before.created_at, Conversation.id < before.id)
+        ))
+
+    conversations = query.order_by(Conversation.created_at.desc(), Conversation.id.desc()).limit(limit + 1).all()
+    has_more = len(conversations) > limit
+    conversations = conversations[:limit]
+
     return jsonify({
         'conversations': [{
             'id': conv.id,
             'title': conv.title or 'Nueva conversación',
             'starred': conv.starred,
             'created_at': conv.created_at.isoformat()
-        } for conv in conversations]
+        } for conv in conversations],
+        'has_more': has_more,
+        'next_cursor': conversations[-1].id if has_more else None
+    })
+
+@app.route('/api/conversations/search')
+@login_required
+def search_conversations():
+    # Paginación por páginas (el orden es por relevancia): ?q=<texto>&page=1&limit=20
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'status': 'error', 'message': 'Falta el texto a buscar'}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), SEARCH_PAGE_MAX))
+    page = max(1, request.args.get('page', 1, type=int))
+
+    # Los mensajes aún en la cola de escritura también deben aparecer
+    message_persister.flush()
+    try:
+        with instrumentation.span('search'):
+            hits = message_search.search(current_user.id, text, limit=limit + 1, offset=(page - 1) * limit)
+    except SearchUnavailableError as e:
+        logger.warning(f"Búsqueda no disponible: {e}")
+        return jsonify({'status': 'error', 'message': 'La búsqueda no está disponible'}), 503
+    except Exception as e:
+        logger.error(f"Error en la búsqueda '{text}': {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': 'La búsqueda no está disponible'}), 503
+
+    return jsonify({
+        'results': hits[:limit],
+        'page': page,
+        'has_more': len(hits) > limit
     })
 
 @app.route('/api/conversations', methods=['POST'])
@@ -1826,7 +2072,29 @@ def get_conversation(conversation_id):
     if conversation.user_id != current_user.id:
         abort(403)
     
-    messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.created_at.asc()).all()
+    # Incluir los mensajes aún pendientes de escritura
+    message_persister.flush()
+    
+    # Paginación keyset: ?before=<message_id>&limit=50 devuelve los mensajes anteriores a ese ID
+    limit = max(1, min(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), MESSAGES_PAGE_MAX))
+    before_id = request.args.get('before', type=int)
+
+    query = Message.query.filter(Message.conversation_id == conversation_id)
+    if before_id:
+        before = db.session.get(Message, before_id)
+        if not before or before.conversation_id != conversation_id:
+            return jsonify({'status': 'error', 'message': 'Cursor inválido'}), 400
+        query = query.filter(sa.or_(
+            Message.created_at < before.created_at,
+            sa.and_(Message.created_at == before.created_at, Message.id < before.id)
+        ))
+
+    # Se pide un mensaje extra para saber si quedan más páginas
+    messages = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+
     return jsonify({
         'id': conversation.id,
         'title': conversation.title or 'Nueva conversación',
@@ -1837,7 +2105,9 @@ def get_conversation(conversation_id):
             'content': msg.content,
             'role': msg.role,
             'created_at': msg.created_at.isoformat()
-        } for msg in messages]
+        } for msg in messages],
+        'has_more': has_more,
+        'next_cursor': messages[0].id if has_more and messages else None
     })
 
 @app.route('/api/conversations/<int:conversation_id>/star', methods=['POST'])
@@ -1875,6 +2145,11 @@ def toggle_star(conversation_id):
             'error': str(e)
         }), 500
 
+@app.context_processor
+def inject_client_config():
+    # Configuración que necesita el JavaScript de la página (ver #app-config en index.html)
+    return {'client_config': {'imageVariantWidths': list(image_variants.widths)}}
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -1885,7 +2160,30 @@ def send_static(path):
 
 @app.route('/uploads/<path:path>')
 def send_upload(path):
-    return send_from_directory('uploads', path)
+    # Ruta pública y cacheable: solo media generada, nunca los adjuntos de los usuarios
+    if not media_server.is_public(path):
+        abort(404)
+    # Imágenes: ?w=<ancho> o ?variant=thumb eligen el tamaño y Accept el formato (WebP/AVIF)
+    if image_variants.is_source(path):
+        width = request.args.get('w', type=int)
+        if request.args.get('variant') == 'thumb':
+            width = image_variants.widths[0]
+        accept = request.headers.get('Accept', '')
+        variant = image_variants.select(path, width=width, accept=accept)
+        # Se marca como usado el fichero que se sirve (los que más se sirven son los
+        # últimos en borrarse al liberar espacio)
+        media_store.touch(variant[0] if variant else path)
+        if variant:
+            response = media_server.send(variant[0], mimetype=variant[1])
+        else:
+            # Mientras no existan las variantes que el navegador podría usar, el original
+            # se cachea poco tiempo para que la siguiente carga las reciba
+            wanted = width or any(mime in accept for mime in ('image/webp', 'image/avif'))
+            response = media_server.send(path, cacheable=not (wanted and image_variants.formats))
+        response.vary.add('Accept')
+        return response
+    media_store.touch(path)
+    return media_server.send(path)
 
 @app.route('/api/search', methods=['POST'])
 @login_required
@@ -1899,6 +2197,7 @@ def web_search():
         data = request.get_json()
         query = data.get('query', '')
         session_id = data.get('session_id', 'default')
+        use_cache = not wants_cache_bypass(data.get('no_cache', False))
 
         if not query:
             return jsonify({
@@ -1907,13 +2206,30 @@ def web_search():
             }), 400
 
         try:
-            response = model.generate_content(
-                f"""Actúa como un asistente de búsqueda web experto. 
-                Busca información sobre: {query}
-                
-                Proporciona una respuesta detallada y actualizada basada en la información disponible.
-                Si es posible, incluye fuentes o referencias relevantes."""
-            )
+            cache_lookup = lookup_cached_response('web_search', query, use_cache)
+            if cache_lookup and cache_lookup.response is not None:
+                return jsonify({
+                    'response': cache_lookup.response,
+                    'session_id': session_id,
+                    'status': 'success',
+                    'cached': True
+                })
+
+            model = providers.get('gemini')
+            if model is None:
+                raise Exception("Gemini text model not initialized.")
+            with upstream.limiter('gemini'):
+                response = upstream_executor.call(
+                    model.generate_content,
+                    f"""Actúa como un asistente de búsqueda web experto. 
+                    Busca información sobre: {query}
+                    
+                    Proporciona una respuesta detallada y actualizada basada en la información disponible.
+                    Si es posible, incluye fuentes o referencias relevantes.""",
+                    request_options=upstream.gemini_request_options()
+                )
+            if cache_lookup:
+                response_cache.store(cache_lookup, response.text)
             
             return jsonify({
                 'response': response.text,
@@ -1957,6 +2273,91 @@ def reset_chat():
             'status': 'error'
         }), 500
 
+@app.route('/api/stats')
+@login_required
+def get_stats():
+    # Estadísticas internas del worker (cachés, colas, clientes)
+    return jsonify({
+        'model_registry': model_registry.stats(),
+        'providers': providers.stats(),
+        'job_scheduler': job_scheduler.stats(),
+        'attachment_store': attachment_store.stats(),
+        'media_store': media_store.stats(),
+        'image_variants': image_variants.stats(),
+        'media_server': media_server.stats(),
+        'image_preprocessor': image_preprocessor.stats(),
+        'blocking_pools': {name: executor.stats() for name, executor in blocking_executors().items()},
+        'loop_lag': loop_lag_monitor.stats() if loop_lag_monitor else None,
+        'upstream': upstream.stats(),
+        'backends': llm_backends.stats(),
+        'instrumentation': instrumentation.stats(),
+        'message_persister': message_persister.stats(),
+        'db_pools': db_pool_stats(),
+        'search': message_search.stats(),
+        'response_cache': response_cache.stats() if response_cache else None
+    })
+
+def db_pool_stats():
+    # Estado de cada pool de conexiones y esperas acumuladas por checkout
+    pools = {}
+    for bind_key, engine in db.engines.items():
+        name = bind_key or 'default'
+        status = pool_status(engine) or {}
+        if name in db_pool_monitors:
+            status.update(db_pool_monitors[name].stats())
+        pools[name] = status
+    return pools
+
+def blocking_executors():
+    # Pools de hilos nativos para el trabajo que no cede el control a gevent
+    return {
+        'upstream': upstream_executor,
+        'image_preprocessor': image_preprocessor.executor,
+        'image_variants': image_variants.executor,
+    }
+
+def collect_gauges():
+    # Métricas instantáneas del worker para /metrics
+    scheduler = job_scheduler.stats()
+    limiters = upstream.stats()
+    pools = db_pool_stats()
+    executors = {name: executor.stats() for name, executor in blocking_executors().items()}
+    gauges = [
+        ('chat_jobs_running', 'Tareas de generación en ejecución por modelo',
+         {(('model', key),): value['running'] for key, value in scheduler['models'].items()}),
+        ('chat_jobs_queued', 'Tareas de generación en espera por modelo',
+         {(('model', key),): value['queued'] for key, value in scheduler['models'].items()}),
+        ('chat_jobs_rejected', 'Peticiones rechazadas por cola llena (acumulado)', scheduler['rejected']),
+        ('messages_pending_write', 'Mensajes en la cola de escritura diferida', message_persister.stats()['pending']),
+        ('upstream_in_flight', 'Llamadas en curso por proveedor',
+         {(('provider', key),): value['in_flight'] for key, value in limiters.items()}),
+        ('upstream_rejected', 'Llamadas rechazadas por proveedor saturado (acumulado)',
+         {(('provider', key),): value['rejected'] for key, value in limiters.items()}),
+        ('db_pool_size', 'Conexiones permanentes de cada pool',
+         {(('pool', key),): value['size'] for key, value in pools.items() if 'size' in value}),
+        ('db_pool_checked_out', 'Conexiones en uso por pool',
+         {(('pool', key),): value['checked_out'] for key, value in pools.items() if 'checked_out' in value}),
+        ('db_pool_overflow', 'Conexiones abiertas por encima de pool_size',
+         {(('pool', key),): value['overflow'] for key, value in pools.items() if 'overflow' in value}),
+        ('db_pool_timeouts', 'Checkouts fallidos por pool agotado (acumulado)',
+         {(('pool', key),): value['timeouts'] for key, value in pools.items() if 'timeouts' in value}),
+        ('blocking_in_flight', 'Llamadas en curso en los pools de hilos nativos',
+         {(('pool', key),): value['in_flight'] for key, value in executors.items()}),
+    ]
+    if loop_lag_monitor:
+        gauges.append(('loop_blocked', 'Bloqueos del bucle de gevent por encima del umbral (acumulado)',
+                       loop_lag_monitor.stats()['blocked']))
+    return gauges
+
+instrumentation.register_gauges(collect_gauges)
+
+@app.route('/metrics')
+def metrics():
+    # Formato de exposición de Prometheus; con METRICS_TOKEN se exige 'Authorization: Bearer <token>'
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        abort(401)
+    return Response(instrumentation.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/test_api')
 def test_api():
     try:
@@ -1984,12 +2385,11 @@ def test_api():
         }), 500
 
 if __name__ == '__main__':
-    with app.app_context():
-        try:
-            db.create_all()
-            logger.info("Base de datos creada exitosamente")
-        except Exception as e:
-            logger.error(f"Error al crear la base de datos: {e}")
+    try:
+        prepare_database()
+        logger.info("Base de datos creada exitosamente")
+    except Exception as e:
+        logger.error(f"Error al crear la base de datos: {e}")
     
     # Configuración para entorno de desarrollo y producción
     port = int(os.environ.get('PORT', 5000)) # Changed default port to 5000
@@ -0,0 +1,104 @@
+# Almacén de adjuntos direccionado por contenido (SHA-256)
+
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger('attachment_store')
+
+
+class AttachmentTooLargeError(Exception):
+    """Se lanza cuando un adjunto supera el tamaño máximo permitido"""
+    pass
+
+
+class AttachmentStore:
+    """
+    Guarda los adjuntos en disco con el SHA-256 de su contenido como nombre.
+
+    Los ficheros se escriben por bloques mientras se calcula el hash, sin cargar la
+    subida completa en memoria. Si el mismo contenido ya existe, se reutiliza el
+    fichero existente (la misma foto se guarda una sola vez). Las tareas de
+    generación reciben solo la referencia y leen los bytes cuando los necesitan.
+    """
+
+    def __init__(self, root, max_size, chunk_size=64 * 1024, on_write=None):
+        """
+        Args:
+            root: Directorio de los adjuntos
+            max_size: Tamaño máximo (bytes) de un adjunto
+            chunk_size: Tamaño de bloque al leer la subida
+            on_write: Función (bytes) llamada tras guardar un fichero nuevo
+                (MediaStore.record_write: el límite de uploads/ cuenta los adjuntos)
+        """
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.on_write = on_write
+        self.saved = 0
+        self.deduplicated = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, sha256):
+        # Subdirectorio por los dos primeros caracteres para no llenar un único directorio
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def save(self, stream, mime_type):
+        """
+        Guarda el contenido de un stream y devuelve su referencia.
+
+        Args:
+            stream: Objeto con read(n) (p. ej. FileStorage.stream)
+            mime_type: Tipo MIME del adjunto
+
+        Returns:
+            dict: Referencia {'sha256', 'mime_type', 'size'}
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while True:
+                    block = stream.read(self.chunk_size)
+                    if not block:
+                        break
+                    size += len(block)
+                    if size > self.max_size:
+                        raise AttachmentTooLargeError(f"Adjunto demasiado grande: más de {self.max_size/1024/1024:.0f}MB")
+                    digest.update(block)
+                    tmp.write(block)
+
+            sha256 = digest.hexdigest()
+            final_path = self.path_for(sha256)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+                # Reutilizado: cuenta como uso reciente al liberar espacio
+                os.utime(final_path)
+                self.deduplicated += 1
+                logger.debug(f"Adjunto {sha256[:12]} ya existía, se reutiliza")
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+                self.saved += 1
+                logger.debug(f"Adjunto {sha256[:12]} guardado ({size/1024:.0f}KB)")
+                if self.on_write:
+                    self.on_write(size)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return {'sha256': sha256, 'mime_type': mime_type, 'size': size}
+
+    def read_bytes(self, ref):
+        """Lee los bytes de un adjunto a partir de su referencia"""
+        with open(self.path_for(ref['sha256']), 'rb') as f:
+            return f.read()
+
+    def stats(self):
+        return {
+            'saved': self.saved,
+            'deduplicated': self.deduplicated,
+        }
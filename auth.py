@@ -3,15 +3,46 @@ from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
 from models import User, db
 from datetime import timedelta
-from authlib.integrations.flask_client import OAuth
 import os
 import secrets
 import string
 
 auth = Blueprint('auth', __name__)
 
-# Configuración de OAuth
-oauth = OAuth()
+# Cliente de Google OAuth: authlib se importa y el cliente se registra en el primer
+# inicio de sesión con Google, no al arrancar el worker
+_google_oauth = None
+
+def get_google_oauth():
+    """
+    Devuelve el cliente de Google OAuth, creándolo si no existe.
+
+    Returns:
+        Cliente OAuth de authlib o None si faltan GOOGLE_CLIENT_ID/GOOGLE_CLIENT_SECRET
+    """
+    global _google_oauth
+    if _google_oauth is None:
+        # Obtener credenciales de Google OAuth
+        client_id = os.getenv('GOOGLE_CLIENT_ID')
+        client_secret = os.getenv('GOOGLE_CLIENT_SECRET')
+        if not client_id or not client_secret:
+            return None
+
+        from authlib.integrations.flask_client import OAuth
+        oauth = OAuth(current_app._get_current_object())
+        _google_oauth = oauth.register(
+            name='google',
+            client_id=client_id,
+            client_secret=client_secret,
+            access_token_url='https://accounts.google.com/o/oauth2/token',
+            access_token_params=None,
+            authorize_url='https://accounts.google.com/o/oauth2/auth',
+            authorize_params=None,
+            api_base_url='https://www.googleapis.com/oauth2/v1/',
+            userinfo_endpoint='https://openidconnect.googleapis.com/v1/userinfo',
+            client_kwargs={'scope': 'email profile'},
+        )
+    return _google_oauth
 
 @auth.route('/login', methods=['GET', 'POST'])
 def login():
@@ -99,29 +130,10 @@ def register():
 @auth.route('/login/google')
 def login_google():
     # Registrar Google OAuth en la primera solicitud
-    if 'google' not in oauth._clients:
-        # Obtener credenciales de Google OAuth
-        client_id = os.getenv('GOOGLE_CLIENT_ID')
-        client_secret = os.getenv('GOOGLE_CLIENT_SECRET')
-        
-        # Verificar que las credenciales existan
-        if not client_id or not client_secret:
-            flash('Error: Credenciales de Google OAuth no configuradas correctamente.')
-            return redirect(url_for('auth.login'))
-            
-        # Configurar cliente de Google OAuth
-        google = oauth.register(
-            name='google',
-            client_id=client_id,
-            client_secret=client_secret,
-            access_token_url='https://accounts.google.com/o/oauth2/token',
-            access_token_params=None,
-            authorize_url='https://accounts.google.com/o/oauth2/auth',
-            authorize_params=None,
-            api_base_url='https://www.googleapis.com/oauth2/v1/',
-            userinfo_endpoint='https://openidconnect.googleapis.com/v1/userinfo',
-            client_kwargs={'scope': 'email profile'},
-        )
+    google = get_google_oauth()
+    if google is None:
+        flash('Error: Credenciales de Google OAuth no configuradas correctamente.')
+        return redirect(url_for('auth.login'))
     
     # Generar URL de redirección
     # Usar una variable de entorno para la URI de redirección
@@ -131,14 +143,19 @@ def login_google():
         redirect_uri = url_for('auth.google_callback', _external=True, _scheme='https')
         current_app.logger.warning(f"GOOGLE_REDIRECT_URI no configurada, usando fallback HTTPS: {redirect_uri}")
 
-    return oauth.google.authorize_redirect(redirect_uri)
+    return google.authorize_redirect(redirect_uri)
 
 @auth.route('/login/google/callback')
 def google_callback():
     try:
+        google = get_google_oauth()
+        if google is None:
+            flash('Error: Credenciales de Google OAuth no configuradas correctamente.')
+            return redirect(url_for('auth.login'))
+
         # Obtener token de acceso y datos del usuario
-        token = oauth.google.authorize_access_token()
-        user_info = oauth.google.get('userinfo').json()
+        token = google.authorize_access_token()
+        user_info = google.get('userinfo').json()
         
         # Verificar si el usuario ya existe por google_id
         user = User.query.filter_by(google_id=user_info['id']).first()
@@ -0,0 +1,15 @@
+# Backends de modelos de chat con una interfaz de streaming común
+
+from .base import LLMBackend, BackendRegistry, BackendUnavailableError
+from .fake import FakeBackend
+from .gemini import GeminiBackend
+from .groq import GroqBackend
+
+__all__ = [
+    'LLMBackend',
+    'BackendRegistry',
+    'BackendUnavailableError',
+    'FakeBackend',
+    'GeminiBackend',
+    'GroqBackend',
+]
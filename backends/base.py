@@ -0,0 +1,100 @@
+# Interfaz común de los backends de modelos de chat
+
+import logging
+
+logger = logging.getLogger('backends')
+
+
+class BackendUnavailableError(Exception):
+    """Se lanza cuando un backend no está configurado (p. ej. falta la API key)"""
+    pass
+
+
+class LLMBackend:
+    """
+    Backend de chat con respuesta en streaming.
+
+    Cada adaptador traduce el historial, el mensaje y las imágenes al formato de su
+    proveedor y devuelve el texto por fragmentos. El historial llega ya serializado
+    por HistoryLoader con la clave history_key del backend.
+
+    La interfaz es síncrona (generadores): con gevent cada llamada bloqueante cede el
+    control al resto de greenlets, igual que el resto de tareas en segundo plano.
+    """
+
+    name = 'base'
+    history_key = 'groq'
+
+    def is_available(self):
+        return True
+
+    def stream(self, history, message, images=None):
+        """
+        Genera la respuesta por fragmentos.
+
+        Args:
+            history: Historial serializado con history_key (ver HistoryLoader)
+            message: Mensaje de texto del usuario
+            images: Lista de referencias de AttachmentStore (opcional)
+
+        Yields:
+            str: Fragmentos de texto a medida que llegan
+        """
+        raise NotImplementedError
+
+    def complete(self, history, message, images=None):
+        """Devuelve la respuesta completa (consume el stream)"""
+        return "".join(self.stream(history, message, images=images))
+
+
+class BackendRegistry:
+    """
+    Resuelve el backend de cada tipo de modelo ('gemini', 'groq', ...).
+
+    Con override se sustituyen todos los backends registrados por el indicado
+    (p. ej. LLM_BACKEND=fake para medir el pipeline sin API keys). El backend de
+    sustitución conserva la history_key del tipo original, de modo que el historial
+    y sus presupuestos no cambian.
+    """
+
+    def __init__(self, override=None, factories=None):
+        """
+        Args:
+            override: Nombre del backend que sustituye a todos (o None)
+            factories: Dict nombre -> función(history_key) que crea ese backend
+        """
+        self.override = override
+        self.factories = factories or {}
+        self._backends = {}
+        self._overrides = {}
+        if override and override not in self.factories:
+            raise ValueError(f"Backend desconocido en LLM_BACKEND: {override}")
+
+    def register(self, model_type, backend):
+        self._backends[model_type] = backend
+
+    def __contains__(self, model_type):
+        return model_type in self._backends
+
+    def get(self, model_type):
+        backend = self._backends[model_type]
+        if not self.override:
+            return backend
+        replacement = self._overrides.get(model_type)
+        if replacement is None:
+            replacement = self.factories[self.override](backend.history_key)
+            self._overrides[model_type] = replacement
+            logger.info(f"Backend '{model_type}' sustituido por '{replacement.name}'")
+        return replacement
+
+    def stats(self):
+        return {
+            'override': self.override,
+            'backends': {
+                model_type: {
+                    'backend': self.get(model_type).name,
+                    'available': self.get(model_type).is_available(),
+                }
+                for model_type in self._backends
+            },
+        }
@@ -0,0 +1,55 @@
+# Backend local determinista para pruebas de carga sin API keys
+
+import hashlib
+import random
+import time
+
+from .base import LLMBackend
+
+WORDS = (
+    "el la los las un una de del en con por para que como más muy pero sobre "
+    "modelo respuesta datos sistema usuario mensaje texto tiempo ejemplo resultado "
+    "proceso servidor conversación imagen cliente petición valor prueba"
+).split()
+
+
+class FakeBackend(LLMBackend):
+    """
+    Genera una respuesta pseudoaleatoria pero determinista a partir del mensaje.
+
+    Simula la latencia de un proveedor real: espera first_chunk_ms antes del primer
+    fragmento y chunk_interval_ms entre fragmentos. Con gevent, time.sleep cede el
+    control, así que el coste por petición es el del pipeline (historial, emisiones,
+    base de datos) y no el del modelo.
+    """
+
+    name = 'fake'
+
+    def __init__(self, history_key='groq', chunks=60, first_chunk_ms=150, chunk_interval_ms=10,
+                 words_per_chunk=3):
+        """
+        Args:
+            history_key: Formato de historial que recibe (el del backend sustituido)
+            chunks: Número de fragmentos de la respuesta
+            first_chunk_ms: Latencia simulada hasta el primer fragmento
+            chunk_interval_ms: Latencia simulada entre fragmentos
+            words_per_chunk: Palabras por fragmento
+        """
+        self.history_key = history_key
+        self.chunks = chunks
+        self.first_chunk = first_chunk_ms / 1000.0
+        self.chunk_interval = chunk_interval_ms / 1000.0
+        self.words_per_chunk = words_per_chunk
+
+    def stream(self, history, message, images=None):
+        # La misma entrada (mensaje, longitud del historial, imágenes) da siempre la misma salida
+        seed = hashlib.sha256(f"{message}|{len(history)}|{len(images or [])}".encode('utf-8')).hexdigest()
+        rng = random.Random(seed)
+
+        if self.first_chunk:
+            time.sleep(self.first_chunk)
+        for index in range(self.chunks):
+            if index and self.chunk_interval:
+                time.sleep(self.chunk_interval)
+            words = [rng.choice(WORDS) for _ in range(self.words_per_chunk)]
+            yield ("" if index == 0 else " ") + " ".join(words)
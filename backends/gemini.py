@@ -0,0 +1,97 @@
+# Adaptador de Gemini (google.generativeai)
+
+import logging
+
+from .base import LLMBackend, BackendUnavailableError
+
+logger = logging.getLogger('backends.gemini')
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Chat con Gemini en streaming, con soporte de imágenes.
+
+    Las imágenes se preprocesan (prepare_image) y se leen del almacén de adjuntos
+    justo antes de enviarlas. Cada llamada ocupa una plaza del limitador 'gemini'
+    mientras dura el stream. El SDK usa gRPC, que no cede el control a gevent: con
+    executor, la llamada y la lectura de cada fragmento se hacen en un hilo nativo.
+    """
+
+    name = 'gemini'
+    history_key = 'gemini'
+    default_image_prompt = "Describe lo que ves en esta imagen"
+
+    def __init__(self, get_model, upstream, read_attachment, prepare_image=None, executor=None):
+        """
+        Args:
+            get_model: Función sin argumentos que devuelve el GenerativeModel (o None)
+            upstream: UpstreamClients con el limitador y los timeouts por llamada
+            read_attachment: Función referencia -> bytes de la imagen
+            prepare_image: Función referencia -> referencia preprocesada (opcional)
+            executor: BlockingExecutor para las llamadas al SDK (opcional; si no, en el greenlet)
+        """
+        self.get_model = get_model
+        self.upstream = upstream
+        self.read_attachment = read_attachment
+        self.prepare_image = prepare_image
+        self.executor = executor
+
+    def is_available(self):
+        return self.get_model() is not None
+
+    def _build_parts(self, message, images):
+        parts = []
+        if message:
+            parts.append({"text": message})
+        if images:
+            for img in images:
+                if self.prepare_image:
+                    img = self.prepare_image(img)
+                parts.append({
+                    "inline_data": {
+                        "mime_type": img['mime_type'],
+                        "data": self.read_attachment(img)
+                    }
+                })
+            # Si no hay mensaje de texto pero hay imágenes, agregar un prompt por defecto
+            if not message:
+                parts.append({"text": self.default_image_prompt})
+        return parts
+
+    def stream(self, history, message, images=None):
+        model = self.get_model()
+        if model is None:
+            raise BackendUnavailableError("Gemini model not initialized.")
+
+        logger.info(f"Generando respuesta con Gemini (streaming). Mensaje: {message[:50]}{'...' if len(message) > 50 else ''}")
+        logger.info(f"Imágenes adjuntas: {len(images) if images else 0}")
+
+        chat = model.start_chat(history=history)
+        parts = self._build_parts(message, images)
+        response = None
+
+        def start_stream():
+            nonlocal response
+            # El timeout aplica a cada llamada; la plaza se mantiene mientras dura el stream
+            request_options = self.upstream.gemini_request_options()
+            if self.executor is None:
+                response = chat.send_message(parts, stream=True, request_options=request_options)
+                return response
+            response = self.executor.call(chat.send_message, parts, stream=True, request_options=request_options)
+            return self.executor.iterate(response)
+
+        received_text = False
+        for chunk in self.upstream.limiter('gemini').wrap_stream(start_stream):
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                # Fragmentos sin texto (p. ej. solo finish_reason o bloqueos de seguridad)
+                logger.debug(f"Fragmento de Gemini sin texto: {chunk}")
+                continue
+            if chunk_text:
+                received_text = True
+                yield chunk_text
+
+        if not received_text:
+            prompt_feedback = getattr(response, 'prompt_feedback', None)
+            raise Exception(f"Gemini no devolvió texto en la respuesta. {prompt_feedback or ''}".strip())
@@ -0,0 +1,64 @@
+# Adaptador de Groq (API compatible con OpenAI)
+
+import json
+import logging
+
+from .base import LLMBackend, BackendUnavailableError
+
+logger = logging.getLogger('backends.groq')
+
+
+class GroqBackend(LLMBackend):
+    """
+    Chat con Groq en streaming.
+
+    El modelo es solo de texto: si el usuario adjunta imágenes se añade una nota al
+    mensaje. Cada llamada ocupa una plaza del limitador 'groq' mientras dura el stream.
+    """
+
+    name = 'groq'
+    history_key = 'groq'
+    image_note = "\n[Nota: El usuario adjuntó imágenes. No puedo verlas directamente.]"
+
+    def __init__(self, upstream, model_name="meta-llama/llama-4-maverick-17b-128e-instruct",
+                 temperature=0.7, max_tokens=2048):
+        """
+        Args:
+            upstream: UpstreamClients con el cliente Groq compartido y su limitador
+            model_name: Modelo de Groq a usar
+            temperature: Temperatura de muestreo
+            max_tokens: Tokens máximos de la respuesta
+        """
+        self.upstream = upstream
+        self.model_name = model_name
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def is_available(self):
+        return self.upstream.groq is not None
+
+    def stream(self, history, message, images=None):
+        client = self.upstream.groq
+        if client is None:
+            raise BackendUnavailableError("Groq API key not configured.")
+
+        user_content = message
+        if images:
+            user_content += self.image_note
+
+        request_params = {
+            "model": self.model_name,
+            "messages": history + [{"role": "user", "content": user_content}],
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "stream": True
+        }
+        logger.debug(f"Groq Chat Request: {json.dumps(request_params)}")
+
+        chunk_counter = 0
+        # La plaza se mantiene hasta consumir el stream completo
+        for chunk in self.upstream.limiter('groq').wrap_stream(lambda: client.chat.completions.create(**request_params)):
+            chunk_counter += 1
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+        logger.info(f"Groq stream finished. Total chunks processed: {chunk_counter}")
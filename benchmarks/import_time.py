@@ -0,0 +1,159 @@
+"""
+Tiempo de importación de la aplicación con python -X importtime.
+
+Importa el módulo indicado (app por defecto) en un proceso nuevo, con una base de
+datos SQLite temporal y el backend local (LLM_BACKEND=fake), varias veces, y muestra
+la mediana del tiempo total, los imports directos que más tardan y lo que cuesta
+después importar los SDK de los proveedores (providers.import_modules(), lo que
+hace el maestro de gunicorn con PROVIDER_WARMUP=preload).
+
+Comprueba además que importar la aplicación no importa los SDK pesados (se cargan
+en su primer uso, ver providers.py): sale con código 1 si alguno aparece o si la
+mediana supera --max-ms, para usarlo como comprobación en CI.
+
+Uso:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --runs 7 --top 15 --json import_time.json
+    python benchmarks/import_time.py --module wsgi --max-ms 1500
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Módulos que no deben importarse al cargar la aplicación
+DEFERRED_MODULES = ('google.generativeai', 'groq', 'authlib', 'PIL.Image')
+
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+CHILD = '''
+import json, time
+started = time.perf_counter()
+import {module} as target
+imported = time.perf_counter()
+from app import providers
+providers.import_modules()
+sdks = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - started) * 1000, 'sdk_ms': (sdks - imported) * 1000}}))
+'''
+
+
+def parse_importtime(stderr, module):
+    """
+    Lee la salida de -X importtime hasta que termina de importarse module.
+
+    Returns:
+        list: (nombre, profundidad, propio_us, acumulado_us) en el orden de la salida
+    """
+    entries = []
+    for line in stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = (len(indent) - 1) // 2
+        entries.append((name, depth, int(self_us), int(cumulative_us)))
+        if name == module and depth == 0:
+            break
+    return entries
+
+
+def run_once(module, env):
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD.format(module=module)],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"La importación de {module} falló:\n{proc.stderr[-2000:]}")
+    timings = json.loads(proc.stdout.strip().splitlines()[-1])
+    return parse_importtime(proc.stderr, module), timings
+
+
+def bench_env(workdir):
+    env = dict(os.environ)
+    env.update({
+        'LLM_BACKEND': 'fake',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        'SECRET_KEY': 'import-time-benchmark',
+        # Claves ficticias: todos los proveedores habilitados (importarlos no llama a las APIs)
+        'GOOGLE_API_KEY': 'benchmark',
+        'GROQ_API_KEY': 'benchmark',
+    })
+    return env
+
+
+def loaded_deferred(entries):
+    names = {name for name, _, _, _ in entries}
+    return sorted(
+        module for module in DEFERRED_MODULES
+        if any(name == module or name.startswith(f'{module}.') for name in names)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tiempo de importación de la aplicación (python -X importtime)')
+    parser.add_argument('--module', default='app', help="Módulo a importar ('app' o 'wsgi')")
+    parser.add_argument('--runs', type=int, default=5, help='Importaciones medidas (tras una de calentamiento)')
+    parser.add_argument('--top', type=int, default=10, help='Imports directos más lentos a mostrar')
+    parser.add_argument('--max-ms', type=float, help='Fallar si la mediana del tiempo total supera estos ms')
+    parser.add_argument('--json', help='Guardar los resultados en este fichero JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='import-time-')
+    try:
+        env = bench_env(workdir)
+        # Calentamiento: compila los .pyc y llena la caché de disco
+        run_once(args.module, env)
+        runs = [run_once(args.module, env) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import_ms = statistics.median(timings['import_ms'] for _, timings in runs)
+    sdk_ms = statistics.median(timings['sdk_ms'] for _, timings in runs)
+    entries = runs[-1][0]
+    direct = {}
+    for run_entries, _ in runs:
+        for name, depth, _, cumulative_us in run_entries:
+            if depth == 1:
+                direct.setdefault(name, []).append(cumulative_us / 1000)
+    slowest = sorted(((name, statistics.median(values)) for name, values in direct.items()),
+                     key=lambda item: item[1], reverse=True)[:args.top]
+    deferred = loaded_deferred(entries)
+
+    print(f"import {args.module}: {import_ms:.0f}ms (mediana de {args.runs})")
+    print(f"SDK de proveedores después: {sdk_ms:.0f}ms")
+    print("Imports directos más lentos (acumulado, ms):")
+    for name, ms in slowest:
+        print(f"  {ms:8.1f}  {name}")
+    if deferred:
+        print(f"ERROR: SDK importados al cargar {args.module}: {', '.join(deferred)}")
+
+    report = {
+        'module': args.module,
+        'runs': args.runs,
+        'import_ms': round(import_ms, 1),
+        'sdk_ms': round(sdk_ms, 1),
+        'slowest_imports_ms': {name: round(ms, 1) for name, ms in slowest},
+        'deferred_loaded': deferred,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    over_budget = args.max_ms is not None and import_ms > args.max_ms
+    if over_budget:
+        print(f"ERROR: {import_ms:.0f}ms supera el máximo de {args.max_ms:.0f}ms")
+    if deferred or over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,396 @@
+"""
+Prueba de carga offline de POST /chat y del streaming por Socket.IO.
+
+Arranca gunicorn con gunicorn_config.py (worker gevent) usando el backend local
+determinista (LLM_BACKEND=fake) y una base de datos SQLite temporal, de modo que no
+se necesitan API keys ni se toca instance/db.sqlite. Cada usuario simulado se
+registra, inicia sesión, abre una conexión Socket.IO, crea una conversación y envía
+varios mensajes de uno en uno, esperando 'message_progress' y el 'message' final.
+
+Resultados: percentiles p50/p95/p99 del tiempo hasta el primer fragmento (TTFC) y de
+la latencia total, emisiones por segundo y pico de RSS (VmHWM) del worker.
+
+Uso:
+    python benchmarks/load_chat.py --users 20 --messages 5
+    python benchmarks/load_chat.py --users 50 --json bench_output.json
+    python benchmarks/load_chat.py --url http://127.0.0.1:8000   # servidor ya arrancado
+
+La latencia del backend falso se ajusta con FAKE_BACKEND_CHUNKS,
+FAKE_BACKEND_FIRST_CHUNK_MS y FAKE_BACKEND_CHUNK_INTERVAL_MS; el resto de variables
+de entorno (JOB_LIMIT_*, STREAM_FLUSH_*, ...) se pasan tal cual al servidor.
+"""
+
+import argparse
+import json
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    """Percentil con interpolación lineal (values no tiene por qué estar ordenado)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_env(workdir):
+    env = dict(os.environ)
+    env.update({
+        'LLM_BACKEND': 'fake',
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.sqlite')}",
+        'SECRET_KEY': 'load-chat-benchmark',
+        # Claves vacías: ninguna llamada real a proveedores (p. ej. generación de títulos)
+        'GOOGLE_API_KEY': '',
+        'GROQ_API_KEY': '',
+    })
+    return env
+
+
+def log_tail(path, lines=20):
+    try:
+        with open(path) as f:
+            return ''.join(f.readlines()[-lines:])
+    except OSError:
+        return ''
+
+
+def boot_server(args, workdir):
+    """Crea las tablas y arranca gunicorn; devuelve (proceso, url)"""
+    env = server_env(workdir)
+    subprocess.run(
+        [sys.executable, '-c',
+         'from app import app\n'
+         'from models import db, ensure_indexes\n'
+         'with app.app_context():\n'
+         '    db.create_all()\n'
+         '    ensure_indexes(db.engine)\n'],
+        cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    port = args.port or free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_config.py',
+           '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', '--access-logfile', os.devnull]
+    if not args.keep_max_requests:
+        # max_requests reinicia el worker a mitad de la prueba y corta los streams
+        cmd += ['--max-requests', '0']
+    cmd.append('wsgi:app')
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + args.boot_timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn terminó al arrancar:\n{log_tail(log.name)}")
+        try:
+            if requests.get(f'{url}/login', timeout=1).status_code == 200:
+                return proc, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"gunicorn no respondió en {args.boot_timeout}s:\n{log_tail(log.name)}")
+
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def read_status_kb(pid, field):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Muestrea VmHWM/VmRSS de los workers de gunicorn (hijos del proceso maestro)"""
+
+    def __init__(self, master_pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_kb = {}
+        self._stop = threading.Event()
+
+    def sample(self):
+        for pid in child_pids(self.master_pid):
+            hwm = read_status_kb(pid, 'VmHWM') or read_status_kb(pid, 'VmRSS')
+            if hwm:
+                self.peak_kb[pid] = max(self.peak_kb.get(pid, 0), hwm)
+
+    def run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self.sample()
+        self._stop.set()
+
+
+class SimulatedUser:
+    """Un usuario: registro, login, Socket.IO, una conversación y N mensajes seguidos"""
+
+    def __init__(self, url, index, args, results):
+        self.url = url
+        self.index = index
+        self.args = args
+        self.results = results
+        self.events = queue.Queue()
+        self.conversation_id = None
+
+    def register_and_login(self):
+        name = f'bench-{uuid.uuid4().hex[:10]}'
+        email = f'{name}@bench.local'
+        password = 'benchmark'
+        requests.post(f'{self.url}/register', data={'email': email, 'username': name, 'password': password}, timeout=10)
+
+        http = requests.Session()
+        response = http.post(f'{self.url}/login', data={'email': email, 'password': password}, timeout=10)
+        response.raise_for_status()
+        if 'session' not in http.cookies and 'remember_token' not in http.cookies:
+            raise RuntimeError('login sin cookie de sesión')
+        return http
+
+    def on_progress(self, data):
+        self.results.count_frame()
+        if data.get('conversation_id') == self.conversation_id:
+            self.events.put(('progress', time.perf_counter()))
+
+    def on_message(self, data):
+        self.results.count_frame()
+        if data.get('conversation_id') == self.conversation_id and data.get('role') == 'assistant' and data.get('done'):
+            self.events.put(('done', time.perf_counter()))
+
+    def send(self, http, text):
+        started = time.perf_counter()
+        response = http.post(f'{self.url}/chat', data={
+            'message': text,
+            'model': self.args.model,
+            'conversation_id': self.conversation_id,
+            'web_search': 'false',
+        }, timeout=30)
+        if response.status_code == 429:
+            self.results.record_rejected()
+            return
+        response.raise_for_status()
+
+        first_chunk = None
+        emits = 0
+        deadline = started + self.args.message_timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.results.record_timeout()
+                return
+            try:
+                kind, at = self.events.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            emits += 1
+            if kind == 'progress' and first_chunk is None:
+                first_chunk = at - started
+            if kind == 'done':
+                self.results.record(first_chunk, at - started, emits)
+                return
+
+    def run(self):
+        try:
+            http = self.register_and_login()
+            sio = socketio.Client(http_session=http, reconnection=False)
+            sio.on('message_progress', self.on_progress)
+            sio.on('message', self.on_message)
+            sio.connect(self.url, wait_timeout=10)
+            try:
+                created = http.post(f'{self.url}/api/conversations', timeout=10)
+                created.raise_for_status()
+                self.conversation_id = created.json()['id']
+                for n in range(self.args.messages):
+                    self.send(http, f'Usuario {self.index}, mensaje {n}: cuéntame algo sobre el rendimiento')
+            finally:
+                sio.disconnect()
+        except Exception as e:
+            self.results.record_error(f'usuario {self.index}: {e}')
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ttfc = []
+        self.total = []
+        self.own_emits = 0
+        self.frames = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = []
+
+    def count_frame(self):
+        with self._lock:
+            self.frames += 1
+
+    def record(self, ttfc, total, emits):
+        with self._lock:
+            if ttfc is not None:
+                self.ttfc.append(ttfc * 1000)
+            self.total.append(total * 1000)
+            self.own_emits += emits
+
+    def record_rejected(self):
+        with self._lock:
+            self.rejected += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def record_error(self, error):
+        with self._lock:
+            self.errors.append(error)
+
+
+def run_benchmark(args, url, master_pid=None):
+    results = Results()
+    sampler = RssSampler(master_pid) if master_pid else None
+    if sampler:
+        sampler.start()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as executor:
+        for index in range(args.users):
+            executor.submit(SimulatedUser(url, index, args, results).run)
+            if args.ramp:
+                time.sleep(args.ramp / args.users)
+    elapsed = time.perf_counter() - started
+
+    if sampler:
+        sampler.stop()
+
+    report = {
+        'users': args.users,
+        'messages_per_user': args.messages,
+        'model': args.model,
+        'elapsed_s': round(elapsed, 3),
+        'completed': len(results.total),
+        'rejected_429': results.rejected,
+        'timeouts': results.timeouts,
+        'errors': len(results.errors),
+        'ttfc_ms': summarize(results.ttfc),
+        'total_ms': summarize(results.total),
+        'messages_per_s': round(len(results.total) / elapsed, 2),
+        # Emisiones propias (progreso + final) y tramas recibidas por todos los clientes
+        'emits_per_s': round(results.own_emits / elapsed, 2),
+        'frames_received_per_s': round(results.frames / elapsed, 2),
+        'peak_rss_mb': round(max(sampler.peak_kb.values()) / 1024, 1) if sampler and sampler.peak_kb else None,
+        'fake_backend': {
+            key: os.environ.get(key)
+            for key in ('FAKE_BACKEND_CHUNKS', 'FAKE_BACKEND_FIRST_CHUNK_MS', 'FAKE_BACKEND_CHUNK_INTERVAL_MS')
+            if os.environ.get(key)
+        },
+    }
+    return report, results.errors
+
+
+def print_report(report, errors):
+    def fmt(stats):
+        if not stats['count']:
+            return 'sin datos'
+        return '  '.join(f"{key}={stats[key]:.1f}" for key in ('p50', 'p95', 'p99', 'max'))
+
+    print(f"Usuarios: {report['users']}  Mensajes/usuario: {report['messages_per_user']}  Modelo: {report['model']}")
+    print(f"Duración: {report['elapsed_s']}s  Completados: {report['completed']}  429: {report['rejected_429']}  "
+          f"Timeouts: {report['timeouts']}  Errores: {report['errors']}")
+    print(f"TTFC (ms):  {fmt(report['ttfc_ms'])}")
+    print(f"Total (ms): {fmt(report['total_ms'])}")
+    print(f"Mensajes/s: {report['messages_per_s']}  Emisiones/s: {report['emits_per_s']}  "
+          f"Tramas recibidas/s: {report['frames_received_per_s']}")
+    if report['peak_rss_mb'] is not None:
+        print(f"Pico RSS del worker: {report['peak_rss_mb']} MB")
+    for error in errors[:10]:
+        print(f"  error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga offline de /chat y Socket.IO')
+    parser.add_argument('--users', type=int, default=10, help='Usuarios simultáneos')
+    parser.add_argument('--messages', type=int, default=3, help='Mensajes por usuario')
+    parser.add_argument('--model', default='gemini', help="Tipo de modelo enviado a /chat ('gemini' o 'groq')")
+    parser.add_argument('--ramp', type=float, default=0.0, help='Segundos para arrancar todos los usuarios')
+    parser.add_argument('--message-timeout', type=float, default=60.0, help='Segundos máximos por mensaje')
+    parser.add_argument('--url', help='Usar un servidor ya arrancado (con LLM_BACKEND=fake) en lugar de lanzar gunicorn')
+    parser.add_argument('--port', type=int, help='Puerto para gunicorn (por defecto uno libre)')
+    parser.add_argument('--boot-timeout', type=float, default=30.0, help='Segundos máximos para arrancar gunicorn')
+    parser.add_argument('--keep-max-requests', action='store_true',
+                        help='Respetar max_requests de gunicorn_config.py (reinicia el worker durante la prueba)')
+    parser.add_argument('--json', help='Guardar los resultados en este fichero JSON')
+    args = parser.parse_args()
+
+    workdir = None
+    server = None
+    try:
+        if args.url:
+            url = args.url.rstrip('/')
+        else:
+            workdir = tempfile.mkdtemp(prefix='load-chat-')
+            server, url = boot_server(args, workdir)
+        report, errors = run_benchmark(args, url, master_pid=server.pid if server else None)
+    finally:
+        if server:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report, errors)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Llamadas bloqueantes fuera del bucle de gevent (SDK con gRPC, trabajo de PIL) y
+# medición del tiempo que el bucle pasa bloqueado
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('blocking')
+
+
+def _gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+class BlockingExecutor:
+    """
+    Ejecuta llamadas que no ceden el control a gevent en un pool de hilos nativos.
+
+    El SDK de Gemini usa gRPC, que no pasa por los sockets parcheados, y PIL ocupa la
+    CPU sin soltar el hilo: ejecutados en un greenlet congelan todos los websockets
+    del worker. Con call() el greenlet espera el resultado de forma cooperativa
+    mientras la llamada corre en el gevent.threadpool.ThreadPool del proceso.
+
+    El pool se crea en el primer uso de cada proceso (después del fork de gunicorn y
+    del monkey patching). Sin gevent (scripts, pruebas) las llamadas se ejecutan en
+    el mismo hilo.
+
+    Uso:
+        response = executor.call(model.generate_content, prompt)
+
+        for chunk in executor.iterate(chat.send_message(parts, stream=True)):
+            ...
+    """
+
+    def __init__(self, name, size):
+        """
+        Args:
+            name: Nombre del pool (para logs y estadísticas)
+            size: Número máximo de hilos nativos
+        """
+        self.name = name
+        self.size = size
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    def _get_pool(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._pool = None
+                    if _gevent_patched():
+                        from gevent.threadpool import ThreadPool
+                        self._pool = ThreadPool(self.size)
+                        logger.info(f"Pool de hilos {self.name} ({self.size} hilos) creado en el proceso {pid}")
+                    self._pid = pid
+        return self._pool
+
+    def _started(self):
+        self.calls += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return time.monotonic()
+
+    def _finished(self, started, failed):
+        self.in_flight -= 1
+        self.total_seconds += time.monotonic() - started
+        if failed:
+            self.errors += 1
+
+    def call(self, fn, *args, **kwargs):
+        """Ejecuta fn en el pool y espera su resultado (las excepciones se propagan)"""
+        pool = self._get_pool()
+        started = self._started()
+        failed = True
+        try:
+            # Nota: ThreadPool define __len__, así que se compara con None explícitamente
+            result = pool.apply(fn, args, kwargs) if pool is not None else fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            self._finished(started, failed)
+
+    def spawn(self, fn, *args):
+        """Ejecuta fn en el pool sin esperar al resultado (sin gevent, en el mismo hilo)"""
+        pool = self._get_pool()
+        if pool is None:
+            return self.call(fn, *args)
+        started = self._started()
+        result = pool.spawn(fn, *args)
+        # rawlink se ejecuta en el hub: los contadores solo se tocan desde el hilo de gevent
+        result.rawlink(lambda done: self._finished(started, not done.successful()))
+        return result
+
+    def iterate(self, iterable):
+        """
+        Recorre un iterable bloqueante (p. ej. un stream de gRPC) pidiendo cada
+        elemento en el pool.
+        """
+        iterator = self.call(iter, iterable)
+        done = object()
+        while True:
+            item = self.call(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'calls': self.calls,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'errors': self.errors,
+            'avg_ms': round(self.total_seconds / self.calls * 1000, 2) if self.calls else 0.0,
+        }
+
+
+class LoopLagMonitor:
+    """
+    Mide cuánto tarda el bucle de gevent en despertar a un greenlet dormido.
+
+    Un greenlet duerme interval_ms en bucle; si despierta más tarde de lo previsto,
+    el retraso es el tiempo que otro código tuvo el hub bloqueado. Cada medida se
+    pasa a observe (histograma de /metrics) y los retrasos por encima de
+    threshold_ms se registran como aviso.
+    """
+
+    def __init__(self, spawn, sleep, threshold_ms=100, interval_ms=100, observe=None):
+        """
+        Args:
+            spawn: Función para lanzar el bucle en segundo plano (socketio.start_background_task)
+            sleep: Espera cooperativa (socketio.sleep)
+            threshold_ms: Retraso a partir del que se considera que el bucle estuvo bloqueado
+            interval_ms: Periodo de medida
+            observe: Función (segundos de retraso) llamada en cada medida (opcional)
+        """
+        self.spawn = spawn
+        self.sleep = sleep
+        self.threshold = threshold_ms / 1000.0
+        self.interval = interval_ms / 1000.0
+        self.observe = observe
+        self._pid = None
+        self.samples = 0
+        self.blocked = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        """Lanza la medición una vez por proceso (solo con gevent)"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        if not _gevent_patched():
+            return
+        self.spawn(self._loop)
+        logger.info(f"Monitor del bucle de gevent iniciado en el proceso {self._pid} (umbral {self.threshold * 1000:.0f}ms)")
+
+    def _loop(self):
+        while self._pid == os.getpid():
+            started = time.monotonic()
+            self.sleep(self.interval)
+            self.record(time.monotonic() - started - self.interval)
+
+    def record(self, lag):
+        lag = max(lag, 0.0)
+        self.samples += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        if self.observe:
+            self.observe(lag)
+        if lag >= self.threshold:
+            self.blocked += 1
+            logger.warning(f"Bucle de gevent bloqueado {lag * 1000:.0f}ms (umbral {self.threshold * 1000:.0f}ms)")
+
+    def stats(self):
+        return {
+            'threshold_ms': round(self.threshold * 1000, 1),
+            'samples': self.samples,
+            'blocked': self.blocked,
+            'last_lag_ms': round(self.last_lag * 1000, 2),
+            'max_lag_ms': round(self.max_lag * 1000, 2),
+        }
@@ -0,0 +1,337 @@
+# Configuración de los motores de base de datos (pools de PostgreSQL y perfil de SQLite)
+
+import logging
+import os
+import threading
+import time
+
+import sqlalchemy as sa
+from flask_sqlalchemy.session import Session
+
+logger = logging.getLogger('database_config')
+
+# Bind con la única conexión de escritura de SQLite
+SQLITE_WRITER_BIND = 'sqlite_writer'
+
+# Pragmas del perfil 'tuned': WAL permite lectores concurrentes con un escritor y
+# synchronous=NORMAL evita un fsync por commit (en WAL sigue siendo seguro ante caídas
+# del proceso; solo una caída del sistema puede perder las últimas transacciones)
+SQLITE_TUNED_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,  # Negativo: tamaño en KiB (~20MB por conexión)
+    'temp_store': 'MEMORY',
+}
+
+SQLITE_PROFILES = ('default', 'tuned')
+
+
+class PoolMonitor:
+    """
+    Mide cuánto espera cada checkout de conexión en un pool.
+
+    Una espera por encima de slow_wait_ms se registra como aviso junto con el estado
+    del pool, y un timeout (pool agotado) como error: así el agotamiento del pool se
+    ve en los logs y en /metrics en lugar de aparecer como bloqueos sin explicación.
+    """
+
+    def __init__(self, name, observe=None, slow_wait_ms=100):
+        """
+        Args:
+            name: Nombre del motor ('default', 'sqlite_writer', ...)
+            observe: Función (segundos) -> None para registrar cada espera (histograma)
+            slow_wait_ms: Espera (ms) a partir de la cual se registra un aviso
+        """
+        self.name = name
+        self.observe = observe
+        self.slow_wait = slow_wait_ms / 1000.0
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.slow_waits = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, pool, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            slow = seconds >= self.slow_wait
+            if slow:
+                self.slow_waits += 1
+        if self.observe:
+            self.observe(seconds)
+        if slow:
+            logger.warning(f"Pool {self.name}: {seconds * 1000:.0f}ms esperando conexión ({pool.status()})")
+
+    def record_timeout(self, pool, seconds):
+        with self._lock:
+            self.timeouts += 1
+        if self.observe:
+            self.observe(seconds)
+        logger.error(f"Pool {self.name} agotado: sin conexión tras {seconds:.1f}s ({pool.status()})")
+
+    def stats(self):
+        return {
+            'checkouts': self.checkouts,
+            'avg_wait_ms': round(self.total_wait / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+            'slow_waits': self.slow_waits,
+            'timeouts': self.timeouts,
+        }
+
+
+def instrumented_pool_class(monitor):
+    """QueuePool que informa al monitor del tiempo de espera de cada checkout"""
+    class InstrumentedQueuePool(sa.pool.QueuePool):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except sa.exc.TimeoutError:
+                monitor.record_timeout(self, time.perf_counter() - started)
+                raise
+            monitor.record_wait(self, time.perf_counter() - started)
+            return connection
+
+    return InstrumentedQueuePool
+
+
+def pool_status(engine):
+    """Estado actual del pool de un motor (solo pools con cola)"""
+    pool = engine.pool
+    if not isinstance(pool, sa.pool.QueuePool):
+        return None
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+        'idle': pool.checkedin(),
+    }
+
+
+def configure_postgres(app, uri, pool_size=5, max_overflow=5, pool_timeout=5, pool_recycle=1800,
+                       pre_ping=True, monitor=None):
+    """
+    Configura el pool de conexiones de PostgreSQL (antes de db.init_app).
+
+    Args:
+        app: Aplicación Flask
+        uri: URI de PostgreSQL
+        pool_size: Conexiones que se mantienen abiertas
+        max_overflow: Conexiones extra permitidas en picos
+        pool_timeout: Segundos máximos esperando una conexión libre antes de fallar
+        pool_recycle: Segundos tras los que una conexión se reabre (cortes del proxy de Render)
+        pre_ping: Comprobar la conexión antes de usarla
+        monitor: PoolMonitor para medir las esperas (opcional)
+    """
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    options = {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+        'pool_pre_ping': pre_ping,
+    }
+    if monitor is not None:
+        options['poolclass'] = instrumented_pool_class(monitor)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def release_connection(db):
+    """
+    Termina la transacción de la sesión actual para devolver su conexión al pool.
+
+    Las tareas en segundo plano deben llamarla antes de esperas largas (streaming del
+    modelo, llamadas a proveedores): si no, la transacción abierta por la última
+    consulta retiene la conexión durante toda la espera, y con varias tareas a la vez
+    el pool se agota. Los objetos cargados siguen en la sesión y se recargan al
+    acceder a ellos; la siguiente consulta toma otra conexión.
+    """
+    db.session.commit()
+
+
+def is_sqlite(uri):
+    return sa.engine.make_url(uri).get_backend_name() == 'sqlite'
+
+
+def sqlite_pragmas(busy_timeout_ms=None, mmap_size=None, cache_size_kb=None):
+    """Pragmas del perfil 'tuned' con los valores configurables sustituidos"""
+    pragmas = dict(SQLITE_TUNED_PRAGMAS)
+    if busy_timeout_ms is not None:
+        pragmas['busy_timeout'] = busy_timeout_ms
+    if mmap_size is not None:
+        pragmas['mmap_size'] = mmap_size
+    if cache_size_kb is not None:
+        pragmas['cache_size'] = -abs(cache_size_kb)
+    return pragmas
+
+
+def configure_sqlite(app, uri, profile='tuned', readers=4, busy_timeout_ms=5000, monitors=None):
+    """
+    Prepara la configuración de Flask-SQLAlchemy para SQLite según el perfil.
+
+    Con 'tuned' el motor por defecto es un pool de `readers` conexiones de lectura y el
+    bind SQLITE_WRITER_BIND tiene una única conexión por la que pasan todas las
+    escrituras (ver RoutingSession). Con 'default' no se cambia nada. Debe llamarse
+    antes de db.init_app(app); después hay que llamar a install_sqlite_pragmas.
+
+    Args:
+        app: Aplicación Flask
+        uri: URI de la base de datos SQLite
+        profile: 'tuned' o 'default'
+        readers: Tamaño del pool de lectura
+        busy_timeout_ms: Espera máxima (ms) por el bloqueo de escritura de SQLite
+        monitors: Dict nombre de motor ('default', SQLITE_WRITER_BIND) -> PoolMonitor (opcional)
+    """
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"SQLITE_PROFILE desconocido: {profile} (opciones: {', '.join(SQLITE_PROFILES)})")
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    if profile == 'default':
+        return
+
+    connect_args = {
+        'timeout': busy_timeout_ms / 1000.0,
+        # Las conexiones se comparten entre greenlets/hilos a través del pool
+        'check_same_thread': False,
+    }
+    monitors = monitors or {}
+
+    def pool_class(name):
+        monitor = monitors.get(name)
+        return instrumented_pool_class(monitor) if monitor else sa.pool.QueuePool
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': pool_class('default'),
+        'pool_size': readers,
+        'max_overflow': 0,
+        'pool_timeout': busy_timeout_ms / 1000.0,
+        'connect_args': connect_args,
+    }
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[SQLITE_WRITER_BIND] = {
+        'url': uri,
+        'poolclass': pool_class(SQLITE_WRITER_BIND),
+        'pool_size': 1,
+        'max_overflow': 0,
+        # Esperar la conexión de escritura es esperar el turno de escribir
+        'pool_timeout': busy_timeout_ms / 1000.0 * 2,
+        'connect_args': dict(connect_args),
+    }
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.config['SQLITE_PROFILE'] = profile
+
+
+def install_sqlite_pragmas(app, db, pragmas):
+    """Aplica los pragmas a cada conexión nueva de los motores SQLite de la aplicación"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                sa.event.listen(engine, 'connect', set_pragmas)
+
+
+def get_write_engine(db):
+    """Motor por el que deben ir las escrituras (la conexión única de SQLite si existe)"""
+    return db.engines.get(SQLITE_WRITER_BIND) or db.engine
+
+
+class RoutingSession(Session):
+    """
+    Sesión que envía las escrituras al bind de escritura de SQLite y las lecturas al pool.
+
+    Las operaciones de flush y las sentencias INSERT/UPDATE/DELETE van siempre a la
+    conexión de escritura. Una vez que la transacción ha escrito, el resto de la
+    transacción también la usa, para leer sus propios cambios aún sin confirmar.
+    Sin el bind de escritura (Postgres o perfil 'default') se comporta como la sesión
+    normal de Flask-SQLAlchemy.
+    """
+
+    _use_writer = False
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            writer = self._db.engines.get(SQLITE_WRITER_BIND)
+            if writer is not None:
+                if self._use_writer or self._flushing or getattr(clause, 'is_dml', False):
+                    self._use_writer = True
+                    return writer
+                return self._db.engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._use_writer = False
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._use_writer = False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._use_writer = False
+
+
+def drop_invalid_indexes(connection, names):
+    """
+    Borra los índices de PostgreSQL que quedaron inválidos.
+
+    Si un CREATE INDEX CONCURRENTLY se interrumpe (el proceso muere o se cancela) el
+    índice queda marcado como inválido: las consultas no lo usan, pero existe, y
+    CREATE INDEX IF NOT EXISTS ya no lo volvería a construir.
+
+    Args:
+        connection: Conexión en modo AUTOCOMMIT (DROP INDEX CONCURRENTLY no admite transacción)
+        names: Nombres de los índices a comprobar
+
+    Returns:
+        list: Nombres de los índices borrados
+    """
+    if not names:
+        return []
+    statement = sa.text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid) AND c.relname IN :names"
+    ).bindparams(sa.bindparam('names', expanding=True))
+    invalid = connection.execute(statement, {'names': list(names)}).scalars().all()
+    for name in invalid:
+        logger.warning(f"Índice {name} inválido (construcción interrumpida): se borra para crearlo de nuevo")
+        connection.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+    return invalid
+
+
+_pools_pid = None
+
+
+def recreate_pools_after_fork(app, db):
+    """
+    Recrea los pools de conexiones una vez por proceso.
+
+    Con preload_app los motores se crean en el proceso maestro antes del monkey
+    patching de gevent: sus colas usarían locks del sistema, y un greenlet esperando
+    conexión bloquearía el worker entero. dispose(close=False) crea pools nuevos (ya
+    parcheados) sin cerrar las conexiones del maestro.
+    """
+    global _pools_pid
+    if _pools_pid == os.getpid():
+        return
+    _pools_pid = os.getpid()
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
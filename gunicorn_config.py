@@ -49,4 +49,36 @@ def post_fork(server, worker):
     import resource
     # Limitar el uso de memoria a 450MB (plan gratuito de Render tiene 512MB)
     # 450MB en bytes = 450 * 1024 * 1024
-    resource.setrlimit(resource.RLIMIT_AS, (450 * 1024 * 1024, 500 * 1024 * 1024))
\ No newline at end of file
+    resource.setrlimit(resource.RLIMIT_AS, (450 * 1024 * 1024, 500 * 1024 * 1024))
+
+def when_ready(server):
+    # Con preload_app la aplicación ya está cargada en el maestro. Sin preload_app el
+    # esquema se prepara con 'flask --app app init-db' antes de arrancar gunicorn
+    if not server.cfg.preload_app:
+        return
+    from app import providers, prepare_database, PROVIDER_WARMUP, DB_PREPARE_ON_START
+    # Tablas e índices que falten, una sola vez y antes de que los workers atiendan
+    # peticiones (una base de datos antigua no tiene los índices compuestos)
+    if DB_PREPARE_ON_START:
+        prepare_database()
+    # Importar aquí los SDK de los proveedores para que cada worker (también los que
+    # reinicia max_requests) los herede ya importados del fork en lugar de importarlos de nuevo
+    if PROVIDER_WARMUP == 'preload':
+        providers.import_modules()
+
+def post_worker_init(worker):
+    # Construir los clientes de los proveedores en el worker, ya con el monkey patching de
+    # gevent aplicado (sus sockets y locks son cooperativos), antes de la primera petición
+    from app import app, db, providers, recreate_pools_after_fork, video_job_tracker, PROVIDER_WARMUP
+    if PROVIDER_WARMUP in ('preload', 'worker'):
+        providers.warm_up()
+    # Reanudar el seguimiento de los videos pendientes sin esperar a la primera petición
+    recreate_pools_after_fork(app, db)
+    video_job_tracker.start()
+
+def worker_exit(server, worker):
+    # Escribir los mensajes que sigan en la cola de escritura diferida antes de salir
+    from app import message_persister, video_job_tracker
+    message_persister.close()
+    # Liberar las reservas de trabajos de video para que el worker nuevo los siga ya
+    video_job_tracker.release()
@@ -0,0 +1,143 @@
+# Carga incremental y por ventanas del historial de conversaciones
+
+import logging
+import threading
+from collections import OrderedDict
+
+from models import Message
+
+logger = logging.getLogger('history_loader')
+
+# Presupuestos por defecto: número máximo de mensajes y de tokens aproximados
+DEFAULT_BUDGETS = {
+    'gemini': {'max_messages': 40, 'max_tokens': 24000},
+    'groq': {'max_messages': 30, 'max_tokens': 6000},
+}
+
+
+def estimate_tokens(text):
+    """Estimación barata de tokens (~4 caracteres por token más un pequeño overhead)"""
+    return len(text or '') // 4 + 4
+
+
+def serialize_gemini(role, content):
+    # Gemini solo acepta los roles 'user' y 'model'
+    return {"role": 'model' if role == 'assistant' else 'user', "parts": [{"text": content}]}
+
+
+def serialize_groq(role, content):
+    role = role if role in ['user', 'assistant'] else 'user'  # Roles desconocidos se tratan como 'user'
+    return {"role": role, "content": content}
+
+
+SERIALIZERS = {
+    'gemini': serialize_gemini,
+    'groq': serialize_groq,
+}
+
+
+class HistoryLoader:
+    """
+    Devuelve el historial reciente de una conversación ya serializado para cada modelo.
+
+    Solo se consultan los N mensajes más recientes (consulta keyset) y se mantiene una
+    caché en memoria por conversación que se amplía con los mensajes nuevos en lugar de
+    reconstruirse en cada turno.
+    """
+
+    def __init__(self, budgets=None, max_conversations=200):
+        self.budgets = budgets or DEFAULT_BUDGETS
+        self.max_conversations = max_conversations
+        # Número de mensajes que se guardan por conversación: el mayor de los presupuestos
+        self.window = max(b['max_messages'] for b in self.budgets.values())
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _make_turn(self, msg):
+        return {
+            'id': msg.id,
+            'tokens': estimate_tokens(msg.content),
+            'serialized': {name: fn(msg.role, msg.content) for name, fn in SERIALIZERS.items()},
+        }
+
+    def _fetch_newest(self, conversation_id):
+        rows = (Message.query
+                .filter(Message.conversation_id == conversation_id)
+                .order_by(Message.created_at.desc(), Message.id.desc())
+                .limit(self.window)
+                .all())
+        rows.reverse()
+        return rows
+
+    def _fetch_after(self, conversation_id, last_id):
+        return (Message.query
+                .filter(Message.conversation_id == conversation_id, Message.id > last_id)
+                .order_by(Message.id.asc())
+                .limit(self.window)
+                .all())
+
+    def _refresh(self, conversation_id):
+        entry = self._cache.get(conversation_id)
+        if entry is not None:
+            rows = self._fetch_after(conversation_id, entry['last_id'])
+            if len(rows) >= self.window:
+                # Han llegado más mensajes que la ventana completa: recargar desde cero
+                entry = None
+
+        if entry is None:
+            rows = self._fetch_newest(conversation_id)
+            entry = {'turns': [self._make_turn(m) for m in rows], 'last_id': rows[-1].id if rows else 0}
+            logger.debug(f"Historial cargado para Conv {conversation_id}: {len(rows)} mensajes")
+        elif rows:
+            entry['turns'].extend(self._make_turn(m) for m in rows)
+            entry['last_id'] = rows[-1].id
+            # Mantener solo la ventana más reciente
+            if len(entry['turns']) > self.window:
+                del entry['turns'][:-self.window]
+            logger.debug(f"Historial ampliado para Conv {conversation_id}: +{len(rows)} mensajes")
+
+        with self._lock:
+            self._cache[conversation_id] = entry
+            self._cache.move_to_end(conversation_id)
+            while len(self._cache) > self.max_conversations:
+                self._cache.popitem(last=False)
+        return entry
+
+    def load(self, conversation_id, model_key, current_message=None):
+        """
+        Devuelve los turnos más recientes que caben en el presupuesto del modelo.
+
+        Args:
+            conversation_id: ID de la conversación
+            model_key: Clave del presupuesto/serializador ('gemini' o 'groq')
+            current_message: Contenido guardado del mensaje del usuario que se va a responder;
+                si es el último turno se excluye, porque el backend lo envía aparte
+
+        Returns:
+            list: Turnos serializados en el formato del modelo, del más antiguo al más reciente
+        """
+        budget = self.budgets[model_key]
+        entry = self._refresh(conversation_id)
+        turns = entry['turns']
+        if (current_message is not None and turns
+                and turns[-1]['serialized'][model_key] == SERIALIZERS[model_key]('user', current_message)):
+            turns = turns[:-1]
+
+        selected = []
+        total_tokens = 0
+        for turn in reversed(turns):
+            if len(selected) >= budget['max_messages']:
+                break
+            if selected and total_tokens + turn['tokens'] > budget['max_tokens']:
+                break
+            selected.append(turn['serialized'][model_key])
+            total_tokens += turn['tokens']
+        selected.reverse()
+        # Gemini espera que el historial empiece con un turno del usuario
+        while selected and selected[0].get('role') == 'model':
+            selected.pop(0)
+        return selected
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            self._cache.pop(conversation_id, None)
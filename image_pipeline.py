@@ -0,0 +1,248 @@
+# Preprocesado de imágenes (redimensionado y recompresión) antes de enviarlas al modelo
+# y variantes (miniaturas, anchos, WebP/AVIF) de las imágenes generadas
+
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from blocking import BlockingExecutor
+from providers import LazyModule
+
+# PIL se importa con la primera imagen que se procesa
+PIL = LazyModule('PIL')
+
+logger = logging.getLogger('image_pipeline')
+
+
+class ImagePreprocessor:
+    """
+    Reduce las imágenes subidas a un tamaño máximo y una calidad JPEG objetivo.
+
+    Usa process_image (que respeta la orientación EXIF) en un pool de hilos nativos,
+    para que el trabajo de PIL no bloquee el bucle de gevent. El resultado se guarda
+    en el AttachmentStore y se reutiliza por hash de contenido: la misma imagen con
+    los mismos parámetros solo se procesa una vez.
+    """
+
+    def __init__(self, store, process, max_edge=1536, quality=85, pool_size=2, max_cached=500):
+        """
+        Args:
+            store: AttachmentStore donde están las imágenes originales y se guardan las procesadas
+            process: Función process_image(file, max_edge=..., quality=...) -> BytesIO o None
+            max_edge: Tamaño máximo (px) del lado mayor
+            quality: Calidad JPEG objetivo
+            pool_size: Número de hilos nativos para el trabajo de PIL
+            max_cached: Número máximo de resultados recordados en memoria
+        """
+        self.store = store
+        self.process = process
+        self.max_edge = max_edge
+        self.quality = quality
+        self.pool_size = pool_size
+        self.max_cached = max_cached
+        self.executor = BlockingExecutor('image_preprocessor', pool_size)
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prepare(self, ref):
+        """
+        Devuelve la referencia de la versión preprocesada de una imagen.
+
+        Si el procesado falla o no reduce el tamaño, se devuelve la referencia original.
+        """
+        key = (ref['sha256'], self.max_edge, self.quality)
+        cached = self._cache.get(key)
+        # La versión procesada puede haberse borrado al liberar espacio en uploads/
+        if cached is not None and not os.path.exists(self.store.path_for(cached['sha256'])):
+            del self._cache[key]
+            cached = None
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        original = self.store.read_bytes(ref)
+        output = self.executor.call(self.process, io.BytesIO(original), max_edge=self.max_edge, quality=self.quality)
+
+        result = ref
+        if output is not None and output.getbuffer().nbytes < ref['size']:
+            result = self.store.save(output, 'image/jpeg')
+            logger.debug(f"Imagen {ref['sha256'][:12]} reducida de {ref['size']/1024:.0f}KB a {result['size']/1024:.0f}KB")
+
+        self._cache[key] = result
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return result
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'max_edge': self.max_edge,
+            'quality': self.quality,
+        }
+
+
+def _format_supported(extension):
+    try:
+        # Plugin opcional: Pillow 10 no codifica AVIF por sí mismo
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    return extension in PIL.Image.registered_extensions()
+
+
+class ImageVariants:
+    """
+    Genera versiones reducidas y recodificadas de las imágenes de uploads/.
+
+    Por cada imagen se escriben en variants/<nombre>/ un fichero por formato moderno
+    (WebP y, si hay codificador, AVIF) y ancho: 'w<ancho>.<fmt>' para cada ancho menor
+    que el original y 'full.<fmt>' al tamaño original, más un manifiesto con el ancho
+    del original para comprobar que el conjunto está completo. El trabajo de PIL va en el pool
+    de hilos nativos, en segundo plano: hasta que termina se sirve el original.
+    select() elige la variante según el ancho pedido y los formatos que acepta el
+    navegador.
+    """
+
+    FORMATS = (('avif', 'AVIF', 'image/avif'), ('webp', 'WEBP', 'image/webp'))
+    # Fichero con el ancho del original (oculto: ni se sirve ni cuenta al liberar espacio)
+    MANIFEST = '.manifest.json'
+    SOURCE_PATTERN = re.compile(r'^[\w.-]+\.(png|jpe?g|webp|gif)$', re.IGNORECASE)
+
+    def __init__(self, root, widths=(320, 640, 1280), quality=80, pool_size=2, variants_dir='variants', on_write=None):
+        """
+        Args:
+            root: Directorio de uploads
+            widths: Anchos (px) de las versiones reducidas; el menor es la miniatura
+            quality: Calidad de codificación WebP/AVIF
+            pool_size: Número de hilos nativos para el trabajo de PIL
+            variants_dir: Subdirectorio de root donde se guardan las variantes
+            on_write: Función (bytes) llamada tras publicar las variantes de una imagen
+                (MediaStore.record_write)
+        """
+        self.root = root
+        self.widths = tuple(sorted(widths))
+        self.quality = quality
+        self.pool_size = pool_size
+        self.variants_root = os.path.join(root, variants_dir)
+        self.variants_dir = variants_dir
+        self.on_write = on_write
+        self._formats = None
+        self.executor = BlockingExecutor('image_variants', pool_size)
+        self.generated = 0
+        self.failures = 0
+
+    @property
+    def formats(self):
+        # Los codificadores disponibles se comprueban en el primer uso (importa PIL)
+        if self._formats is None:
+            self._formats = [(ext, fmt, mime) for ext, fmt, mime in self.FORMATS if _format_supported(f'.{ext}')]
+        return self._formats
+
+    def is_source(self, filename):
+        """Si el fichero (relativo a root) es una imagen original con variantes posibles"""
+        return '/' not in filename and bool(self.SOURCE_PATTERN.match(filename))
+
+    def schedule(self, filename):
+        """Genera en segundo plano las variantes de una imagen recién guardada en root"""
+        if self.formats and self.is_source(filename):
+            self.executor.spawn(self._generate, filename)
+
+    def _generate(self, filename):
+        target_dir = os.path.join(self.variants_root, filename)
+        if os.path.isdir(target_dir):
+            if self._complete(target_dir):
+                return  # Mismo contenido (nombre por hash): ya generadas
+            # Conjunto incompleto (borrado a medias): se genera de nuevo
+            shutil.rmtree(target_dir, ignore_errors=True)
+        try:
+            with PIL.Image.open(os.path.join(self.root, filename)) as source:
+                image = PIL.ImageOps.exif_transpose(source)
+                image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+            sizes = [('full', image)]
+            for width in self.widths:
+                if width < image.width:
+                    height = max(1, round(image.height * width / image.width))
+                    sizes.append((f'w{width}', image.resize((width, height), PIL.Image.LANCZOS, reducing_gap=2.0)))
+
+            # Se escribe en un directorio temporal y se publica de una vez con rename
+            os.makedirs(self.variants_root, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=self.variants_root, prefix='.tmp-')
+            for name, resized in sizes:
+                for ext, fmt, _ in self.formats:
+                    resized.save(os.path.join(tmp_dir, f'{name}.{ext}'), fmt, quality=self.quality)
+            # Ancho del original: con él _complete() sabe qué ficheros debe tener el conjunto
+            with open(os.path.join(tmp_dir, self.MANIFEST), 'w') as f:
+                json.dump({'width': image.width}, f)
+            written = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir)
+                          if name != self.MANIFEST)
+            try:
+                os.rename(tmp_dir, target_dir)
+            except OSError:
+                # Otro worker las generó a la vez
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            self.generated += 1
+            if self.on_write:
+                self.on_write(written)
+            logger.debug(f"Variantes de {filename}: {', '.join(name for name, _ in sizes)} en {len(self.formats)} formatos")
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Error generando variantes de {filename}: {e}", exc_info=True)
+
+    def _complete(self, target_dir):
+        """Si el directorio tiene todas las variantes que corresponden a la configuración actual"""
+        try:
+            with open(os.path.join(target_dir, self.MANIFEST)) as f:
+                width = json.load(f)['width']
+        except (OSError, ValueError, KeyError):
+            return False  # Sin manifiesto: conjunto de una versión anterior o a medio borrar
+        names = ['full'] + [f'w{w}' for w in self.widths if w < width]
+        return all(os.path.exists(os.path.join(target_dir, f'{name}.{ext}'))
+                   for name in names for ext, _, _ in self.formats)
+
+    def select(self, filename, width=None, accept=''):
+        """
+        Elige la variante que servir para una imagen.
+
+        Args:
+            filename: Imagen original, relativa a root
+            width: Ancho de pantalla pedido (px) o None para el tamaño original
+            accept: Cabecera Accept de la petición
+
+        Returns:
+            tuple: (ruta relativa a root, tipo MIME) o None para servir el original
+        """
+        if not self.is_source(filename):
+            return None
+        # Sin el original (borrado al liberar espacio) tampoco se sirven sus variantes
+        if not os.path.exists(os.path.join(self.root, filename)):
+            return None
+        names = ['full']
+        if width:
+            # La menor variante que cubre el ancho pedido; si ninguna, el tamaño original
+            names = [f'w{w}' for w in self.widths if w >= width] + names
+        for ext, _, mime in self.formats:
+            if mime not in accept:
+                continue
+            for name in names:
+                relative = f'{self.variants_dir}/{filename}/{name}.{ext}'
+                if os.path.exists(os.path.join(self.root, relative)):
+                    return relative, mime
+        return None
+
+    def stats(self):
+        return {
+            'formats': [ext for ext, _, _ in self.formats],
+            'widths': list(self.widths),
+            'generated': self.generated,
+            'failures': self.failures,
+        }
@@ -0,0 +1,272 @@
+# Instrumentación ligera: tiempos por etapa, histogramas y exportación en formato Prometheus
+
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+logger = logging.getLogger('instrumentation')
+
+# Límites (segundos) de los buckets de los histogramas
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """Histograma acumulativo por etiqueta (p. ej. una serie por etapa)"""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+                self._series[label_value] = series
+            series['counts'][bisect_left(self.buckets, seconds)] += 1
+            series['sum'] += seconds
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value in sorted(self._series):
+                series = self._series[label_value]
+                label = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['counts']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{label}}} {series["sum"]:.6f}')
+                lines.append(f'{self.name}_count{{{label}}} {series["count"]}')
+        return lines
+
+    def snapshot(self):
+        """Resumen por etiqueta (número de observaciones y media en ms) para /api/stats"""
+        with self._lock:
+            return {
+                label_value: {
+                    'count': series['count'],
+                    'avg_ms': round(series['sum'] / series['count'] * 1000, 2) if series['count'] else 0.0,
+                }
+                for label_value, series in self._series.items()
+            }
+
+
+class Trace:
+    """Tiempos de las etapas de una petición o tarea (se suman si una etapa se repite)"""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+class Instrumentation:
+    """
+    Registra la duración de etapas (spans) y de peticiones/tareas completas (traces).
+
+    Cada span se acumula en el histograma chat_stage_seconds y, si hay una traza
+    activa en el greenlet actual, también en el desglose de esa traza. Al cerrar una
+    traza se registra su duración total en chat_trace_seconds y, si supera
+    slow_threshold_ms, se escribe un aviso con el desglose por etapa.
+
+    Uso:
+        with instrumentation.trace('chat_response', conversation_id=42):
+            with instrumentation.span('history_load'):
+                ...
+    """
+
+    def __init__(self, slow_threshold_ms=None):
+        """
+        Args:
+            slow_threshold_ms: Umbral (ms) para el log de peticiones lentas (None lo desactiva)
+        """
+        self.slow_threshold = slow_threshold_ms / 1000.0 if slow_threshold_ms else None
+        self.stages = Histogram('chat_stage_seconds', 'Duración de cada etapa del procesamiento de un chat', 'stage')
+        self.traces = Histogram('chat_trace_seconds', 'Duración total de peticiones y tareas en segundo plano', 'name')
+        self._local = None
+        self._local_pid = None
+        self.slow_traces = 0
+        self._gauges = []
+
+    @property
+    def context(self):
+        """
+        Almacenamiento local de la traza en curso.
+
+        Con preload_app el módulo se importa en el maestro, antes del monkey patching
+        de gevent: un threading.local creado entonces sería el original y lo
+        compartirían todos los greenlets. Se crea en el proceso que lo usa, cuando
+        threading.local ya es local a cada greenlet.
+        """
+        pid = os.getpid()
+        if self._local_pid != pid:
+            self._local = threading.local()
+            self._local_pid = pid
+        return self._local
+
+    def current_trace(self):
+        return getattr(self.context, 'trace', None)
+
+    def observe(self, stage, seconds):
+        """Registra una duración ya medida (p. ej. el tiempo hasta el primer fragmento)"""
+        self.stages.observe(stage, seconds)
+        current = self.current_trace()
+        if current is not None:
+            current.add(stage, seconds)
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def trace(self, name, **attrs):
+        return _TraceContext(self, name, attrs)
+
+    def timed(self, stage):
+        """Decorador que mide cada llamada a la función como la etapa indicada"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def traced(self, name, attrs=()):
+        """
+        Decorador que abre una traza por llamada.
+
+        Args:
+            name: Nombre de la traza
+            attrs: Argumentos (por nombre) que se incluyen en el log de peticiones lentas
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.trace(name, **{key: kwargs[key] for key in attrs if key in kwargs}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, stage, iterable, first_item_stage=None):
+        """
+        Recorre un iterable midiendo el tiempo total y, opcionalmente, hasta el primer elemento.
+
+        El tiempo que el consumidor dedica a cada elemento no se cuenta: solo el de
+        esperar al siguiente (p. ej. la latencia del proveedor en un stream).
+        """
+        waited = 0.0
+        iterator = iter(iterable)
+        first = True
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    waited += time.perf_counter() - started
+                    return
+                waited += time.perf_counter() - started
+                if first and first_item_stage:
+                    self.observe(first_item_stage, waited)
+                first = False
+                yield item
+        finally:
+            self.observe(stage, waited)
+
+    def register_gauges(self, collect):
+        """
+        Añade métricas instantáneas a /metrics.
+
+        Args:
+            collect: Función sin argumentos que devuelve [(nombre, help, {etiquetas: valor} o valor)]
+        """
+        self._gauges.append(collect)
+
+    def _finish_trace(self, current, failed):
+        total = time.perf_counter() - current.started
+        self.traces.observe(current.name, total)
+        if self.slow_threshold is not None and total >= self.slow_threshold:
+            self.slow_traces += 1
+            breakdown = ', '.join(
+                f"{stage}={seconds * 1000:.0f}ms"
+                for stage, seconds in sorted(current.stages.items(), key=lambda item: -item[1])
+            )
+            attrs = ' '.join(f"{key}={value}" for key, value in current.attrs.items())
+            logger.warning(f"Petición lenta {current.name} ({total * 1000:.0f}ms{', con error' if failed else ''}) {attrs} -> {breakdown or 'sin etapas'}")
+
+    def render_prometheus(self):
+        lines = self.stages.render() + self.traces.render()
+        lines += [
+            "# HELP chat_slow_traces_total Peticiones que superaron el umbral de lentitud",
+            "# TYPE chat_slow_traces_total counter",
+            f"chat_slow_traces_total {self.slow_traces}",
+        ]
+        for collect in self._gauges:
+            try:
+                gauges = collect()
+            except Exception as e:
+                logger.error(f"Error recogiendo métricas: {e}")
+                continue
+            for name, help_text, values in gauges:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} gauge")
+                if isinstance(values, dict):
+                    for labels, value in sorted(values.items()):
+                        label_text = ','.join(f'{key}="{val}"' for key, val in labels)
+                        lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {values}")
+        return '\n'.join(lines) + '\n'
+
+    def stats(self):
+        return {
+            'stages': self.stages.snapshot(),
+            'traces': self.traces.snapshot(),
+            'slow_traces': self.slow_traces,
+        }
+
+
+class _Span:
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.instrumentation.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class _TraceContext:
+    def __init__(self, instrumentation, name, attrs):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        local = self.instrumentation.context
+        self.previous = getattr(local, 'trace', None)
+        self.current = Trace(self.name, self.attrs)
+        local.trace = self.current
+        return self.current
+
+    def __exit__(self, exc_type, exc, tb):
+        self.instrumentation.context.trace = self.previous
+        self.instrumentation._finish_trace(self.current, failed=exc_type is not None)
+        return False
@@ -0,0 +1,124 @@
+# Planificador de tareas de generación con límites de concurrencia por modelo
+
+import logging
+import threading
+from collections import defaultdict, deque
+
+logger = logging.getLogger('job_scheduler')
+
+
+class QueueFullError(Exception):
+    """Se lanza cuando la cola de un modelo está llena y no se aceptan más tareas"""
+    pass
+
+
+class JobScheduler:
+    """
+    Ejecuta tareas en segundo plano con un máximo de tareas simultáneas por modelo.
+
+    Las tareas que superan el límite esperan en una cola acotada (FIFO). Cuando la
+    cola está llena, submit() lanza QueueFullError para que la ruta responda con 429
+    en lugar de crear greenlets sin límite.
+    """
+
+    def __init__(self, spawn, limits=None, default_limit=2, max_queue=20):
+        """
+        Args:
+            spawn: Función para lanzar tareas en segundo plano (socketio.start_background_task)
+            limits: Dict modelo -> número máximo de tareas simultáneas
+            default_limit: Límite para modelos no listados en limits
+            max_queue: Número máximo de tareas en espera por modelo
+        """
+        self._spawn = spawn
+        self.limits = limits or {}
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self._running = defaultdict(int)
+        self._queues = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def limit_for(self, key):
+        return self.limits.get(key, self.default_limit)
+
+    def can_accept(self, key):
+        """Indica si una nueva tarea para este modelo se ejecutaría o encolaría"""
+        with self._lock:
+            return self._running[key] < self.limit_for(key) or len(self._queues[key]) < self.max_queue
+
+    def submit(self, key, target, notify=None, **kwargs):
+        """
+        Lanza la tarea o la encola si el modelo está al límite.
+
+        Args:
+            key: Clave del modelo (p. ej. 'gemini', 'groq', 'kkty2-video')
+            target: Función a ejecutar
+            notify: Callback opcional notify(position) para avisar de la posición en cola
+            **kwargs: Argumentos para target
+
+        Returns:
+            int: 0 si la tarea empieza inmediatamente, o su posición en la cola (1 = siguiente)
+        """
+        job = {'target': target, 'kwargs': kwargs, 'notify': notify}
+        with self._lock:
+            if self._running[key] < self.limit_for(key):
+                self._running[key] += 1
+                position = 0
+            elif len(self._queues[key]) < self.max_queue:
+                self._queues[key].append(job)
+                position = len(self._queues[key])
+            else:
+                self.rejected += 1
+                raise QueueFullError(f"Cola llena para el modelo {key}")
+
+        if position == 0:
+            self._spawn(self._run, key, job)
+        else:
+            logger.info(f"Tarea encolada para {key} en posición {position}")
+            self._notify(job, position)
+        return position
+
+    def _run(self, key, job):
+        try:
+            job['target'](**job['kwargs'])
+        except Exception as e:
+            logger.error(f"Error no controlado en tarea de {key}: {e}", exc_info=True)
+        finally:
+            self._release(key)
+
+    def _release(self, key):
+        with self._lock:
+            queue = self._queues[key]
+            next_job = queue.popleft() if queue else None
+            if next_job is None:
+                self._running[key] -= 1
+            waiting = list(queue)
+
+        if next_job is not None:
+            # El hueco liberado pasa directamente a la siguiente tarea
+            self._notify(next_job, 0)
+            self._spawn(self._run, key, next_job)
+            for position, job in enumerate(waiting, start=1):
+                self._notify(job, position)
+
+    @staticmethod
+    def _notify(job, position):
+        if job['notify']:
+            try:
+                job['notify'](position)
+            except Exception as e:
+                logger.warning(f"Error notificando posición en cola: {e}")
+
+    def stats(self):
+        """Devuelve tareas en ejecución y en espera por modelo"""
+        with self._lock:
+            keys = set(self._running) | set(self._queues)
+            return {
+                'models': {key: {
+                    'running': self._running[key],
+                    'queued': len(self._queues[key]),
+                    'limit': self.limit_for(key),
+                } for key in keys},
+                'max_queue': self.max_queue,
+                'rejected': self.rejected,
+            }
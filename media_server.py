@@ -0,0 +1,172 @@
+# Envío de los ficheros de uploads/ con ETag, caché inmutable, rangos y descarga en el proxy
+
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from flask import Response, request, send_file
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
+
+logger = logging.getLogger('media_server')
+
+# Nombres direccionados por contenido: '<prefijo>_<sha256>.<ext>' (MediaStore) y
+# 'variants/<original>/<variante>.<ext>' (ImageVariants)
+_HASH_NAME = re.compile(r'(?:^|/|_)([0-9a-f]{64})(?:\.[A-Za-z0-9]+)?$')
+_VARIANT_NAME = re.compile(r'^variants/[^/]*_([0-9a-f]{64})\.[A-Za-z0-9]+/([\w-]+\.[A-Za-z0-9]+)$')
+
+OFFLOAD_MODES = ('x-accel', 'x-sendfile')
+
+
+class MediaServer:
+    """
+    Sirve los ficheros de uploads/ de forma eficiente.
+
+    - ETag fuerte: el hash del nombre si el fichero está direccionado por contenido; si
+      no, el SHA-256 del contenido (calculado una vez por tamaño+fecha y recordado).
+    - Los ficheros direccionados por contenido nunca cambian: 'Cache-Control: immutable'
+      con max_age de un año. El resto, max_age corto.
+    - Peticiones condicionales (If-None-Match → 304) y de rango (206, para avanzar en
+      los videos) con werkzeug, leyendo en bloques de block_size.
+    - Con offload='x-accel' (nginx) o 'x-sendfile' (Apache/lighttpd) solo se envían las
+      cabeceras y el proxy envía el fichero (con sendfile y soporte de rangos); el
+      worker de gevent no mueve los bytes.
+
+    Las respuestas son 'public' (cacheables en proxies y CDN), así que solo se sirve
+    media generada: los directorios de private_dirs (adjuntos subidos por los usuarios)
+    y los temporales en escritura ('.<nombre>') no se sirven (404).
+    """
+
+    def __init__(self, root, offload=None, offload_prefix='/_uploads', max_age=31536000,
+                 mutable_max_age=3600, block_size=256 * 1024, max_hashed_bytes=64 * 1024 * 1024,
+                 max_cached_etags=2000, private_dirs=('attachments',)):
+        """
+        Args:
+            root: Directorio de uploads
+            offload: None, 'x-accel' o 'x-sendfile'
+            offload_prefix: Location interna del proxy para X-Accel-Redirect
+            max_age: Segundos de caché de los ficheros direccionados por contenido
+            mutable_max_age: Segundos de caché del resto de ficheros
+            block_size: Tamaño de los bloques al enviar el fichero desde el worker
+            max_hashed_bytes: Tamaño máximo para calcular el hash del contenido como ETag
+                (en ficheros mayores se usa tamaño+fecha)
+            max_cached_etags: ETags calculados que se recuerdan
+            private_dirs: Subdirectorios de root que nunca se sirven
+        """
+        if offload and offload not in OFFLOAD_MODES:
+            raise ValueError(f"MEDIA_OFFLOAD desconocido: {offload} (opciones: {', '.join(OFFLOAD_MODES)})")
+        self.root = root
+        self.offload = offload or None
+        self.offload_prefix = offload_prefix.rstrip('/')
+        self.max_age = max_age
+        self.mutable_max_age = mutable_max_age
+        self.block_size = block_size
+        self.max_hashed_bytes = max_hashed_bytes
+        self.max_cached_etags = max_cached_etags
+        self.private_dirs = tuple(private_dirs)
+        self._etags = OrderedDict()
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.not_modified = 0
+        self.ranges = 0
+        self.offloaded = 0
+
+    def is_public(self, relative):
+        parts = relative.replace('\\', '/').split('/')
+        return parts[0] not in self.private_dirs and not any(part.startswith('.') for part in parts)
+
+    def is_immutable(self, relative):
+        return bool(_HASH_NAME.search(relative) or _VARIANT_NAME.match(relative))
+
+    def etag_for(self, relative, path, st):
+        variant = _VARIANT_NAME.match(relative)
+        if variant:
+            return f"{variant.group(1)}-{variant.group(2)}"
+        match = _HASH_NAME.search(relative)
+        if match:
+            return match.group(1)
+        if st.st_size > self.max_hashed_bytes:
+            return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+        key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            etag = self._etags.get(key)
+            if etag is not None:
+                self._etags.move_to_end(key)
+                return etag
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                digest.update(block)
+        etag = digest.hexdigest()
+        with self._lock:
+            self._etags[key] = etag
+            while len(self._etags) > self.max_cached_etags:
+                self._etags.popitem(last=False)
+        return etag
+
+    def send(self, relative, mimetype=None, cacheable=True):
+        """
+        Respuesta para un fichero de root.
+
+        Args:
+            relative: Ruta relativa a root
+            mimetype: Tipo MIME (si no, se deduce de la extensión)
+            cacheable: False para una respuesta provisional (p. ej. el original mientras
+                se generan sus variantes): caché corta y sin immutable
+
+        Returns:
+            Response (404 si el fichero no existe o no es público)
+        """
+        path = safe_join(self.root, relative)
+        if path is None or not self.is_public(relative) or not os.path.isfile(path):
+            return Response(status=404)
+        st = os.stat(path)
+        etag = self.etag_for(relative, path, st)
+        mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        immutable = cacheable and self.is_immutable(relative)
+        max_age = self.max_age if immutable else (self.mutable_max_age if cacheable else 60)
+
+        if self.offload:
+            if request.if_none_match.contains(etag):
+                self.not_modified += 1
+                response = Response(status=304)
+            else:
+                self.offloaded += 1
+                response = Response(mimetype=mimetype)
+                if self.offload == 'x-accel':
+                    response.headers['X-Accel-Redirect'] = f"{self.offload_prefix}/{relative}"
+                else:
+                    response.headers['X-Sendfile'] = path
+            response.set_etag(etag)
+        else:
+            # gevent.pywsgi no ofrece wsgi.file_wrapper: bloques grandes = menos cambios de greenlet
+            request.environ.setdefault('wsgi.file_wrapper', lambda f, _: FileWrapper(f, self.block_size))
+            response = send_file(path, mimetype=mimetype, conditional=True, etag=etag,
+                                 last_modified=st.st_mtime, max_age=max_age)
+            # Anunciar los rangos también en la respuesta completa (el <video> los usa para avanzar)
+            response.accept_ranges = 'bytes'
+            if response.status_code == 304:
+                self.not_modified += 1
+            elif response.status_code == 206:
+                self.ranges += 1
+            self.sent += 1
+
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        if immutable:
+            response.cache_control.immutable = True
+        return response
+
+    def stats(self):
+        return {
+            'offload': self.offload,
+            'sent': self.sent,
+            'not_modified': self.not_modified,
+            'ranges': self.ranges,
+            'offloaded': self.offloaded,
+        }
@@ -0,0 +1,292 @@
+# Almacén de los ficheros generados (imágenes y videos) en uploads/
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.security import safe_join
+
+from response_cache import normalize_prompt
+
+logger = logging.getLogger('media_store')
+
+
+class MediaStore:
+    """
+    Guarda la media generada con el SHA-256 del contenido en el nombre del fichero.
+
+    Dos generaciones simultáneas nunca se pisan (nombres distintos si el contenido
+    es distinto; el mismo fichero si es idéntico) y los ficheros se escriben de forma
+    atómica (temporal + rename). Un índice prompt+modelo permite reutilizar un
+    resultado reciente si quien llama lo pide. Cuando uploads/ supera max_bytes se
+    borran los ficheros usados hace más tiempo (por fecha de modificación, que
+    touch() actualiza al servirlos) hasta bajar al 90%; los de menos de min_age
+    segundos no se borran (adjuntos de tareas en curso, media recién generada).
+    Las variantes de una imagen (variants/<nombre>/) se borran junto con ella.
+
+    Los demás almacenes que escriben en root (adjuntos, variantes) avisan con
+    record_write() para que el total cuente todo el directorio. Como el total es de
+    cada worker y no ve lo que escriben los demás, se vuelve a medir el directorio
+    cada rescan_seconds.
+
+    El índice de reutilización es propio de cada worker y no sobrevive a reinicios:
+    solo evita repetir generaciones recientes.
+    """
+
+    def __init__(self, root, max_bytes, min_age_seconds=600, reuse_ttl_seconds=86400,
+                 max_index_entries=1000, url_prefix='/uploads', chunk_size=64 * 1024,
+                 rescan_seconds=300, variants_dir='variants'):
+        """
+        Args:
+            root: Directorio de uploads
+            max_bytes: Tamaño máximo (bytes) de todo el directorio, subdirectorios incluidos
+            min_age_seconds: Antigüedad mínima para poder borrar un fichero
+            reuse_ttl_seconds: Validez de una entrada del índice prompt+modelo
+            max_index_entries: Entradas máximas del índice (se descartan las más antiguas)
+            url_prefix: Prefijo de las URLs públicas de los ficheros
+            chunk_size: Tamaño de bloque al calcular el hash de un fichero
+            rescan_seconds: Cada cuánto se vuelve a medir el directorio completo
+            variants_dir: Subdirectorio de root con las variantes de las imágenes
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_age = min_age_seconds
+        self.reuse_ttl = reuse_ttl_seconds
+        self.max_index_entries = max_index_entries
+        self.url_prefix = url_prefix
+        self.chunk_size = chunk_size
+        self.rescan_seconds = rescan_seconds
+        self.variants_root = os.path.join(root, variants_dir)
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._total_bytes = None
+        self._scanned_at = None
+        self.saved = 0
+        self.deduplicated = 0
+        self.reused = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    def url_for(self, filename):
+        return f"{self.url_prefix}/{filename}"
+
+    def save(self, data, extension, prefix='media'):
+        """
+        Guarda unos bytes y devuelve el nombre del fichero.
+
+        Args:
+            data: Contenido
+            extension: Extensión con punto ('.png', '.mp4')
+            prefix: Prefijo legible del nombre ('generated_image', 'edited_image', ...)
+
+        Returns:
+            str: Nombre del fichero dentro de root
+        """
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return self.save_with(write, extension, prefix, sha256=hashlib.sha256(data).hexdigest())
+
+    def save_with(self, write, extension, prefix='media', sha256=None):
+        """
+        Guarda un fichero escrito por una función (p. ej. video.save(path) del SDK).
+
+        Args:
+            write: Función que recibe una ruta temporal y escribe el contenido en ella
+            extension: Extensión con punto
+            prefix: Prefijo legible del nombre
+            sha256: Hash del contenido si ya se conoce (si no, se calcula leyendo el fichero)
+
+        Returns:
+            str: Nombre del fichero dentro de root
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.media-', suffix=extension)
+        os.close(fd)
+        try:
+            write(tmp_path)
+            if sha256 is None:
+                sha256 = self._hash_file(tmp_path)
+            filename = f"{prefix}_{sha256}{extension}"
+            final_path = os.path.join(self.root, filename)
+            size = os.path.getsize(tmp_path)
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+                os.utime(final_path)
+                self.deduplicated += 1
+                logger.debug(f"{filename} ya existía, se reutiliza")
+            else:
+                os.replace(tmp_path, final_path)
+                self.saved += 1
+                logger.info(f"Media guardada en {final_path} ({size/1024:.0f}KB)")
+                self._add_bytes(size)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.evict_if_needed()
+        return filename
+
+    def _add_bytes(self, nbytes):
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += nbytes
+
+    def record_write(self, nbytes):
+        """
+        Registra bytes escritos en root por otro almacén y libera espacio si hace falta.
+
+        Args:
+            nbytes: Tamaño de lo escrito (adjunto nuevo, conjunto de variantes)
+        """
+        self._add_bytes(nbytes)
+        self.evict_if_needed()
+
+    def _hash_file(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _index_key(self, prompt, model_name):
+        return hashlib.sha256(f"{model_name}\n{normalize_prompt(prompt)}".encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt, model_name):
+        """Ficheros de una generación reciente con el mismo prompt y modelo (o None)"""
+        key = self._index_key(prompt, model_name)
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None or entry['expires'] < time.monotonic():
+                return None
+            filenames = entry['filenames']
+        # El fichero puede haberse borrado por falta de espacio
+        if not all(os.path.exists(os.path.join(self.root, name)) for name in filenames):
+            with self._lock:
+                self._index.pop(key, None)
+            return None
+        for name in filenames:
+            self.touch(name)
+        self.reused += 1
+        return filenames
+
+    def remember(self, prompt, model_name, filenames):
+        """Registra el resultado de una generación para reutilizarlo con lookup()"""
+        key = self._index_key(prompt, model_name)
+        with self._lock:
+            self._index[key] = {'filenames': list(filenames), 'expires': time.monotonic() + self.reuse_ttl}
+            self._index.move_to_end(key)
+            while len(self._index) > self.max_index_entries:
+                self._index.popitem(last=False)
+
+    def touch(self, filename, min_interval=3600):
+        """Marca un fichero como usado (como mucho una escritura de metadatos por hora)"""
+        path = safe_join(self.root, filename)
+        if path is None:
+            return
+        try:
+            if time.time() - os.path.getmtime(path) > min_interval:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def _scan(self):
+        """
+        Mide root y agrupa los ficheros en unidades de borrado.
+
+        Cada fichero es una unidad, salvo las variantes de una imagen, que forman una
+        sola unidad con su original: su fecha es la del último uso de cualquiera de
+        ellos y se borran juntas.
+
+        Returns:
+            list: (mtime, bytes, rutas) por unidad
+        """
+        units = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Directorios temporales de variantes en escritura
+            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+            in_variants = os.path.dirname(dirpath) == self.variants_root
+            for name in filenames:
+                if name.startswith('.'):
+                    continue  # Temporales en escritura y .gitkeep
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if in_variants:
+                    key, member = os.path.join(self.root, os.path.basename(dirpath)), dirpath
+                else:
+                    key, member = path, path
+                unit = units.setdefault(key, [0.0, 0, set()])
+                unit[0] = max(unit[0], st.st_mtime)
+                unit[1] += st.st_size
+                unit[2].add(member)
+        return [(mtime, size, sorted(paths)) for mtime, size, paths in units.values()]
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def evict_if_needed(self):
+        """Borra los ficheros menos usados si el directorio supera max_bytes"""
+        with self._lock:
+            total = self._total_bytes
+        recent_scan = self._scanned_at is not None and time.monotonic() - self._scanned_at < self.rescan_seconds
+        if total is not None and total <= self.max_bytes and recent_scan:
+            return 0
+        if not self._evict_lock.acquire(blocking=False):
+            return 0  # Otro greenlet ya está liberando espacio
+        try:
+            units = self._scan()
+            self._scanned_at = time.monotonic()
+            total = sum(size for _, size, _ in units)
+            removed = 0
+            if total > self.max_bytes:
+                target = self.max_bytes * 0.9
+                cutoff = time.time() - self.min_age
+                for mtime, size, paths in sorted(units):
+                    if total <= target:
+                        break
+                    if mtime > cutoff:
+                        continue
+                    try:
+                        for path in paths:
+                            self._remove(path)
+                    except OSError as e:
+                        logger.warning(f"No se pudo borrar {path}: {e}")
+                        continue
+                    total -= size
+                    removed += len(paths)
+                    self.evicted_files += len(paths)
+                    self.evicted_bytes += size
+                if removed:
+                    logger.info(f"Liberado espacio en {self.root}: {removed} ficheros borrados, {total/1024/1024:.0f}MB en uso")
+                if total > self.max_bytes:
+                    logger.warning(f"{self.root} sigue por encima del límite ({total/1024/1024:.0f}MB): los ficheros restantes son recientes")
+            with self._lock:
+                self._total_bytes = total
+            return removed
+        finally:
+            self._evict_lock.release()
+
+    def stats(self):
+        return {
+            'bytes': self._total_bytes,
+            'max_bytes': self.max_bytes,
+            'saved': self.saved,
+            'deduplicated': self.deduplicated,
+            'reused': self.reused,
+            'evicted_files': self.evicted_files,
+            'evicted_bytes': self.evicted_bytes,
+            'index_entries': len(self._index),
+        }
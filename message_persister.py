@@ -0,0 +1,200 @@
+# Escritura diferida (write-behind) de mensajes en lotes
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import sqlalchemy as sa
+
+logger = logging.getLogger('message_persister')
+
+# Errores causados por una fila concreta (p. ej. FK de una conversación ya borrada): no
+# se arreglan reintentando, así que se aísla la fila y se descarta solo esa
+ROW_ERRORS = (sa.exc.IntegrityError, sa.exc.DataError)
+
+
+class MessagePersister:
+    """
+    Acumula los mensajes nuevos y los inserta en lotes, en una transacción por lote.
+
+    save() solo encola el mensaje (con su fecha de creación) y vuelve inmediatamente;
+    un bucle por worker vacía la cola cada flush_interval_ms, y quien encola el mensaje
+    número max_batch la vacía sin esperar. La cola es FIFO y solo hay un flush a la
+    vez, así que los ids se asignan en el orden de llegada y el orden dentro de cada
+    conversación se conserva. Quien necesite leer lo recién guardado (historial, API)
+    llama antes a flush(). Al terminar el proceso (atexit / worker_exit de gunicorn)
+    se vacía la cola.
+
+    Si un lote falla por una fila inválida se divide en mitades hasta aislarla: el
+    resto del lote (otras conversaciones, otros usuarios) se guarda y solo se descarta
+    esa fila. Si falla por otra causa (conexión, bloqueo) lo que quede por escribir
+    vuelve al principio de la cola y se reintenta hasta max_attempts veces. Cada
+    mensaje descartado se registra en el log.
+    """
+
+    def __init__(self, app, get_engine, table, spawn, sleep, flush_interval_ms=100, max_batch=200,
+                 max_attempts=3):
+        """
+        Args:
+            app: Aplicación Flask (para el contexto de la base de datos)
+            get_engine: Función que devuelve el motor por el que se escribe
+            table: Tabla de mensajes (Message.__table__)
+            spawn: Función para lanzar el bucle en segundo plano (socketio.start_background_task)
+            sleep: Espera cooperativa del bucle (socketio.sleep)
+            flush_interval_ms: Tiempo máximo (ms) que un mensaje espera en la cola
+            max_batch: Mensajes pendientes a partir de los que se vacía la cola sin esperar
+            max_attempts: Intentos por mensaje ante errores de la base de datos antes de descartarlo
+        """
+        self.app = app
+        self.get_engine = get_engine
+        self.table = table
+        self.spawn = spawn
+        self.sleep = sleep
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pid = None
+        self._closed = False
+        self.batches = 0
+        self.messages = 0
+        self.largest_batch = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def start(self):
+        """Lanza el bucle de escritura una vez por proceso (seguro tras el fork de gunicorn)"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._closed = False
+        # Con preload_app el módulo se importa antes del monkey patching de gevent: los locks
+        # se crean de nuevo en el worker para que esperar por ellos ceda el control
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.spawn(self._loop)
+        atexit.register(self.close)
+        logger.info(f"Escritura diferida de mensajes iniciada en el proceso {self._pid}")
+
+    def save(self, conversation_id, content, role):
+        """Encola un mensaje para guardarlo en el siguiente lote"""
+        row = {
+            'conversation_id': conversation_id,
+            'content': content,
+            'role': role,
+            'created_at': datetime.utcnow(),
+        }
+        with self._lock:
+            self._pending.append((row, 0))
+            pending = len(self._pending)
+
+        if self._closed or self._pid != os.getpid() or pending >= self.max_batch:
+            # Sin bucle activo (script, shutdown) o lote completo: escribir ya
+            self.flush()
+
+    def flush(self):
+        """Escribe todos los mensajes pendientes; devuelve cuántos se guardaron"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch = list(self._pending)
+                self._pending.clear()
+
+            saved, invalid, unwritten, error = self._write(batch)
+            for row, _ in invalid:
+                self._log_dropped(row, 'fila inválida')
+            self.dropped += len(invalid)
+
+            if unwritten:
+                self.failures += 1
+                retry = [(row, attempts + 1) for row, attempts in unwritten if attempts + 1 < self.max_attempts]
+                exhausted = len(unwritten) - len(retry)
+                for row, attempts in unwritten:
+                    if attempts + 1 >= self.max_attempts:
+                        self._log_dropped(row, f'{self.max_attempts} intentos fallidos')
+                self.dropped += exhausted
+                with self._lock:
+                    # Los reintentos vuelven al principio para no alterar el orden
+                    self._pending.extendleft(reversed(retry))
+                logger.error(f"Error guardando {len(unwritten)} de {len(batch)} mensajes ({len(retry)} se reintentarán): {error}",
+                             exc_info=error)
+
+            if saved:
+                self.batches += 1
+                self.messages += saved
+                self.largest_batch = max(self.largest_batch, saved)
+                logger.debug(f"Lote de {saved} mensajes guardado")
+            return saved
+
+    def _insert(self, rows):
+        with self.app.app_context():
+            # Conexión propia: no arrastra cambios pendientes de la sesión ORM de quien llama
+            with self.get_engine().begin() as connection:
+                connection.execute(sa.insert(self.table), rows)
+
+    def _write(self, entries):
+        """
+        Inserta los mensajes en orden, aislando los que la base de datos rechaza.
+
+        Args:
+            entries: Lista de (fila, intentos)
+
+        Returns:
+            tuple: (guardados, inválidos, sin escribir, error). Sin escribir son los
+                mensajes desde el primer error que no se debe a una fila (en orden),
+                y error la excepción de ese fallo o de la última fila inválida
+        """
+        try:
+            self._insert([row for row, _ in entries])
+            return len(entries), [], [], None
+        except ROW_ERRORS as e:
+            if len(entries) == 1:
+                return 0, entries, [], e
+        except Exception as e:
+            return 0, [], entries, e
+
+        # Una fila inválida: cada mitad en su propia transacción
+        middle = len(entries) // 2
+        saved, invalid, unwritten, error = self._write(entries[:middle])
+        if unwritten:
+            return saved, invalid, unwritten + entries[middle:], error
+        saved_rest, invalid_rest, unwritten, error_rest = self._write(entries[middle:])
+        return saved + saved_rest, invalid + invalid_rest, unwritten, error_rest or error
+
+    def _log_dropped(self, row, reason):
+        created_at = row['created_at'].isoformat() if row.get('created_at') else None
+        logger.error(f"Mensaje descartado ({reason}): conversación {row['conversation_id']}, "
+                     f"rol {row['role']}, creado {created_at}, {len(row['content'] or '')} caracteres")
+
+    def _loop(self):
+        while not self._closed:
+            self.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error en la escritura diferida de mensajes: {e}", exc_info=True)
+
+    def close(self):
+        """Detiene el bucle y escribe lo pendiente (idempotente)"""
+        self._closed = True
+        deadline = time.monotonic() + 5
+        # Lo que no se pudo escribir vuelve a la cola: se reintenta hasta agotar sus intentos
+        while self._pending and time.monotonic() < deadline:
+            self.flush()
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'batches': self.batches,
+            'messages': self.messages,
+            'largest_batch': self.largest_batch,
+            'failures': self.failures,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,272 @@
+# Búsqueda de texto completo en los mensajes y títulos de las conversaciones
+
+import logging
+import os
+import re
+import threading
+from html import escape
+
+import sqlalchemy as sa
+
+from database_config import drop_invalid_indexes
+
+logger = logging.getLogger('message_search')
+
+# Marcadores de coincidencia que devuelve la base de datos; se sustituyen por <mark>
+# después de escapar el texto, así el fragmento se puede insertar como HTML
+_MARK_START = '\x01'
+_MARK_END = '\x02'
+
+# Palabras de contexto alrededor de la coincidencia en cada fragmento
+SNIPPET_WORDS = 16
+
+# SQLite: tablas FTS5 de contenido externo (el texto sigue solo en message/conversation)
+# mantenidas por triggers, de modo que cualquier escritura (ORM o los lotes de
+# MessagePersister) actualiza el índice en la misma transacción
+_SQLITE_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    "content, content='message', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_ai AFTER INSERT ON message BEGIN "
+    "INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_ad AFTER DELETE ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_au AFTER UPDATE OF content ON message BEGIN "
+    "INSERT INTO message_fts(message_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO message_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5("
+    "title, content='conversation', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS conversation_fts_ai AFTER INSERT ON conversation BEGIN "
+    "INSERT INTO conversation_fts(rowid, title) VALUES (new.id, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS conversation_fts_ad AFTER DELETE ON conversation BEGIN "
+    "INSERT INTO conversation_fts(conversation_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS conversation_fts_au AFTER UPDATE OF title ON conversation BEGIN "
+    "INSERT INTO conversation_fts(conversation_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+    "INSERT INTO conversation_fts(rowid, title) VALUES (new.id, new.title); END",
+)
+
+_SQLITE_SEARCH = f"""
+SELECT m.id AS message_id, m.conversation_id, c.title, m.role, m.created_at,
+       snippet(message_fts, 0, :mark_start, :mark_end, '…', {SNIPPET_WORDS}) AS snippet,
+       -bm25(message_fts) AS score
+FROM message_fts
+JOIN message m ON m.id = message_fts.rowid
+JOIN conversation c ON c.id = m.conversation_id
+WHERE message_fts MATCH :query AND c.user_id = :user_id
+UNION ALL
+SELECT NULL, c.id, c.title, NULL, c.created_at,
+       snippet(conversation_fts, 0, :mark_start, :mark_end, '…', {SNIPPET_WORDS}),
+       -bm25(conversation_fts)
+FROM conversation_fts
+JOIN conversation c ON c.id = conversation_fts.rowid
+WHERE conversation_fts MATCH :query AND c.user_id = :user_id
+ORDER BY score DESC, created_at DESC
+LIMIT :limit OFFSET :offset
+"""
+
+
+# Índices GIN de PostgreSQL (ver _postgres_ddl)
+_POSTGRES_INDEXES = ('ix_message_content_fts', 'ix_conversation_title_fts')
+
+
+class SearchUnavailableError(Exception):
+    """Se lanza cuando el índice de búsqueda todavía no se ha creado"""
+    pass
+
+
+def _postgres_ddl(config):
+    # Índices GIN sobre la expresión: se mantienen solos con cada INSERT/UPDATE
+    return (
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_message_content_fts ON message "
+        f"USING GIN (to_tsvector('{config}', content))",
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conversation_title_fts ON conversation "
+        f"USING GIN (to_tsvector('{config}', coalesce(title, '')))",
+    )
+
+
+def _postgres_search(config):
+    # La configuración va como literal: con un parámetro el planificador no usaría los
+    # índices GIN. Los fragmentos (ts_headline, costoso) solo se calculan para la página
+    return f"""
+SELECT hits.*,
+       ts_headline('{config}', hits.text, websearch_to_tsquery('{config}', :query),
+                   'StartSel=' || :mark_start || ', StopSel=' || :mark_end
+                   || ', MaxWords={SNIPPET_WORDS * 2}, MinWords={SNIPPET_WORDS // 2}, MaxFragments=1') AS snippet
+FROM (
+    SELECT m.id AS message_id, m.conversation_id, c.title, m.role, m.created_at, m.content AS text,
+           ts_rank(to_tsvector('{config}', m.content), q.query) AS score
+    FROM message m
+    JOIN conversation c ON c.id = m.conversation_id
+    CROSS JOIN websearch_to_tsquery('{config}', :query) AS q(query)
+    WHERE to_tsvector('{config}', m.content) @@ q.query AND c.user_id = :user_id
+    UNION ALL
+    SELECT NULL, c.id, c.title, NULL, c.created_at, coalesce(c.title, ''),
+           ts_rank(to_tsvector('{config}', coalesce(c.title, '')), q.query)
+    FROM conversation c
+    CROSS JOIN websearch_to_tsquery('{config}', :query) AS q(query)
+    WHERE to_tsvector('{config}', coalesce(c.title, '')) @@ q.query AND c.user_id = :user_id
+    ORDER BY score DESC, created_at DESC
+    LIMIT :limit OFFSET :offset
+) AS hits
+"""
+
+
+def fts5_query(text):
+    """
+    Convierte el texto del usuario en una consulta FTS5 segura.
+
+    Cada palabra se busca como término literal (la sintaxis de FTS5 no se interpreta)
+    y la última también como prefijo, para buscar mientras se escribe.
+    """
+    words = re.findall(r'\w+', text, flags=re.UNICODE)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def render_snippet(snippet):
+    """Escapa el fragmento y marca las coincidencias con <mark>"""
+    return escape(snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+class MessageSearch:
+    """
+    Búsqueda ordenada por relevancia en los mensajes y títulos de un usuario.
+
+    En SQLite usa tablas FTS5 sincronizadas por triggers; en PostgreSQL, índices GIN
+    sobre to_tsvector. El esquema lo crea ensure_schema() al arrancar (prepare_database
+    en app.py), nunca una búsqueda: rellenar el índice o construir los GIN sobre un
+    historial grande puede tardar más que el timeout de un worker. Mientras no exista,
+    search() lanza SearchUnavailableError.
+    """
+
+    def __init__(self, get_read_engine, get_write_engine, language='simple'):
+        """
+        Args:
+            get_read_engine: Función que devuelve el motor para las consultas
+            get_write_engine: Función que devuelve el motor para crear el esquema
+            language: Configuración de texto de PostgreSQL ('simple', 'spanish', ...)
+        """
+        if not re.fullmatch(r'[a-z_]+', language):
+            raise ValueError(f"Configuración de búsqueda no válida: {language}")
+        self.get_read_engine = get_read_engine
+        self.get_write_engine = get_write_engine
+        self.language = language
+        self._ready = False
+        self._lock = None
+        self._lock_pid = None
+        self.searches = 0
+
+    def _get_lock(self):
+        # Se crea en el proceso que lo usa, después del monkey patching de gevent: esperar
+        # por él cede el control en lugar de bloquear el worker
+        pid = os.getpid()
+        if self._lock_pid != pid:
+            self._lock = threading.Lock()
+            self._lock_pid = pid
+        return self._lock
+
+    def ensure_schema(self):
+        """Crea los índices de búsqueda si faltan (idempotente; se llama al arrancar)"""
+        if self._ready:
+            return
+        with self._get_lock():
+            if self._ready:
+                return
+            engine = self.get_write_engine()
+            if engine.dialect.name == 'sqlite':
+                with engine.begin() as connection:
+                    existed = connection.exec_driver_sql(
+                        "SELECT 1 FROM sqlite_master WHERE name = 'message_fts'"
+                    ).first() is not None
+                    for statement in _SQLITE_FTS_DDL:
+                        connection.exec_driver_sql(statement)
+                    if not existed:
+                        # Índice nuevo: indexar lo que ya había antes de los triggers
+                        connection.exec_driver_sql("INSERT INTO message_fts(message_fts) VALUES ('rebuild')")
+                        connection.exec_driver_sql("INSERT INTO conversation_fts(conversation_fts) VALUES ('rebuild')")
+                        logger.info("Índice de búsqueda FTS5 creado y rellenado")
+            elif engine.dialect.name == 'postgresql':
+                # CONCURRENTLY no bloquea las escrituras mientras se construye el índice,
+                # pero no puede ir dentro de una transacción. Si una construcción anterior
+                # se interrumpió, el índice inválido se borra antes (IF NOT EXISTS lo saltaría)
+                with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    drop_invalid_indexes(connection, _POSTGRES_INDEXES)
+                    for statement in _postgres_ddl(self.language):
+                        connection.exec_driver_sql(statement)
+            else:
+                raise RuntimeError(f"Búsqueda no soportada para {engine.dialect.name}")
+            self._ready = True
+
+    def _schema_exists(self, connection):
+        if connection.dialect.name == 'sqlite':
+            found = connection.exec_driver_sql(
+                "SELECT count(*) FROM sqlite_master WHERE name IN ('message_fts', 'conversation_fts')"
+            ).scalar()
+            return found == 2
+        statement = sa.text(
+            "SELECT count(*) FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE i.indisvalid AND pg_table_is_visible(c.oid) AND c.relname IN :names"
+        ).bindparams(sa.bindparam('names', expanding=True))
+        return connection.execute(statement, {'names': list(_POSTGRES_INDEXES)}).scalar() == len(_POSTGRES_INDEXES)
+
+    def search(self, user_id, text, limit=20, offset=0):
+        """
+        Busca en las conversaciones del usuario.
+
+        Args:
+            user_id: Usuario propietario de las conversaciones
+            text: Texto buscado
+            limit: Resultados por página
+            offset: Resultados que se saltan (paginación)
+
+        Returns:
+            list: Coincidencias ordenadas por relevancia (mensajes y títulos); el
+                fragmento ('snippet') es HTML escapado con las coincidencias en <mark>
+        """
+        engine = self.get_read_engine()
+        params = {
+            'user_id': user_id,
+            'limit': limit,
+            'offset': offset,
+            'mark_start': _MARK_START,
+            'mark_end': _MARK_END,
+        }
+        if engine.dialect.name == 'sqlite':
+            query = fts5_query(text)
+            if query is None:
+                return []
+            statement = sa.text(_SQLITE_SEARCH)
+            params['query'] = query
+        else:
+            statement = sa.text(_postgres_search(self.language))
+            params['query'] = text
+
+        statement = statement.columns(created_at=sa.DateTime)
+        with engine.connect() as connection:
+            # Comprobación barata (catálogo) hasta ver el esquema creado una vez en el proceso
+            if not self._ready:
+                if not self._schema_exists(connection):
+                    raise SearchUnavailableError("El índice de búsqueda no está creado (flask --app app init-db)")
+                self._ready = True
+            rows = connection.execute(statement, params).mappings().all()
+        self.searches += 1
+
+        hits = []
+        for row in rows:
+            created_at = row['created_at']
+            hits.append({
+                'type': 'message' if row['message_id'] is not None else 'title',
+                'message_id': row['message_id'],
+                'conversation_id': row['conversation_id'],
+                'conversation_title': row['title'] or 'Nueva conversación',
+                'role': row['role'],
+                'created_at': created_at.isoformat() if created_at else None,
+                'snippet': render_snippet(row['snippet']),
+                'score': round(float(row['score']), 6),
+            })
+        return hits
+
+    def stats(self):
+        return {'ready': self._ready, 'searches': self.searches}
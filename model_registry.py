@@ -0,0 +1,86 @@
+# Registro de modelos Gemini reutilizables por worker
+
+import json
+import logging
+import threading
+
+from providers import LazyModule
+
+# El SDK se importa al crear el primer modelo
+genai = LazyModule('google.generativeai')
+
+logger = logging.getLogger('model_registry')
+
+
+class ModelRegistry:
+    """
+    Construye cada genai.GenerativeModel una sola vez por worker y lo reutiliza.
+
+    Los modelos se indexan por (nombre, generation_config, safety_settings), de modo
+    que dos llamadas con la misma configuración comparten la misma instancia tanto
+    en las peticiones HTTP como en las tareas en segundo plano.
+    """
+
+    def __init__(self, api_key=None):
+        self._api_key = api_key
+        self._configured = False
+        self._models = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _make_key(model_name, generation_config, safety_settings):
+        # Los dicts/listas no son hashables: se serializan de forma canónica
+        return (
+            model_name,
+            json.dumps(generation_config or {}, sort_keys=True),
+            json.dumps(safety_settings or [], sort_keys=True),
+        )
+
+    def _ensure_configured(self):
+        if not self._configured:
+            genai.configure(api_key=self._api_key)
+            self._configured = True
+
+    def get(self, model_name, generation_config=None, safety_settings=None):
+        """
+        Devuelve el modelo para la configuración indicada, creándolo si no existe.
+
+        Args:
+            model_name: Nombre del modelo Gemini (p. ej. "gemini-2.0-flash")
+            generation_config: Configuración de generación (dict)
+            safety_settings: Configuración de seguridad (lista de dicts)
+
+        Returns:
+            genai.GenerativeModel: Instancia compartida del modelo
+        """
+        key = self._make_key(model_name, generation_config, safety_settings)
+        cached = self._models.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        with self._lock:
+            cached = self._models.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self._ensure_configured()
+            instance = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=generation_config,
+                safety_settings=safety_settings
+            )
+            self._models[key] = instance
+            self.misses += 1
+            logger.info(f"Modelo {model_name} creado y registrado ({len(self._models)} en caché)")
+            return instance
+
+    def stats(self):
+        """Devuelve los contadores de aciertos/fallos del registro"""
+        return {
+            'models': len(self._models),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
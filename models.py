@@ -4,8 +4,10 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import sqlalchemy as sa
 from sqlalchemy.orm import relationship
+from database_config import RoutingSession, drop_invalid_indexes
 
-db = SQLAlchemy()
+# RoutingSession envía las escrituras a la conexión de escritura de SQLite si está configurada
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     id = sa.Column(sa.Integer, primary_key=True)
@@ -29,6 +31,11 @@ class User(UserMixin, db.Model):
         return f'<User {self.username}>'
 
 class Conversation(db.Model):
+    # Índice compuesto para la barra lateral (destacadas/recientes de un usuario por fecha)
+    __table_args__ = (
+        sa.Index('ix_conversation_user_starred_created', 'user_id', 'starred', 'created_at'),
+    )
+
     id = sa.Column(sa.Integer, primary_key=True)
     user_id = sa.Column(sa.Integer, sa.ForeignKey('user.id'), nullable=True)  # Changed to nullable=True to allow guest conversations
     title = sa.Column(sa.String(200))
@@ -41,6 +48,11 @@ class Conversation(db.Model):
         return f'<Conversation {self.id}>'
 
 class Message(db.Model):
+    # Índice compuesto para cargar el historial de una conversación ordenado por fecha
+    __table_args__ = (
+        sa.Index('ix_message_conversation_created', 'conversation_id', 'created_at'),
+    )
+
     id = sa.Column(sa.Integer, primary_key=True)
     conversation_id = sa.Column(sa.Integer, sa.ForeignKey('conversation.id'), nullable=False)
     content = sa.Column(sa.Text, nullable=False)
@@ -49,3 +61,70 @@ class Message(db.Model):
 
     def __repr__(self):
         return f'<Message {self.id}>'
+
+class VideoJob(db.Model):
+    """Operación de generación de video (Veo 2) en curso o terminada"""
+    id = sa.Column(sa.Integer, primary_key=True)
+    conversation_id = sa.Column(sa.Integer, sa.ForeignKey('conversation.id'), nullable=False)
+    operation_name = sa.Column(sa.String(255), unique=True, nullable=False)
+    prompt = sa.Column(sa.Text, nullable=False)
+    status = sa.Column(sa.String(20), default='running', index=True)  # 'running', 'done' o 'failed'
+    progress_percent = sa.Column(sa.Integer, default=0)
+    sid = sa.Column(sa.String(64), nullable=True)  # Socket.IO SID al que notificar
+    error = sa.Column(sa.Text, nullable=True)
+    # Worker que sigue la operación ('host:pid') y hasta cuándo la tiene reservada
+    owner = sa.Column(sa.String(100), nullable=True)
+    lease_until = sa.Column(sa.DateTime, nullable=True)
+    created_at = sa.Column(sa.DateTime, default=datetime.utcnow)
+    updated_at = sa.Column(sa.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<VideoJob {self.id} {self.status}>'
+
+def ensure_columns(engine):
+    """
+    Añade a tablas ya existentes las columnas declaradas que falten (create_all no lo hace).
+
+    Solo columnas que admiten NULL, que se pueden añadir sin reescribir las filas
+    existentes; un cambio de otro tipo necesita una migración propia.
+    """
+    inspector = sa.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        present = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in present:
+                continue
+            if not column.nullable:
+                raise RuntimeError(f"Falta la columna obligatoria {table.name}.{column.name}: requiere una migración")
+            ddl = sa.schema.CreateColumn(column).compile(dialect=engine.dialect)
+            with engine.begin() as connection:
+                connection.exec_driver_sql(f"ALTER TABLE {engine.dialect.identifier_preparer.format_table(table)} ADD COLUMN {ddl}")
+
+
+def ensure_indexes(engine):
+    """
+    Crea los índices declarados que falten en tablas ya existentes (create_all no lo hace).
+
+    En PostgreSQL se crean con CONCURRENTLY: en una base de datos con historial la
+    construcción puede tardar, y un CREATE INDEX normal bloquearía mientras tanto las
+    escrituras de mensajes y conversaciones. Los que quedaron inválidos por una
+    construcción interrumpida se borran y se crean de nuevo.
+    """
+    indexes = [index for table in db.metadata.sorted_tables for index in table.indexes]
+    if engine.dialect.name != 'postgresql':
+        for index in indexes:
+            index.create(bind=engine, checkfirst=True)
+        return
+    # CONCURRENTLY no puede ir dentro de una transacción
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        drop_invalid_indexes(connection, [index.name for index in indexes])
+        for index in indexes:
+            options = index.dialect_options['postgresql']
+            options['concurrently'] = True
+            try:
+                index.create(bind=connection, checkfirst=True)
+            finally:
+                options['concurrently'] = False
@@ -0,0 +1,195 @@
+# Inicialización diferida de los SDK de proveedores (Gemini, Groq) y de sus clientes
+
+import importlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('providers')
+
+
+class LazyModule:
+    """
+    Módulo que se importa en el primer acceso a uno de sus atributos.
+
+    Los submódulos se importan también al acceder a ellos, así que un paquete
+    sirve como alias de sus submódulos:
+
+        genai = LazyModule('google.generativeai')
+        PIL = LazyModule('PIL')
+        genai.configure(api_key=...)   # aquí se importa el SDK
+        PIL.Image.open(...)            # y aquí PIL.Image
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            # importlib ya serializa las importaciones concurrentes del mismo módulo
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            self.__dict__['_module'] = module
+            logger.debug(f"Módulo {self._name} importado en {(time.perf_counter() - started) * 1000:.0f}ms")
+        return module
+
+    @property
+    def loaded(self):
+        return self.__dict__['_module'] is not None
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            if attr.startswith('__'):
+                raise
+            # Submódulo todavía sin importar (p. ej. PIL.ImageOps)
+            try:
+                return importlib.import_module(f"{self._name}.{attr}")
+            except ModuleNotFoundError as e:
+                if e.name != f"{self._name}.{attr}":
+                    raise
+            raise AttributeError(f"module '{self._name}' has no attribute '{attr}'")
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'cargado' if self.loaded else 'sin cargar'
+        return f"<LazyModule {self._name} ({state})>"
+
+
+class Provider:
+    """
+    Cliente de un proveedor construido en el primer uso, una vez por proceso.
+
+    Si se construyó en otro proceso (el maestro de gunicorn antes del fork) se
+    vuelve a construir: los clientes HTTP no deben compartir sockets entre procesos.
+    Si la construcción falla se registra el error y get() devuelve None en este
+    proceso, como cuando el proveedor no está configurado.
+    """
+
+    def __init__(self, name, factory, modules=(), enabled=True):
+        """
+        Args:
+            name: Nombre del proveedor (para logs y estadísticas)
+            factory: Función sin argumentos que construye el cliente
+            modules: Módulos que importa factory (para importarlos por adelantado)
+            enabled: False si falta la configuración (API key): get() devuelve None
+        """
+        self.name = name
+        self.factory = factory
+        self.modules = tuple(modules)
+        self.enabled = enabled
+        self._instance = None
+        self._pid = None
+        self._lock = None
+        self._lock_pid = None
+        self.error = None
+        self.init_seconds = None
+
+    def get(self):
+        if not self.enabled:
+            return None
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._instance
+        # Con preload_app el módulo se importa antes del monkey patching de gevent: el lock
+        # se crea en el proceso que lo usa para que esperar por él ceda el control
+        if self._lock_pid != pid:
+            self._lock = threading.Lock()
+            self._lock_pid = pid
+        with self._lock:
+            if self._pid != pid:
+                self._build()
+                self._pid = pid
+        return self._instance
+
+    def _build(self):
+        started = time.perf_counter()
+        try:
+            self._instance = self.factory()
+            self.error = None
+            logger.info(f"Proveedor {self.name} inicializado en {(time.perf_counter() - started) * 1000:.0f}ms")
+        except Exception as e:
+            self._instance = None
+            self.error = str(e)
+            logger.error(f"Error inicializando el proveedor {self.name}: {e}")
+        self.init_seconds = time.perf_counter() - started
+
+    @property
+    def ready(self):
+        return self._pid == os.getpid()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'ready': self.ready,
+            'available': self.ready and self._instance is not None,
+            'init_ms': round(self.init_seconds * 1000, 1) if self.init_seconds is not None else None,
+            'error': self.error,
+        }
+
+
+class ProviderRegistry:
+    """
+    Proveedores con inicialización diferida.
+
+    Importar la aplicación no importa ningún SDK: cada cliente se construye en su
+    primer uso o en warm_up(), que gunicorn llama en cada worker tras el fork (ver
+    gunicorn_config.py). import_modules() importa los SDK sin construir clientes;
+    con preload_app se llama en el maestro para que los workers hereden los módulos
+    ya cargados y solo construyan sus clientes.
+    """
+
+    def __init__(self):
+        self._providers = {}
+
+    def register(self, name, factory, modules=(), enabled=True):
+        """
+        Registra un proveedor.
+
+        Args:
+            name: Nombre del proveedor
+            factory: Función sin argumentos que construye el cliente
+            modules: Módulos que importa factory
+            enabled: False si falta la configuración del proveedor
+
+        Returns:
+            Provider
+        """
+        provider = Provider(name, factory, modules=modules, enabled=enabled)
+        self._providers[name] = provider
+        return provider
+
+    def get(self, name):
+        """Cliente del proveedor (None si no está configurado o falló su inicialización)"""
+        return self._providers[name].get()
+
+    def import_modules(self):
+        """Importa los SDK de los proveedores habilitados sin construir clientes"""
+        started = time.perf_counter()
+        for provider in self._providers.values():
+            if not provider.enabled:
+                continue
+            for name in provider.modules:
+                try:
+                    importlib.import_module(name)
+                except ImportError as e:
+                    logger.error(f"No se pudo importar {name} para el proveedor {provider.name}: {e}")
+        logger.info(f"SDK de proveedores importados en {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    def warm_up(self, names=None):
+        """Construye los clientes de los proveedores habilitados (todos o los indicados)"""
+        started = time.perf_counter()
+        for name, provider in self._providers.items():
+            if names is None or name in names:
+                provider.get()
+        logger.info(f"Proveedores inicializados en el proceso {os.getpid()} en {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    def stats(self):
+        return {name: provider.stats() for name, provider in self._providers.items()}
@@ -0,0 +1,171 @@
+# Caché de respuestas para prompts repetidos (coincidencia exacta o por similitud)
+
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger('response_cache')
+
+
+def normalize_prompt(text):
+    """
+    Forma canónica de un prompt para usarla como clave.
+
+    Ignora mayúsculas, espacios repetidos y la puntuación inicial y final
+    ('¿Qué es  Python?' equivale a 'qué es python').
+    """
+    text = unicodedata.normalize('NFKC', text or '').casefold()
+    text = re.sub(r'\s+', ' ', text)
+    return text.strip(' \t\n.,;:!?¿¡"\'')
+
+
+def _unit(vector):
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else None
+
+
+def replay_chunks(text, size=48):
+    """Trocea una respuesta guardada para reenviarla como si llegara en streaming"""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+class CacheLookup:
+    """Resultado de ResponseCache.lookup; se pasa a store() para guardar la respuesta nueva"""
+
+    def __init__(self, namespace, key, embedding, response=None, semantic=False):
+        self.namespace = namespace
+        self.key = key
+        self.embedding = embedding
+        self.response = response
+        self.semantic = semantic
+
+
+class ResponseCache:
+    """
+    Caché LRU con caducidad de respuestas completas por (espacio, prompt normalizado).
+
+    El espacio separa modelos y usos ('chat:groq', 'web_search', ...). Si se indica
+    embed, cuando no hay coincidencia exacta se busca la entrada del mismo espacio
+    cuyo embedding tenga una similitud coseno >= similarity. La búsqueda por
+    similitud es lineal: max_entries acota su coste.
+
+    Solo deben guardarse respuestas que no dependan del usuario ni del historial
+    (primeras preguntas sin adjuntos, búsquedas web): la caché es compartida.
+    """
+
+    def __init__(self, max_entries=500, ttl_seconds=3600, embed=None, similarity=0.95,
+                 max_response_chars=20000):
+        """
+        Args:
+            max_entries: Número máximo de respuestas guardadas (se expulsa la menos usada)
+            ttl_seconds: Segundos que una respuesta es válida
+            embed: Función texto -> lista de floats para la coincidencia por similitud (opcional)
+            similarity: Similitud coseno mínima para aceptar una coincidencia aproximada
+            max_response_chars: Las respuestas más largas no se guardan
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.embed = embed
+        self.similarity = similarity
+        self.max_response_chars = max_response_chars
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.embed_errors = 0
+
+    def lookup(self, namespace, prompt, read=True):
+        """
+        Busca una respuesta guardada para el prompt.
+
+        Args:
+            namespace: Espacio de la caché (modelo/uso)
+            prompt: Prompt del usuario (sin plantillas alrededor)
+            read: False para omitir la caché (la respuesta nueva se guardará igualmente)
+
+        Returns:
+            CacheLookup: con response a None si no hay coincidencia
+        """
+        key = (namespace, normalize_prompt(prompt))
+        if not read:
+            self.bypassed += 1
+            return CacheLookup(namespace, key, self._embed(key[1]))
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires'] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return CacheLookup(namespace, key, entry['embedding'], entry['response'])
+
+        embedding = self._embed(key[1])
+        if embedding is not None:
+            with self._lock:
+                candidates = [
+                    (candidate_key, entry) for candidate_key, entry in self._entries.items()
+                    if candidate_key[0] == namespace and entry['embedding'] and entry['expires'] > now
+                ]
+            best_key, best_score = None, self.similarity
+            for candidate_key, entry in candidates:
+                # Vectores ya normalizados: el producto escalar es la similitud coseno
+                score = sum(a * b for a, b in zip(embedding, entry['embedding']))
+                if score >= best_score:
+                    best_key, best_score = candidate_key, score
+            if best_key is not None:
+                with self._lock:
+                    entry = self._entries.get(best_key)
+                    if entry is not None:
+                        self._entries.move_to_end(best_key)
+                        self.hits += 1
+                        self.semantic_hits += 1
+                        logger.debug(f"Coincidencia aproximada ({best_score:.3f}) en {namespace}")
+                        return CacheLookup(namespace, key, embedding, entry['response'], semantic=True)
+
+        self.misses += 1
+        return CacheLookup(namespace, key, embedding)
+
+    def store(self, lookup, response):
+        """Guarda la respuesta generada para el prompt de una búsqueda sin coincidencia"""
+        if not response or len(response) > self.max_response_chars:
+            return
+        with self._lock:
+            self._entries[lookup.key] = {
+                'response': response,
+                'embedding': lookup.embedding,
+                'expires': time.monotonic() + self.ttl,
+            }
+            self._entries.move_to_end(lookup.key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _embed(self, text):
+        if self.embed is None or not text:
+            return None
+        try:
+            return _unit(self.embed(text))
+        except Exception as e:
+            # Sin embedding se sigue funcionando solo con coincidencias exactas
+            self.embed_errors += 1
+            logger.warning(f"No se pudo calcular el embedding del prompt: {e}")
+            return None
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'evictions': self.evictions,
+            'embed_errors': self.embed_errors,
+        }
@@ -1,5 +1,10 @@
 document.addEventListener('DOMContentLoaded', () => {
     const socket = io();
+
+    // Configuración del servidor: anchos de las variantes de imagen (IMAGE_VARIANT_WIDTHS)
+    const appConfigElement = document.getElementById('app-config');
+    const appConfig = appConfigElement ? JSON.parse(appConfigElement.textContent) : {};
+    const imageVariantWidths = appConfig.imageVariantWidths || [];
     
     const modelSelector = document.getElementById('model-selector'); // Get the hidden select
     const modelNameElements = document.querySelectorAll('#model-name'); // Get all elements displaying the model name
@@ -109,49 +114,69 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    // Cargar conversaciones al inicio
-    function loadConversations() {
-        fetch('/api/conversations')
+    // Crear el elemento de la barra lateral para una conversación
+    function createChatItem(conv) {
+        const chatItem = document.createElement('div');
+        chatItem.className = 'chat-item';
+        
+        const chatTitle = document.createElement('span');
+        chatTitle.textContent = conv.title || 'Nueva conversación';
+        chatItem.appendChild(chatTitle);
+        
+        const starButton = document.createElement('button');
+        starButton.className = `star-btn ${conv.starred ? 'starred' : ''}`;
+        starButton.innerHTML = '<i class="fas fa-star"></i>';
+        
+        // Improved star button click handler
+        starButton.onclick = (e) => {
+            e.preventDefault();
+            e.stopPropagation();
+            toggleStar(conv.id, !conv.starred);
+            
+            // Update visual feedback immediately
+            starButton.classList.toggle('starred');
+        };
+        
+        chatItem.appendChild(starButton);
+        chatItem.dataset.id = conv.id;
+        chatItem.addEventListener('click', () => loadConversation(conv.id));
+        return chatItem;
+    }
+
+    // Cargar una página de conversaciones (destacadas o recientes) en su sección
+    function loadConversationPage(starred, container, cursor = null) {
+        let url = `/api/conversations?starred=${starred}`;
+        if (cursor) {
+            url += `&before=${cursor}`;
+        }
+        return fetch(url)
             .then(response => response.json())
             .then(data => {
-                recentChats.innerHTML = '';
-                starredChats.innerHTML = '';
+                const oldMoreButton = container.querySelector('.load-more-chats');
+                if (oldMoreButton) {
+                    oldMoreButton.remove();
+                }
+                data.conversations.forEach(conv => container.appendChild(createChatItem(conv)));
                 
-                data.conversations.forEach(conv => {
-                    const chatItem = document.createElement('div');
-                    chatItem.className = 'chat-item';
-                    
-                    const chatTitle = document.createElement('span');
-                    chatTitle.textContent = conv.title || 'Nueva conversación';
-                    chatItem.appendChild(chatTitle);
-                    
-                    const starButton = document.createElement('button');
-                    starButton.className = `star-btn ${conv.starred ? 'starred' : ''}`;
-                    starButton.innerHTML = '<i class="fas fa-star"></i>';
-                    
-                    // Improved star button click handler
-                    starButton.onclick = (e) => {
-                        e.preventDefault();
-                        e.stopPropagation();
-                        toggleStar(conv.id, !conv.starred);
-                        
-                        // Update visual feedback immediately
-                        starButton.classList.toggle('starred');
-                    };
-                    
-                    chatItem.appendChild(starButton);
-                    chatItem.dataset.id = conv.id;
-                    chatItem.addEventListener('click', () => loadConversation(conv.id));
-                    
-                    // Move chat item to appropriate section
-                    if (conv.starred) {
-                        starredChats.appendChild(chatItem);
-                    } else {
-                        recentChats.appendChild(chatItem);
-                    }
-                });
-            })
-            .catch(error => console.error('Error cargando conversaciones:', error));
+                // Botón para cargar la siguiente página
+                if (data.next_cursor) {
+                    const moreButton = document.createElement('button');
+                    moreButton.className = 'load-more-chats';
+                    moreButton.textContent = 'Ver más';
+                    moreButton.onclick = () => loadConversationPage(starred, container, data.next_cursor);
+                    container.appendChild(moreButton);
+                }
+            });
+    }
+
+    // Cargar conversaciones al inicio
+    function loadConversations() {
+        recentChats.innerHTML = '';
+        starredChats.innerHTML = '';
+        Promise.all([
+            loadConversationPage(true, starredChats),
+            loadConversationPage(false, recentChats)
+        ]).catch(error => console.error('Error cargando conversaciones:', error));
     }
 
     function toggleStar(conversationId, starred) {
@@ -171,7 +196,7 @@ document.addEventListener('DOMContentLoaded', () => {
         })
         .catch(error => console.error('Error al cambiar estado destacado:', error));
     }
-    // Cargar una conversación específica
+    // Cargar una conversación específica (solo la página más reciente de mensajes)
     function loadConversation(conversationId) {
         fetch(`/api/conversations/${conversationId}`)
             .then(response => response.json())
@@ -181,11 +206,50 @@ document.addEventListener('DOMContentLoaded', () => {
                 data.messages.forEach(msg => {
                     addMessage(msg.content, msg.role === 'user');
                 });
+                updateLoadOlderButton(conversationId, data.next_cursor);
                 highlightCurrentChat(conversationId);
             })
             .catch(error => console.error('Error cargando conversación:', error));
     }
 
+    // Mostrar u ocultar el botón para cargar mensajes anteriores
+    function updateLoadOlderButton(conversationId, cursor) {
+        let loadOlderButton = messagesContainer.querySelector('.load-older-btn');
+        if (!cursor) {
+            if (loadOlderButton) {
+                loadOlderButton.remove();
+            }
+            return;
+        }
+        if (!loadOlderButton) {
+            loadOlderButton = document.createElement('button');
+            loadOlderButton.className = 'load-older-btn';
+            loadOlderButton.textContent = 'Cargar mensajes anteriores';
+            messagesContainer.prepend(loadOlderButton);
+        }
+        loadOlderButton.onclick = () => loadOlderMessages(conversationId, cursor);
+    }
+
+    // Cargar la página anterior de mensajes y añadirla al principio
+    function loadOlderMessages(conversationId, cursor) {
+        fetch(`/api/conversations/${conversationId}?before=${cursor}`)
+            .then(response => response.json())
+            .then(data => {
+                if (currentConversationId !== conversationId) return;
+                const loadOlderButton = messagesContainer.querySelector('.load-older-btn');
+                const firstMessage = loadOlderButton ? loadOlderButton.nextSibling : messagesContainer.firstChild;
+                const previousHeight = messagesContainer.scrollHeight;
+                data.messages.forEach(msg => {
+                    const messageDiv = addMessage(msg.content, msg.role === 'user');
+                    messagesContainer.insertBefore(messageDiv, firstMessage);
+                });
+                updateLoadOlderButton(conversationId, data.next_cursor);
+                // Mantener la posición de lectura
+                messagesContainer.scrollTop = messagesContainer.scrollHeight - previousHeight;
+            })
+            .catch(error => console.error('Error cargando mensajes anteriores:', error));
+    }
+
     // Resaltar chat actual
     function highlightCurrentChat(conversationId) {
         document.querySelectorAll('.chat-item').forEach(item => {
@@ -239,7 +303,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 
                 // Crear la imagen
                 const img = document.createElement('img');
-                img.src = imgUrl;
+                img.src = `${imgUrl}?w=640`;
+                // El servidor elige WebP/AVIF y la variante más pequeña que cubre cada ancho
+                if (imageVariantWidths.length) {
+                    img.srcset = imageVariantWidths.map(w => `${imgUrl}?w=${w} ${w}w`).join(', ');
+                }
+                img.sizes = '(max-width: 768px) 90vw, 640px';
                 img.alt = 'Imagen generada';
                 img.loading = 'lazy';
                 
@@ -325,6 +394,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         // Scroll al último mensaje
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        return messageDiv;
     }
 
     // Manejar subida de archivos
@@ -414,6 +484,11 @@ document.addEventListener('DOMContentLoaded', () => {
     socket.on('message', (data) => {
         console.log("Mensaje recibido:", data); // Para depuración
 
+        // Un video terminado reemplaza su indicador de progreso
+        if (data.model_type === 'kkty2-video' && data.done) {
+            messagesContainer.querySelectorAll('.video-progress-status').forEach(el => el.remove());
+        }
+
         const loadingIndicator = document.querySelector('.loading-indicator');
         if (loadingIndicator) {
             loadingIndicator.remove();
@@ -487,6 +562,37 @@ document.addEventListener('DOMContentLoaded', () => {
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
     });
 
+    // Mostrar la posición en la cola mientras la respuesta espera su turno
+    socket.on('queue_position', (data) => {
+        const loadingIndicator = document.querySelector('.loading-indicator');
+        if (!loadingIndicator) return;
+        let queueText = loadingIndicator.querySelector('.queue-position');
+        if (data.position > 0) {
+            if (!queueText) {
+                queueText = document.createElement('div');
+                queueText.className = 'queue-position';
+                loadingIndicator.querySelector('.message-bubble').appendChild(queueText);
+            }
+            queueText.textContent = `En cola (posición ${data.position})...`;
+        } else if (queueText) {
+            queueText.remove();
+        }
+    });
+
+    // Mostrar el progreso de la generación de videos (Veo 2)
+    socket.on('video_progress', (data) => {
+        if (String(data.conversation_id) !== String(currentConversationId)) return;
+        let progressStatus = messagesContainer.querySelector(`.video-progress-status[data-job-id="${data.job_id}"]`);
+        if (!progressStatus) {
+            progressStatus = document.createElement('div');
+            progressStatus.className = 'video-progress-status';
+            progressStatus.dataset.jobId = data.job_id;
+            messagesContainer.appendChild(progressStatus);
+        }
+        progressStatus.textContent = `Generando video... ${data.progress_percent}%`;
+        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    });
+
     // Función para mostrar el indicador de carga
     function showLoadingIndicator() {
         const loadingDiv = document.createElement('div');
@@ -562,7 +668,7 @@ document.addEventListener('DOMContentLoaded', () => {
         })
         .then(response => {
             if (!response.ok) {
-                return response.json().then(err => { throw new Error(err.error || 'Error en la respuesta del servidor'); });
+                return response.json().then(err => { throw new Error(err.error || err.message || 'Error en la respuesta del servidor'); });
             }
             return response.json();
         })
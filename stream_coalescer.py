@@ -0,0 +1,90 @@
+# Agrupación de fragmentos de streaming en envíos por tamaño/tiempo
+
+import threading
+import time
+
+
+class StreamCoalescer:
+    """
+    Acumula fragmentos de texto y los envía agrupados en lugar de uno por token.
+
+    Se envía el búfer cuando alcanza max_bytes o cuando han pasado max_interval_ms
+    desde el último envío, lo que ocurra primero. Con spawn y sleep, el primer
+    fragmento que entra en un búfer vacío programa un envío al cumplirse el plazo,
+    así que el texto no se queda esperando si el proveedor hace una pausa entre
+    fragmentos; sin ellos, el plazo solo se comprueba al recibir cada fragmento.
+    close() (o salir del bloque with) envía lo que quede.
+
+    Uso:
+        with StreamCoalescer(lambda text: socketio.emit('message_progress', {...}),
+                             spawn=socketio.start_background_task, sleep=socketio.sleep) as coalescer:
+            for chunk in stream:
+                coalescer.push(chunk)
+    """
+
+    def __init__(self, emit, max_bytes=64, max_interval_ms=80, spawn=None, sleep=None):
+        """
+        Args:
+            emit: Función que recibe el texto agrupado y lo envía
+            max_bytes: Tamaño (bytes UTF-8) a partir del cual se envía el búfer
+            max_interval_ms: Tiempo máximo (ms) que un fragmento espera en el búfer
+            spawn: Función para lanzar el envío programado en segundo plano (opcional)
+            sleep: Espera cooperativa del envío programado (necesaria con spawn)
+        """
+        self._emit = emit
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval_ms / 1000.0
+        self.spawn = spawn
+        self.sleep = sleep
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = time.monotonic()
+        # Cada envío invalida el envío programado pendiente (no hace falta cancelarlo)
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.emits = 0
+        self.timed_emits = 0
+
+    def push(self, text):
+        if not text:
+            return
+        with self._lock:
+            schedule = not self._buffer
+            self._buffer.append(text)
+            self._buffered_bytes += len(text.encode('utf-8'))
+            waited = time.monotonic() - self._last_flush
+            due = self._buffered_bytes >= self.max_bytes or waited >= self.max_interval
+            generation = self._generation
+        if due:
+            self.flush()
+        elif schedule and self.spawn:
+            self.spawn(self._flush_later, generation, self.max_interval - waited)
+
+    def _flush_later(self, generation, delay):
+        self.sleep(delay)
+        if generation == self._generation and self._buffer:
+            self.timed_emits += 1
+            self.flush()
+
+    def flush(self):
+        # El lock mantiene el orden de los envíos entre push() y el envío programado
+        with self._lock:
+            self._generation += 1
+            if self._buffer:
+                text = ''.join(self._buffer)
+                self._buffer = []
+                self._buffered_bytes = 0
+                self._emit(text)
+                self.emits += 1
+            self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Enviar lo pendiente también si el stream falla a mitad
+        self.flush()
+        return False
@@ -0,0 +1,139 @@
+# Pruebas de concurrencia del perfil de SQLite (ejecutar con: python -m pytest test_sqlite_concurrency.py)
+
+import threading
+
+import pytest
+from flask import Flask
+
+from database_config import (
+    SQLITE_WRITER_BIND,
+    configure_sqlite,
+    get_write_engine,
+    install_sqlite_pragmas,
+    sqlite_pragmas,
+)
+from message_persister import MessagePersister
+from models import db, User, Conversation, Message
+
+THREADS = 12
+WRITES_PER_THREAD = 40
+
+
+def make_app(tmp_path, profile='tuned'):
+    app = Flask(__name__)
+    configure_sqlite(app, f"sqlite:///{tmp_path / 'concurrency.sqlite'}", profile=profile, readers=4, busy_timeout_ms=5000)
+    db.init_app(app)
+    if profile == 'tuned':
+        install_sqlite_pragmas(app, db, sqlite_pragmas())
+    with app.app_context():
+        # El bind de escritura apunta al mismo fichero: las tablas se crean una vez
+        db.create_all(bind_key=None)
+        user = User(email='test@example.com', username='test')
+        db.session.add(user)
+        db.session.commit()
+        conversations = [Conversation(user_id=user.id, title=f'c{i}') for i in range(THREADS)]
+        db.session.add_all(conversations)
+        db.session.commit()
+        conversation_ids = [conversation.id for conversation in conversations]
+    return app, conversation_ids
+
+
+def run_threads(target, count):
+    errors = []
+
+    def wrapper(index):
+        try:
+            target(index)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=wrapper, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_tuned_profile_applies_pragmas_and_single_writer(tmp_path):
+    app, _ = make_app(tmp_path)
+    with app.app_context():
+        assert db.engines[SQLITE_WRITER_BIND].pool.size() == 1
+        assert db.engine.pool.size() == 4
+        with db.engine.connect() as connection:
+            assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+            assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+
+
+def test_default_profile_keeps_plain_engine(tmp_path):
+    app, _ = make_app(tmp_path, profile='default')
+    with app.app_context():
+        assert SQLITE_WRITER_BIND not in db.engines
+        assert get_write_engine(db) is db.engine
+
+
+def test_concurrent_orm_writes_and_reads(tmp_path):
+    app, conversation_ids = make_app(tmp_path)
+
+    def worker(index):
+        with app.app_context():
+            for n in range(WRITES_PER_THREAD):
+                db.session.add(Message(conversation_id=conversation_ids[index], content=f'{index}-{n}', role='user'))
+                db.session.commit()
+                # Lectura intercalada por el pool de lectura
+                Message.query.filter_by(conversation_id=conversation_ids[index]).count()
+
+    errors = run_threads(worker, THREADS)
+    assert errors == []
+    with app.app_context():
+        assert Message.query.count() == THREADS * WRITES_PER_THREAD
+
+
+def test_writes_are_routed_to_writer_connection(tmp_path):
+    app, conversation_ids = make_app(tmp_path)
+    with app.app_context():
+        writer = db.engines[SQLITE_WRITER_BIND]
+        assert db.session.get_bind(clause=Message.__table__.select()) is db.engine
+        db.session.add(Message(conversation_id=conversation_ids[0], content='x', role='user'))
+        db.session.flush()
+        # Tras escribir, la transacción lee por la misma conexión para ver sus cambios
+        assert db.session.get_bind(clause=Message.__table__.select()) is writer
+        assert Message.query.filter_by(content='x').count() == 1
+        db.session.commit()
+        assert db.session.get_bind(clause=Message.__table__.select()) is db.engine
+
+
+def test_persister_batches_keep_order_per_conversation(tmp_path):
+    app, conversation_ids = make_app(tmp_path)
+    persister = MessagePersister(
+        app,
+        lambda: get_write_engine(db),
+        Message.__table__,
+        spawn=lambda fn: None,
+        sleep=lambda seconds: None,
+        max_batch=25
+    )
+    # Simula un worker con el bucle activo: save() solo escribe al completar un lote
+    persister.start()
+
+    def worker(index):
+        for n in range(WRITES_PER_THREAD):
+            persister.save(conversation_ids[index], str(n), 'assistant')
+
+    errors = run_threads(worker, THREADS)
+    persister.close()
+    assert errors == []
+    assert persister.stats()['pending'] == 0
+    assert persister.batches < THREADS * WRITES_PER_THREAD
+
+    with app.app_context():
+        for conversation_id in conversation_ids:
+            contents = [
+                m.content for m in Message.query.filter_by(conversation_id=conversation_id).order_by(Message.id)
+            ]
+            assert contents == [str(n) for n in range(WRITES_PER_THREAD)]
+
+
+if __name__ == '__main__':
+    raise SystemExit(pytest.main([__file__, '-q']))
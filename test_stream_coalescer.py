@@ -0,0 +1,65 @@
+# Pruebas de la agrupación de fragmentos de streaming (ejecutar con: python -m pytest test_stream_coalescer.py)
+
+import threading
+import time
+
+from stream_coalescer import StreamCoalescer
+
+
+def spawn_thread(fn, *args):
+    thread = threading.Thread(target=fn, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_flushes_by_size():
+    emitted = []
+    coalescer = StreamCoalescer(emitted.append, max_bytes=10, max_interval_ms=10000)
+    coalescer.push('12345')
+    assert emitted == []
+    coalescer.push('67890')
+    assert emitted == ['1234567890']
+
+
+def test_timed_flush_during_upstream_pause():
+    # Un fragmento corto y luego una pausa del proveedor: se envía al cumplirse el plazo
+    emitted = []
+    coalescer = StreamCoalescer(emitted.append, max_bytes=1000, max_interval_ms=50,
+                                spawn=spawn_thread, sleep=time.sleep)
+    coalescer.push('Hola')
+    assert emitted == []
+    time.sleep(0.15)
+    assert emitted == ['Hola']
+    assert coalescer.timed_emits == 1
+
+
+def test_flush_cancels_scheduled_flush():
+    emitted = []
+    coalescer = StreamCoalescer(emitted.append, max_bytes=1000, max_interval_ms=50,
+                                spawn=spawn_thread, sleep=time.sleep)
+    with coalescer:
+        coalescer.push('Hola')
+    assert emitted == ['Hola']
+    coalescer.push(' mundo')
+    # El envío programado para 'Hola' ya no aplica; el de ' mundo' sale en su plazo
+    assert wait_for(lambda: emitted == ['Hola', ' mundo'])
+    time.sleep(0.1)
+    assert emitted == ['Hola', ' mundo']
+    assert coalescer.timed_emits == 1
+
+
+def test_without_spawn_deadline_checked_on_push():
+    emitted = []
+    coalescer = StreamCoalescer(emitted.append, max_bytes=1000, max_interval_ms=20)
+    coalescer.push('a')
+    time.sleep(0.05)
+    assert emitted == []
+    coalescer.push('b')
+    assert emitted == ['ab']
@@ -0,0 +1,176 @@
+# Capa de clientes de proveedores externos (Groq y Gemini): pool de conexiones,
+# timeouts por llamada y límite de peticiones simultáneas por proveedor
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger('upstream_clients')
+
+
+class UpstreamBusyError(Exception):
+    """Se lanza cuando un proveedor tiene todas sus plazas ocupadas durante demasiado tiempo"""
+    pass
+
+
+class InFlightLimiter:
+    """
+    Limita el número de llamadas simultáneas a un proveedor.
+
+    Con gevent, threading.BoundedSemaphore queda parcheado y la espera cede el control
+    al resto de greenlets. Si no se consigue plaza en acquire_timeout segundos se lanza
+    UpstreamBusyError, así un proveedor lento no acumula greenlets esperando sin fin.
+
+    Uso:
+        with limiter:
+            response = client.call(...)
+
+        for chunk in limiter.wrap_stream(lambda: client.stream(...)):
+            ...
+    """
+
+    def __init__(self, name, limit, acquire_timeout=10):
+        """
+        Args:
+            name: Nombre del proveedor (para logs y estadísticas)
+            limit: Número máximo de llamadas simultáneas
+            acquire_timeout: Segundos máximos esperando una plaza libre
+        """
+        self.name = name
+        self.limit = limit
+        self.acquire_timeout = acquire_timeout
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    def acquire(self):
+        started = time.monotonic()
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            self.rejected += 1
+            logger.warning(f"{self.name}: sin plazas libres tras {self.acquire_timeout}s ({self.limit} llamadas en curso)")
+            raise UpstreamBusyError(f"El proveedor {self.name} está saturado, inténtalo de nuevo en unos segundos")
+        self.total_wait += time.monotonic() - started
+        self.calls += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def release(self, failed=False):
+        self.in_flight -= 1
+        if failed:
+            self.errors += 1
+        self._semaphore.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release(failed=exc_type is not None)
+        return False
+
+    def wrap_stream(self, start):
+        """
+        Ejecuta start() y recorre su resultado manteniendo la plaza ocupada.
+
+        La plaza se libera al agotar el stream, si falla o si el consumidor lo
+        abandona (cierre del generador).
+        """
+        self.acquire()
+        failed = False
+        try:
+            for item in start():
+                yield item
+        except BaseException as e:
+            failed = not isinstance(e, GeneratorExit)
+            raise
+        finally:
+            self.release(failed=failed)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'calls': self.calls,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self.total_wait / self.calls * 1000, 2) if self.calls else 0.0,
+        }
+
+
+def build_groq_client(api_key, max_connections=20, max_keepalive=10, keepalive_expiry=30,
+                      connect_timeout=5, read_timeout=60, max_retries=1):
+    """
+    Crea el cliente Groq compartido con un pool httpx de tamaño explícito.
+
+    Args:
+        api_key: API key de Groq
+        max_connections: Conexiones máximas abiertas a la API
+        max_keepalive: Conexiones inactivas que se mantienen para reutilizarlas
+        keepalive_expiry: Segundos que una conexión inactiva sigue abierta
+        connect_timeout: Timeout (s) para establecer la conexión
+        read_timeout: Timeout (s) entre bytes recibidos (también entre fragmentos del stream)
+        max_retries: Reintentos del SDK ante errores transitorios
+
+    Returns:
+        Groq: Cliente listo para usar desde cualquier greenlet
+    """
+    # Importación diferida: el SDK solo se carga si hay API key de Groq
+    import httpx
+    from groq import Groq
+
+    timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        ),
+        timeout=timeout
+    )
+    return Groq(api_key=api_key, http_client=http_client, timeout=timeout, max_retries=max_retries)
+
+
+class UpstreamClients:
+    """
+    Agrupa los limitadores por proveedor y los timeouts de cada llamada.
+
+    Groq usa un único cliente con pool httpx (ver build_groq_client), construido en
+    su primer uso por get_groq_client. El SDK de Gemini gestiona su propio transporte,
+    así que para Gemini se controla el timeout de cada llamada con request_options y
+    el número de llamadas simultáneas con el limitador.
+    """
+
+    def __init__(self, get_groq_client=None, limits=None, gemini_timeout=60, acquire_timeout=10):
+        """
+        Args:
+            get_groq_client: Función sin argumentos que devuelve el cliente Groq compartido
+                (o None si no está configurado)
+            limits: Dict proveedor -> llamadas simultáneas máximas
+            gemini_timeout: Timeout (s) por llamada a Gemini
+            acquire_timeout: Segundos máximos esperando plaza en un proveedor
+        """
+        self.get_groq_client = get_groq_client
+        self.gemini_timeout = gemini_timeout
+        self.limiters = {
+            name: InFlightLimiter(name, limit, acquire_timeout=acquire_timeout)
+            for name, limit in (limits or {}).items()
+        }
+
+    @property
+    def groq(self):
+        return self.get_groq_client() if self.get_groq_client else None
+
+    def limiter(self, provider):
+        return self.limiters[provider]
+
+    def gemini_request_options(self, timeout=None):
+        """Opciones por llamada para generate_content/send_message de Gemini"""
+        return {'timeout': timeout or self.gemini_timeout}
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
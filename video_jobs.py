@@ -0,0 +1,209 @@
+# Seguimiento persistente de las operaciones de generación de video (Veo 2)
+
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from database_config import release_connection
+from models import db, VideoJob
+
+logger = logging.getLogger('video_jobs')
+
+
+class VideoJobTracker:
+    """
+    Sigue todas las operaciones de video pendientes desde un único bucle por worker.
+
+    El nombre de cada operación se guarda en la tabla VideoJob, de modo que tras un
+    reinicio del worker (max_requests en gunicorn_config.py) el seguimiento continúa
+    donde se quedó. El progreso se notifica con el evento Socket.IO 'video_progress' y
+    el resultado final con el evento 'message' habitual.
+
+    Con varios workers (o el worker saliente y el nuevo durante un reinicio) cada
+    trabajo lo sigue uno solo: en cada consulta el worker reserva el trabajo con un
+    UPDATE atómico (owner, lease_until) que solo prospera si nadie más lo tiene
+    reservado, y el paso a 'done'/'failed' solo se aplica si aún tiene la reserva. Así
+    los videos se descargan y el mensaje final se guarda una sola vez.
+    """
+
+    def __init__(self, app, socketio, get_operation, save_videos, save_message,
+                 poll_interval=20, timeout=600, lease_seconds=None):
+        """
+        Args:
+            app: Aplicación Flask (para el contexto de la base de datos)
+            socketio: Instancia de SocketIO usada para emitir eventos y lanzar el bucle
+            get_operation: Función nombre_operación -> operación actualizada
+            save_videos: Función operación -> lista de URLs de videos guardados
+            save_message: Función (conversation_id, content, role) para guardar mensajes
+            poll_interval: Segundos entre consultas del estado de las operaciones
+            timeout: Segundos tras los que una operación se da por fallida
+            lease_seconds: Duración de la reserva de un trabajo (por defecto, seis
+                ciclos de consulta y al menos dos minutos, para cubrir la descarga)
+        """
+        self.app = app
+        self.socketio = socketio
+        self.get_operation = get_operation
+        self.save_videos = save_videos
+        self.save_message = save_message
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.lease = timedelta(seconds=lease_seconds or max(poll_interval * 6, 120))
+        self._hostname = socket.gethostname()
+        self._pid = None
+
+    def start(self):
+        """Lanza el bucle de seguimiento una vez por proceso (seguro tras el fork de gunicorn)"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.socketio.start_background_task(self._loop)
+        logger.info(f"Seguimiento de trabajos de video iniciado en el proceso {self._pid}")
+
+    @property
+    def owner(self):
+        """Identificador de este worker en las reservas ('host:pid')"""
+        return f"{self._hostname}:{os.getpid()}"
+
+    def track(self, conversation_id, operation_name, prompt, sid):
+        """Registra una operación recién iniciada para que el bucle la siga"""
+        job = VideoJob(
+            conversation_id=conversation_id,
+            operation_name=operation_name,
+            prompt=prompt,
+            sid=sid
+        )
+        db.session.add(job)
+        db.session.commit()
+        logger.info(f"Trabajo de video {job.id} registrado para la operación {operation_name}")
+        return job
+
+    def _loop(self):
+        with self.app.app_context():
+            try:
+                VideoJob.__table__.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                logger.error(f"No se pudo crear la tabla de trabajos de video: {e}")
+        while True:
+            try:
+                with self.app.app_context():
+                    self.tick()
+            except Exception as e:
+                logger.error(f"Error en el seguimiento de trabajos de video: {e}", exc_info=True)
+            self.socketio.sleep(self.poll_interval)
+
+    def tick(self):
+        """Consulta una vez todas las operaciones pendientes que este worker puede reservar"""
+        job_ids = [job_id for (job_id,) in db.session.query(VideoJob.id).filter_by(status='running').order_by(VideoJob.id)]
+        for job_id in job_ids:
+            try:
+                if not self._claim(job_id):
+                    continue  # La sigue otro worker
+                job = db.session.get(VideoJob, job_id)
+                self._poll(job)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error consultando el trabajo de video {job_id}: {e}", exc_info=True)
+
+    def _claim(self, job_id):
+        """Reserva (o renueva) un trabajo para este worker; False si lo tiene otro"""
+        now = datetime.utcnow()
+        result = db.session.execute(
+            sa.update(VideoJob)
+            .where(
+                VideoJob.id == job_id,
+                VideoJob.status == 'running',
+                sa.or_(VideoJob.owner.is_(None), VideoJob.owner == self.owner, VideoJob.lease_until < now)
+            )
+            .values(owner=self.owner, lease_until=now + self.lease)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+    def release(self):
+        """Libera las reservas de este worker (al salir) para que otro las siga sin esperar"""
+        with self.app.app_context():
+            db.session.execute(
+                sa.update(VideoJob)
+                .where(VideoJob.owner == self.owner, VideoJob.status == 'running')
+                .values(owner=None, lease_until=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+
+    def _poll(self, job):
+        if datetime.utcnow() - job.created_at > timedelta(seconds=self.timeout):
+            logger.error(f"Timeout esperando la generación del video (Operación: {job.operation_name})")
+            self._finish(job, 'failed', "Lo siento, la generación de los videos con Veo 2 tardó demasiado y se canceló. Por favor, intenta de nuevo más tarde.")
+            return
+
+        operation_name = job.operation_name
+        # La conexión no se retiene mientras se consulta al proveedor
+        release_connection(db)
+        try:
+            operation = self.get_operation(operation_name)
+        except Exception as poll_error:
+            # Errores transitorios: se reintenta en el siguiente ciclo
+            logger.warning(f"Error al obtener el estado de la operación {operation_name}: {poll_error}")
+            return
+
+        if not operation.done:
+            metadata = getattr(operation, 'metadata', None)
+            progress = getattr(metadata, 'progress_percent', None) if metadata else None
+            if progress is not None and int(progress) != job.progress_percent:
+                job.progress_percent = int(progress)
+                db.session.commit()
+                self.socketio.emit('video_progress', {
+                    'conversation_id': job.conversation_id,
+                    'job_id': job.id,
+                    'progress_percent': job.progress_percent
+                }, room=job.sid)
+            return
+
+        if operation.error:
+            logger.error(f"La operación de generación de video falló con error: {operation.error.message} (Código: {operation.error.code})")
+            self._finish(job, 'failed', "Lo siento, no pude generar los videos con Veo 2. Hubo un problema durante la generación. Por favor, revisa el prompt, asegúrate de que el servicio Veo 2 esté activo y tu API key tenga permisos, o intenta de nuevo más tarde.", error=str(operation.error.message))
+            return
+
+        # La descarga puede tardar: se renueva la reserva antes de empezar
+        if not self._claim(job.id):
+            logger.warning(f"Trabajo de video {job.id} reservado por otro worker: no se descarga")
+            return
+        video_urls = self.save_videos(operation)
+        if video_urls:
+            response_content = f"Aquí tienes los videos generados a partir de '{job.prompt}':\n"
+            for url in video_urls:
+                response_content += f"[GENERATED_VIDEO:{url}]\n"
+            self._finish(job, 'done', response_content)
+        else:
+            self._finish(job, 'failed', "Lo siento, no pude generar los videos con Veo 2. Hubo un problema durante la generación. Por favor, revisa el prompt, asegúrate de que el servicio Veo 2 esté activo y tu API key tenga permisos, o intenta de nuevo más tarde.")
+
+    def _finish(self, job, status, content, error=None):
+        # Solo si este worker conserva la reserva: otro pudo tomarla si la nuestra caducó
+        values = {'status': status, 'owner': None, 'lease_until': None}
+        if status == 'done':
+            values['progress_percent'] = 100
+        if error is not None:
+            values['error'] = error
+        result = db.session.execute(
+            sa.update(VideoJob)
+            .where(VideoJob.id == job.id, VideoJob.status == 'running', VideoJob.owner == self.owner)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if result.rowcount != 1:
+            logger.warning(f"Trabajo de video {job.id} ya finalizado o reservado por otro worker")
+            return
+        logger.info(f"Trabajo de video {job.id} finalizado con estado {status}")
+        self.socketio.emit('message', {
+            'role': 'assistant',
+            'content': content,
+            'done': True,
+            'conversation_id': job.conversation_id,
+            'model_type': 'kkty2-video'
+        }, room=job.sid)
+        self.save_message(job.conversation_id, content, 'assistant')